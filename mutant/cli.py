@@ -3,24 +3,125 @@
 
 # !/usr/bin/env python
 
+import functools
 import os
 import subprocess
+import sys
 from datetime import datetime
 
 import click
 
 from mutant import version, log, WD, TIMESTAMP
-from mutant.modules.sarscov2_start import RunSC2
-from mutant.modules.generic_parser import get_json
-from mutant.modules.sarscov2_report import ReportSC2
-from mutant.modules.sarscov2_delivery import DeliverySC2
+
+# Implementation modules are imported by the commands that need them,
+# keeping the startup of lightweight commands free of pandas/yaml
+
+# Options of the sarscov2 reports, shared by every command that builds them
+REPORT_OPTIONS = [
+    click.option(
+        "--engine",
+        help="Ingestion engine for the artic result tables",
+        type=click.Choice(["csv", "pandas"]),
+        default="csv",
+    ),
+    click.option("--workers", help="Report stages run in parallel", default=4, type=int),
+    click.option(
+        "--verify_deliverables",
+        help="Check that all deliverables exist and record their size and checksum",
+        is_flag=True,
+    ),
+    click.option(
+        "--warehouse",
+        help="SQLite results warehouse to load the results into, overrides the MUTANT configuration",
+        default="",
+    ),
+    click.option(
+        "--json_format",
+        help="Artic json output: a single json, indexed JSON Lines (one sample per line) or both",
+        type=click.Choice(["json", "jsonl", "both"]),
+        default="json",
+    ),
+    click.option(
+        "--streaming",
+        help="Build the reports in one sample-by-sample pass, in constant memory",
+        is_flag=True,
+    ),
+    click.option(
+        "--variant_shards",
+        help="Also split the variant report per region-lab or per sample",
+        type=click.Choice(["none", "regionlab", "sample"]),
+        default="none",
+    ),
+    click.option(
+        "--consensus_qc",
+        help="Recompute QC metrics from the consensus sequences and check them against qc.csv",
+        is_flag=True,
+    ),
+]
+
+
+class ReportSettings:
+    """Values of the REPORT_OPTIONS of a command"""
+
+    __slots__ = (
+        "engine",
+        "workers",
+        "verify_deliverables",
+        "warehouse",
+        "json_format",
+        "streaming",
+        "variant_shards",
+        "consensus_qc",
+    )
+
+    def __init__(self, **options):
+        for name in self.__slots__:
+            setattr(self, name, options[name])
+
+    def report_kwargs(self, config_mutant):
+        """Keyword arguments of ReportSC2"""
+        from mutant.modules.results_warehouse import warehouse_path
+
+        return {
+            "engine": self.engine,
+            "workers": self.workers,
+            "warehouse": warehouse_path(config_mutant, self.warehouse),
+            "json_format": self.json_format,
+            "streaming": self.streaming,
+            "variant_shards": self.variant_shards,
+            "consensus_qc": self.consensus_qc,
+        }
+
+
+def report_options(func):
+    """Adds the REPORT_OPTIONS to a command, which receives them as one
+    ReportSettings argument named settings"""
+
+    @functools.wraps(func)
+    def command(*args, **kwargs):
+        options = {name: kwargs.pop(name) for name in ReportSettings.__slots__}
+        return func(*args, settings=ReportSettings(**options), **kwargs)
+
+    for option in reversed(REPORT_OPTIONS):
+        command = option(command)
+    return command
+
 
 @click.group()
 @click.version_option(version)
+@click.option(
+    "--profile",
+    help="Profile the command (cProfile, tracemalloc and step timings), written to its results folder",
+    is_flag=True,
+)
 @click.pass_context
-def root(ctx):
+def root(ctx, profile):
     """Microbial Utility Toolbox And wrapper for data traNsmission and Transformation"""
     ctx.obj = {}
+    if profile:
+        from mutant.modules import profiling
+
+        ctx.call_on_close(profiling.start(" ".join(sys.argv[1:])).finish)
 
 
 @root.group()
@@ -50,15 +151,35 @@ def analyse(ctx):
     help="Execution profiles, comma-separated",
     default="singularity,slurm",
 )
+@click.option(
+    "--resume",
+    help="Reuse the work directory of the latest run of the same case and input",
+    is_flag=True,
+)
+@click.option("--status_file", help="Json file with the live progress of the run", default="")
+@report_options
 @click.pass_context
 def sarscov2(
-    ctx, input_folder, config_artic, config_case, config_mutant, outdir, profiles
+    ctx,
+    input_folder,
+    config_artic,
+    config_case,
+    config_mutant,
+    outdir,
+    profiles,
+    resume,
+    status_file,
+    settings,
 ):
+    from mutant.modules.case_model import load_case
+    from mutant.modules.profiling import set_output_dir
+    from mutant.modules.sarscov2_delivery import DeliverySC2
+    from mutant.modules.sarscov2_report import ReportSC2
+    from mutant.modules.sarscov2_start import RunSC2
 
     # Set base for output files (Move this section)
     if config_case != "":
-        caseinfo = get_json(config_case)
-        caseID = caseinfo[0]["case_ID"]
+        caseID = load_case(config_case).case
     else:
         caseID = "artic"
     prefix = "{}_{}".format(caseID, TIMESTAMP)
@@ -76,7 +197,13 @@ def sarscov2(
     )
 
     resdir = run.get_results_dir(config_mutant, outdir)
-    run.run_case(resdir)
+    set_output_dir(resdir)
+    previous = None
+    if resume:
+        previous = run.find_previous_run(resdir)
+        if previous is None:
+            log.warning("No previous run of {} with the same input found, starting over".format(caseID))
+    run.run_case(resdir, resume_from=previous, status_file=status_file)
 
     # Report
     if config_case != "":
@@ -86,6 +213,7 @@ def sarscov2(
             fastq_dir=os.path.abspath(input_folder),
             config_artic=config_artic,
             timestamp=TIMESTAMP,
+            **settings.report_kwargs(config_mutant)
         )
         report.create_all_files()
 
@@ -97,6 +225,75 @@ def sarscov2(
         )
 
         delivery.rename_deliverables()
+        if settings.verify_deliverables and delivery.verify_deliverables():
+            sys.exit(-1)
+
+
+@analyse.command("sarscov2-batch")
+@click.argument("manifest")
+@click.option(
+    "--config_artic",
+    help="Custom artic configuration file",
+    default="{}/config/hasta/artic.json".format(WD),
+)
+@click.option(
+    "--config_mutant",
+    help="General configuration file for MUTANT",
+    default="{}/config/hasta/mutant.json".format(WD),
+)
+@click.option(
+    "--profiles",
+    help="Execution profiles, comma-separated",
+    default="singularity,slurm",
+)
+@click.option("--max_concurrent", help="Nextflow runs launched at the same time", default=4, type=int)
+@click.option(
+    "--resume",
+    help="Reuse the work directory of the latest run of each case and input",
+    is_flag=True,
+)
+@click.option(
+    "--status_file",
+    help="Status/timing table of the batch",
+    default="batch_{}_status.tsv".format(TIMESTAMP),
+)
+@click.option(
+    "--live_status",
+    help="Write the live progress of each run to run_status.json in its results directory",
+    is_flag=True,
+)
+@report_options
+@click.pass_context
+def sarscov2_batch(
+    ctx,
+    manifest,
+    config_artic,
+    config_mutant,
+    profiles,
+    max_concurrent,
+    resume,
+    status_file,
+    live_status,
+    settings,
+):
+    """Analyses every (input_folder, config_case) pair of a json manifest"""
+    from mutant.modules.sarscov2_batch import BatchSC2
+
+    batch = BatchSC2(
+        manifest=manifest,
+        config_artic=config_artic,
+        config_mutant=config_mutant,
+        profiles=profiles,
+        max_concurrent=max_concurrent,
+        resume=resume,
+        live_status=live_status,
+        verify_deliverables=settings.verify_deliverables,
+        report_kwargs=settings.report_kwargs(config_mutant),
+    )
+    status = batch.run()
+    batch.write_status(status_file)
+    if any(record["postproc"] != "done" for record in status):
+        sys.exit(-1)
 
 
 @analyse.command()
@@ -126,9 +323,32 @@ def sarscov2(ctx):
 )
 @click.option("--fastq_folder", help="Sequence data folder for the case", required=True)
 @click.option("--config_case", help="Provided config for the case", required=True)
+@click.option("--force", help="Rebuild all reports, even those up to date with their inputs", is_flag=True)
+@click.option("--hash_inputs", help="Also compare input checksums when deciding what to rebuild", is_flag=True)
+@click.option(
+    "--config_mutant",
+    help="General configuration file for MUTANT",
+    default="{}/config/hasta/mutant.json".format(WD),
+)
+@report_options
 @click.pass_context
-def postproc(ctx, input_folder, config_artic, fastq_folder, config_case):
+def postproc(
+    ctx,
+    input_folder,
+    config_artic,
+    fastq_folder,
+    config_case,
+    force,
+    hash_inputs,
+    config_mutant,
+    settings,
+):
     """Applies all cg post-processing of the sarscov2 pipeline"""
+    from mutant.modules.profiling import set_output_dir
+    from mutant.modules.sarscov2_delivery import DeliverySC2
+    from mutant.modules.sarscov2_report import ReportSC2
+
+    set_output_dir(os.path.abspath(input_folder))
 
 
     # Reports
@@ -139,6 +359,9 @@ def postproc(ctx, input_folder, config_artic, fastq_folder, config_case):
             config_artic=config_artic,
             fastq_dir=os.path.abspath(fastq_folder),
             timestamp=TIMESTAMP,
+            force=force,
+            hash_inputs=hash_inputs,
+            **settings.report_kwargs(config_mutant)
         )
 
         report.create_all_files()
@@ -151,6 +374,8 @@ def postproc(ctx, input_folder, config_artic, fastq_folder, config_case):
         )
 
         delivery.rename_deliverables()
+        if settings.verify_deliverables and delivery.verify_deliverables():
+            sys.exit(-1)
 
 
 @sarscov2.command()
@@ -164,6 +389,10 @@ def postproc(ctx, input_folder, config_artic, fastq_folder, config_case):
 @click.pass_context
 def rename(ctx, input_folder, config_artic, config_case):
     """Renames sarcov2 pipeline output to CG standard"""
+    from mutant.modules.profiling import set_output_dir
+    from mutant.modules.sarscov2_delivery import DeliverySC2
+
+    set_output_dir(os.path.abspath(input_folder))
 
     # Delivery
     if config_case != "":
@@ -174,20 +403,145 @@ def rename(ctx, input_folder, config_artic, config_case):
         delivery.rename_deliverables()
 
 
+@sarscov2.command()
+@click.argument("input_folder")
+@click.option("--config_case", help="Provided config for the case, names the output after its ticket", default="")
+@click.option("--output", help="Output file, overrides the name derived from --config_case", default="")
+@click.option("--bgzip", help="Write block-gzip (BGZF) compressed output", is_flag=True)
+@click.option("--index", help="Write a .fai index (and .gzi with --bgzip) next to the output", is_flag=True)
+@click.pass_context
+def consensus(ctx, input_folder, config_case, output, bgzip, index):
+    """Concatenates the consensus sequences of a sarscov2 run in sample order"""
+    from mutant.modules.case_model import load_case
+    from mutant.modules.sarscov2_consensus import consensus_files, write_concat_consensus
+
+    indir = os.path.join(
+        os.path.abspath(input_folder), "ncovIllumina_sequenceAnalysis_makeConsensus"
+    )
+    if output == "":
+        if config_case == "":
+            click.echo("Either --config_case or --output has to be provided. Exiting..")
+            sys.exit(-1)
+        ticket = load_case(config_case).ticket
+        output = os.path.join(os.path.abspath(input_folder), "{}.consensus.fa".format(ticket))
+        if bgzip:
+            output = "{}.gz".format(output)
+
+    inputs = consensus_files(indir)
+    write_concat_consensus(inputs, output, bgzip=bgzip, index=index)
+    log.info("Wrote {} consensus sequences to {}".format(len(inputs), output))
+
+
+@sarscov2.command("consensus-qc")
+@click.argument("input_folder")
+@click.option("--output", help="Output csv, defaults to consensus_metrics.csv in the input folder", default="")
+@click.option("--workers", help="Processes computing the metrics", default=4, type=int)
+@click.pass_context
+def consensus_qc(ctx, input_folder, output, workers):
+    """Recomputes the QC metrics of the consensus sequences of a sarscov2 run,
+    and compares them to its qc.csv"""
+    import glob
+
+    from mutant.modules.consensus_qc import write_metrics
+
+    indir = os.path.abspath(input_folder)
+    if output == "":
+        output = os.path.join(indir, "consensus_metrics.csv")
+    hits = glob.glob(os.path.join(indir, "*qc.csv"))
+    hits = [hit for hit in hits if os.path.abspath(hit) != os.path.abspath(output)]
+    if not hits:
+        log.warning("No qc.csv found in {}, metrics are not cross-checked".format(indir))
+    samples, mismatched = write_metrics(
+        indir, output, qc_path=hits[0] if hits else "", workers=workers
+    )
+    log.info(
+        "Wrote metrics of {} consensus sequences to {}, {} disagree with qc.csv".format(
+            samples, output, mismatched
+        )
+    )
+
+
+@sarscov2.command()
+@click.argument("input_folder")
+@click.pass_context
+def profile(ctx, input_folder):
+    """Writes a performance summary of a sarscov2 run from its execution trace"""
+    from mutant.modules.trace_profiler import write_performance_report
+
+    if not write_performance_report(os.path.abspath(input_folder)):
+        click.echo("No execution trace found in {}/pipeline_info. Exiting..".format(input_folder))
+        sys.exit(-1)
+    log.info("Performance summary written to {}/pipeline_info".format(input_folder))
+
+
+@sarscov2.command()
+@click.option(
+    "--config_mutant",
+    help="General configuration file for MUTANT",
+    default="{}/config/hasta/mutant.json".format(WD),
+)
+@click.option("--warehouse", help="SQLite results warehouse, overrides the MUTANT configuration", default="")
+@click.option("--sample", help="Customer sample ID", default="")
+@click.option("--lineage", help="Pangolin lineage, may be a glob such as 'B.1.617.2*'", default="")
+@click.option("--voc", help="VOC class, e.g. VOC or VOI", default="")
+@click.option("--region", help="Region code", default="")
+@click.option("--since", help="First sequencing date, e.g. 2021-04-01", default="")
+@click.option("--until", help="Last sequencing date, e.g. 2021-06-30", default="")
+@click.option("--full", help="Include all result data of the samples (json output only)", is_flag=True)
+@click.option("--output_format", help="Output format", type=click.Choice(["csv", "json"]), default="csv")
+@click.pass_context
+def query(ctx, config_mutant, warehouse, sample, lineage, voc, region, since, until, full, output_format):
+    """Queries the sarscov2 results warehouse of all runs"""
+    import csv
+    import json
+
+    from mutant.modules.results_warehouse import COLUMNS, ResultsWarehouse, warehouse_path
+
+    path = warehouse_path(config_mutant, warehouse)
+    if path == "" or not os.path.exists(path):
+        click.echo("Could not find results warehouse '{}'. Exiting..".format(path))
+        sys.exit(-1)
+    with ResultsWarehouse(path) as results:
+        hits = results.query(
+            sample=sample,
+            lineage=lineage,
+            voc=voc,
+            region=region,
+            since=since,
+            until=until,
+            full=full and output_format == "json",
+        )
+    if output_format == "json":
+        json.dump(hits, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        writer = csv.DictWriter(sys.stdout, fieldnames=COLUMNS, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(hits)
+    log.info("{} samples found".format(len(hits)))
+
+
 @toolbox.command()
 @click.option("--input_folder", help="Folder with fastq to concatenate", required=True)
 @click.option("--app_tag", help="Application tag", required=False, default="CONCATENATE")
 @click.option("--date", help="Date to add to the concatenated file name, e.g. order date", required=False, default=None)
+@click.option("--threads", help="Sample folders/read directions to concatenate in parallel", required=False, default=min(8, os.cpu_count() or 1), type=int)
+@click.option("--verify", help="Verify gzip integrity, count reads and write an integrity manifest per sample", is_flag=True)
 @click.pass_context
-def concatenate(ctx, input_folder, app_tag, date):
+def concatenate(ctx, input_folder, app_tag, date, threads, verify):
     """ Concatenates fastq files if needed """
     if date:
-        cmd = "python {0}/standalone/concatenate.py --input_folder {1} --app_tag {2} --date {3}".format(WD, input_folder, app_tag, date)
+        cmd = "python {0}/standalone/concatenate.py --input_folder {1} --app_tag {2} --threads {3} --date {4}".format(WD, input_folder, app_tag, threads, date)
     else:
-        cmd = "python {0}/standalone/concatenate.py --input_folder {1} --app_tag {2}".format(WD, input_folder, app_tag)
+        cmd = "python {0}/standalone/concatenate.py --input_folder {1} --app_tag {2} --threads {3}".format(WD, input_folder, app_tag, threads)
+    if verify:
+        cmd = cmd + " --verify"
     log.debug("Command ran: {}".format(cmd))
     proc = subprocess.Popen(cmd.split())
     out, err = proc.communicate()
+    # Failed integrity checks of --verify exit non-zero
+    if proc.returncode:
+        sys.exit(proc.returncode)
 
 
 @toolbox.command()
@@ -0,0 +1,95 @@
+""" JSON Lines variant of the artic json: one {sample: data} object per line,
+    written as samples are produced. An optional sidecar index holds the byte
+    offset and length of every sample, so that loaders can seek to single
+    samples instead of parsing the whole file.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import json
+import os
+
+
+def index_path(path):
+    return "{}.idx".format(path)
+
+
+class JsonlWriter:
+    """Writes samples, and their index entries as they go, to temporary files
+    that are renamed into place on close"""
+
+    def __init__(self, path, index=True):
+        self.path = path
+        self.tmpfile = "{}.{}.tmp".format(path, os.getpid())
+        self.index_tmpfile = "{}.{}.tmp".format(index_path(path), os.getpid()) if index else None
+        self.out = open(self.tmpfile, "wb")
+        self.index = open(self.index_tmpfile, "w") if index else None
+        self.offset = 0
+
+    def write(self, sample, data):
+        line = (json.dumps({sample: data}) + "\n").encode()
+        self.out.write(line)
+        if self.index is not None:
+            self.index.write("{}\t{}\t{}\n".format(sample, self.offset, len(line)))
+        self.offset += len(line)
+
+    def close(self):
+        self.out.close()
+        os.replace(self.tmpfile, self.path)
+        if self.index is not None:
+            self.index.close()
+            os.replace(self.index_tmpfile, index_path(self.path))
+
+    def abort(self):
+        self.out.close()
+        os.remove(self.tmpfile)
+        if self.index is not None:
+            self.index.close()
+            os.remove(self.index_tmpfile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def iter_jsonl(path):
+    """Streams (sample, data) pairs of a JSON Lines artic file"""
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                for sample, data in record.items():
+                    yield sample, data
+
+
+def read_index(path):
+    """Sample -> (offset, length) of the sidecar index of path"""
+    index = dict()
+    with open(index_path(path)) as f:
+        for line in f:
+            sample, offset, length = line.rstrip("\n").split("\t")
+            index[sample] = (int(offset), int(length))
+    return index
+
+
+def load_samples(path, samples):
+    """Data of the given samples, seeking through the index when there is one.
+    Samples that are not in the file are left out"""
+    wanted = set(samples)
+    if not os.path.exists(index_path(path)):
+        return {sample: data for sample, data in iter_jsonl(path) if sample in wanted}
+    index = read_index(path)
+    found = dict()
+    with open(path, "rb") as f:
+        for sample in samples:
+            if sample not in index:
+                continue
+            offset, length = index[sample]
+            f.seek(offset)
+            found.update(json.loads(f.read(length)))
+    return found
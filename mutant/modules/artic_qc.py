@@ -0,0 +1,30 @@
+""" Reading of the artic qc.csv, shared by every parser of the results. Columns
+    are taken from their position in the artic output
+    (sample_name,pct_N_bases,pct_covered_bases,longest_no_N_run,
+    num_aligned_reads,fasta,bam,qc_pass), like the other artic reports.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+# Position of every reported qc.csv column, in report order
+QC_COLUMNS = {
+    "pct_n_bases": 1,
+    "pct_10X_bases": 2,
+    "longest_no_N_run": 3,
+    "num_aligned_reads": 4,
+    "artic_qc": 7,
+}
+# Samples with a larger share of covered bases pass QC
+MIN_PCT_COVERED = 95
+
+
+def qc_sample(line):
+    """Customer sample ID of a qc.csv row"""
+    return line[0].split("_")[-1]
+
+
+def qc_values(line):
+    """Reported values of a qc.csv row"""
+    data = {key: line[position] for key, position in QC_COLUMNS.items()}
+    data["qc"] = "TRUE" if float(data["pct_10X_bases"]) > MIN_PCT_COVERED else "FALSE"
+    return data
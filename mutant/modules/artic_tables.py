@@ -0,0 +1,97 @@
+""" Vectorized ingestion of the artic result tables (qc, pangolin and
+    variant summary). Produces the same per sample data as the line by line
+    parser of ReportSC2.load_artic_results, but parses the tables as typed
+    pandas columns.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import os
+
+import numpy
+import pandas
+
+from mutant.modules.artic_qc import MIN_PCT_COVERED, QC_COLUMNS
+
+
+def read_table(path, columns):
+    """Reads the given column positions of a csv as untouched strings"""
+    return pandas.read_csv(
+        path,
+        sep=",",
+        usecols=columns,
+        dtype=str,
+        keep_default_na=False,
+        na_filter=False,
+    )
+
+
+def last_per_sample(frame):
+    """Keeps the last row of every sample, ordered by the sample's first occurrence"""
+    first_seen = frame["sample"].drop_duplicates(keep="first")
+    return frame.drop_duplicates("sample", keep="last").set_index("sample").loc[first_seen]
+
+
+def load_artic_tables(qc_path, variant_path, pangolin_rows, variant_index):
+    """Returns artic_data (per sample dictionaries, without VOC classification)
+    and the variants of interest per sample. Pangolin results are given as
+    the data rows of the merged pangolin csv, variant_index decides which
+    variants are of interest"""
+
+    # QC report
+    qc = read_table(qc_path, [0] + list(QC_COLUMNS.values()))
+    qc.columns = ["sample_name"] + list(QC_COLUMNS)
+    qc["sample"] = qc["sample_name"].str.split("_").str[-1]
+    qc["qc"] = numpy.where(qc["pct_10X_bases"].astype(float) > MIN_PCT_COVERED, "TRUE", "FALSE")
+    qc = last_per_sample(qc)
+    qc_columns = list(QC_COLUMNS) + ["qc"]
+    artic_data = {
+        sample: dict(zip(qc_columns, values))
+        for sample, values in zip(qc.index, qc[qc_columns].itertuples(index=False, name=None))
+    }
+
+    # Pangolin report
+    pangolin = pandas.DataFrame(
+        [row[:5] for row in pangolin_rows], columns=range(5), dtype=str
+    )
+    pangolin.columns = ["taxon", "lineage", "pangolin_probability", "pangoLEARN_version", "pangolin_qc"]
+    pangolin["sample"] = pangolin["taxon"].str.split(".").str[0].str.split("_").str[-1]
+    pangolin = last_per_sample(pangolin)
+    pangolin_columns = ["lineage", "pangolin_probability", "pangoLEARN_version", "pangolin_qc"]
+    for sample, values in zip(pangolin.index, pangolin[pangolin_columns].itertuples(index=False, name=None)):
+        artic_data[sample].update(zip(pangolin_columns, values))
+
+    # Variant report
+    var_all = dict()
+    var_voc = dict()
+    if os.stat(variant_path).st_size != 0:
+        variants = read_table(variant_path, [0, 1, 2])
+        variants.columns = ["sample_name", "gene", "variant"]
+        variants["sample"] = variants["sample_name"].str.split("_").str[-1]
+        # Every distinct (gene, variant) is looked up once
+        distinct = variants[["gene", "variant"]].drop_duplicates()
+        of_interest = pandas.MultiIndex.from_tuples(
+            [
+                pair
+                for pair in zip(distinct["gene"], distinct["variant"])
+                if variant_index.matches(*pair)
+            ],
+            names=["gene", "variant"],
+        )
+        variants["voc"] = pandas.MultiIndex.from_frame(variants[["gene", "variant"]]).isin(of_interest)
+        grouped = variants.groupby("sample", sort=False)["variant"]
+        var_all = grouped.agg(list).to_dict()
+        var_voc = variants[variants["voc"]].groupby("sample", sort=False)["variant"].agg(list).to_dict()
+
+    for sample, data in artic_data.items():
+        data["VOC_aa"] = ";".join(var_voc[sample]) if sample in var_voc else "-"
+    if var_all:
+        for sample, data in artic_data.items():
+            if sample not in var_all:
+                data["variants"] = "-"
+            elif len(var_all[sample]) > 1:
+                data["variants"] = ";".join(var_all[sample])
+            else:
+                data["variants"] = var_all[sample]
+
+    return artic_data, var_voc
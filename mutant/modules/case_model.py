@@ -0,0 +1,117 @@
+""" Case config (sample info from StatusDB) of a sarscov2 case. The json is
+    read and normalised once per process, into compact sample records with
+    lookups by customer sample ID, CG sample ID and region-lab.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import os
+
+from mutant.modules.generic_parser import get_sarscov2_config
+
+_cases = dict()
+# Field name -> position, shared by all records with the same keys
+_layouts = dict()
+
+
+class SampleRecord:
+    """One sample of the case config. Read-only, with the dict interface of the
+    original json record (record["lab_code"], keys(), items()...)"""
+
+    __slots__ = ("layout", "values")
+
+    def __init__(self, entry):
+        keys = tuple(entry.keys())
+        self.layout = _layouts.setdefault(keys, {key: pos for pos, key in enumerate(keys)})
+        self.values = tuple(entry.values())
+
+    def __getitem__(self, key):
+        return self.values[self.layout[key]]
+
+    def get(self, key, default=None):
+        pos = self.layout.get(key)
+        return default if pos is None else self.values[pos]
+
+    def __contains__(self, key):
+        return key in self.layout
+
+    def __iter__(self):
+        return iter(self.layout)
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        return self.layout.keys()
+
+    def items(self):
+        return zip(self.layout, self.values)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    @property
+    def regionlab(self):
+        return "{}_{}".format(self["region_code"], self["lab_code"])
+
+    @property
+    def base_sample(self):
+        """Sample name used for the pipeline output files"""
+        return "{}_{}_{}".format(self["region_code"], self["lab_code"], self["Customer_ID_sample"])
+
+
+class CaseInfo:
+    """Sample records of a case in config order, indexed by sample IDs and region-lab"""
+
+    __slots__ = ("path", "records", "by_customer_id", "by_cg_id", "by_regionlab")
+
+    def __init__(self, path, entries):
+        """entries: the sample entries of get_sarscov2_config"""
+        self.path = path
+        self.records = [SampleRecord(entry) for entry in entries]
+        self.by_customer_id = dict()
+        self.by_cg_id = dict()
+        # Region-labs in order of first appearance
+        self.by_regionlab = dict()
+        for record in self.records:
+            self.by_customer_id[record["Customer_ID_sample"]] = record
+            self.by_cg_id[record["CG_ID_sample"]] = record
+            self.by_regionlab.setdefault(record.regionlab, []).append(record)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    @property
+    def case(self):
+        return self.records[0]["case_ID"]
+
+    @property
+    def ticket(self):
+        return self.records[0]["Customer_ID_project"]
+
+    @property
+    def regionlabs(self):
+        return list(self.by_regionlab)
+
+    def sample(self, customer_id):
+        """Record of a customer sample ID, or None"""
+        return self.by_customer_id.get(customer_id)
+
+
+def load_case(path):
+    """Returns the CaseInfo of a case config. Memoised per process, keyed by the
+    file's mtime and size so that an edited config is read again"""
+    key = (os.path.abspath(path),)
+    if os.path.exists(path):
+        stat = os.stat(path)
+        key += (stat.st_mtime_ns, stat.st_size)
+    if key not in _cases:
+        # get_sarscov2_config exits on missing or unreadable files
+        _cases[key] = CaseInfo(path, get_sarscov2_config(path))
+    return _cases[key]
@@ -0,0 +1,195 @@
+""" QC metrics recomputed from the consensus FASTA files instead of taken from
+    the artic qc.csv: length, %N, longest run without N, ambiguity code counts
+    and the N run intervals. Every sequence is read into a numpy byte array and
+    measured with vectorized operations, samples are spread over a process
+    pool, and the results are cross-checked against qc.csv.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from mutant.modules.artic_qc import QC_COLUMNS, qc_sample
+from mutant.modules.sarscov2_consensus import consensus_files
+
+# IUPAC nucleotide codes other than A, C, G, T and N
+AMBIGUITY_CODES = "RYKMSWBDHV"
+# qc.csv values are rounded, and implementations count runs ending at the
+# sequence ends differently
+PCT_TOLERANCE = 0.01
+RUN_TOLERANCE = 1
+# Files per task sent to a worker process
+TASK_CHUNK = 64
+# Fewer files are measured in this process: a file takes well under a
+# millisecond, a spawned worker a fifth of a second to start
+POOL_MIN_FILES = 1000
+# Keys added to the articdata of a sample
+CONSENSUS_KEYS = [
+    "consensus_length",
+    "consensus_pct_n_bases",
+    "consensus_longest_no_N_run",
+    "consensus_ambiguous_bases",
+    "consensus_n_runs",
+    "consensus_qc_mismatch",
+]
+METRICS_HEADER = [
+    "sample",
+    "length",
+    "pct_n_bases",
+    "longest_no_N_run",
+    "ambiguous_bases",
+    "n_runs",
+    "qc_pct_n_bases",
+    "qc_longest_no_N_run",
+    "mismatch",
+]
+
+
+def consensus_sample(path):
+    """Customer sample ID of a consensus file"""
+    return os.path.basename(path).split(".")[0].split("_")[-1]
+
+
+def read_sequence(path):
+    """First sequence of a FASTA file as an array of uppercase ASCII codes"""
+    raw = numpy.fromfile(path, dtype=numpy.uint8)
+    if raw.size and raw[0] == ord(">"):
+        newlines = numpy.flatnonzero(raw == ord("\n"))
+        raw = raw[newlines[0] + 1 :] if newlines.size else raw[:0]
+    headers = numpy.flatnonzero(raw == ord(">"))
+    if headers.size:
+        raw = raw[: headers[0]]
+    # Drops line breaks and other whitespace, and clears the lowercase bit
+    return raw[raw > ord(" ")] & 0xDF
+
+
+def sequence_metrics(sequence):
+    """Metrics of a sequence from read_sequence. N runs are 1-based, inclusive"""
+    length = int(sequence.size)
+    is_n = sequence == ord("N")
+    n_bases = int(numpy.count_nonzero(is_n))
+    edges = numpy.diff(is_n.view(numpy.int8), prepend=0, append=0)
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)
+    # Runs without N lie before, between and after the N runs
+    no_n_runs = numpy.concatenate((starts, [length])) - numpy.concatenate(([0], ends))
+    counts = numpy.bincount(sequence, minlength=256)
+    return {
+        "length": length,
+        "pct_n_bases": n_bases / length * 100 if length else 100.0,
+        "longest_no_N_run": int(no_n_runs.max()),
+        "ambiguous_bases": {
+            code: int(counts[ord(code)]) for code in AMBIGUITY_CODES if counts[ord(code)]
+        },
+        "n_runs": [[int(start) + 1, int(end)] for start, end in zip(starts, ends)],
+    }
+
+
+def file_metrics(path):
+    return consensus_sample(path), sequence_metrics(read_sequence(path))
+
+
+def consensus_metrics(paths, workers=4):
+    """(sample, metrics) of consensus files, in the order of paths. Computed in
+    workers processes (at most one per CPU), or in this process for few files"""
+    workers = min(workers, os.cpu_count() or 1)
+    if workers <= 1 or len(paths) < POOL_MIN_FILES:
+        for path in paths:
+            yield file_metrics(path)
+        return
+    # Spawned workers, as the report stages run in threads of this process
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        yield from pool.map(file_metrics, paths, chunksize=TASK_CHUNK)
+
+
+def cross_check(data, metrics):
+    """Fields of the qc.csv data of a sample that disagree with its metrics"""
+    mismatches = []
+    try:
+        if abs(float(data["pct_n_bases"]) - metrics["pct_n_bases"]) > PCT_TOLERANCE:
+            mismatches.append("pct_n_bases")
+    except (KeyError, ValueError):
+        pass
+    try:
+        if abs(int(float(data["longest_no_N_run"])) - metrics["longest_no_N_run"]) > RUN_TOLERANCE:
+            mismatches.append("longest_no_N_run")
+    except (KeyError, ValueError):
+        pass
+    return mismatches
+
+
+def merge_metrics(data, metrics):
+    """Adds the consensus metrics of a sample to its articdata. Samples without
+    a consensus get '-'"""
+    if metrics is None:
+        data.update(dict(zip(CONSENSUS_KEYS, "-" * len(CONSENSUS_KEYS))))
+        return
+    data.update(
+        {
+            "consensus_length": metrics["length"],
+            "consensus_pct_n_bases": round(metrics["pct_n_bases"], 4),
+            "consensus_longest_no_N_run": metrics["longest_no_N_run"],
+            "consensus_ambiguous_bases": metrics["ambiguous_bases"],
+            "consensus_n_runs": metrics["n_runs"],
+            "consensus_qc_mismatch": ";".join(cross_check(data, metrics)) or "-",
+        }
+    )
+
+
+def read_qc(path):
+    """Sample -> qc.csv values that can be recomputed from the consensus"""
+    qc = dict()
+    with open(path, newline="") as f:
+        content = csv.reader(f)
+        next(content, None)
+        for line in content:
+            if line:
+                qc[qc_sample(line)] = {
+                    "pct_n_bases": line[QC_COLUMNS["pct_n_bases"]],
+                    "longest_no_N_run": line[QC_COLUMNS["longest_no_N_run"]],
+                }
+    return qc
+
+
+def write_metrics(indir, output, qc_path="", workers=4):
+    """Writes the consensus metrics of a results directory, next to the qc.csv
+    values when given. Returns the number of samples and of mismatches"""
+    qc = read_qc(qc_path) if qc_path else dict()
+    paths = consensus_files(os.path.join(indir, "ncovIllumina_sequenceAnalysis_makeConsensus"))
+    samples = 0
+    mismatched = 0
+    with open(output, "w", newline="") as out:
+        table = csv.writer(out)
+        table.writerow(METRICS_HEADER)
+        for sample, metrics in consensus_metrics(paths, workers):
+            values = qc.get(sample, dict())
+            mismatches = cross_check(values, metrics)
+            samples += 1
+            mismatched += bool(mismatches)
+            table.writerow(
+                [
+                    sample,
+                    metrics["length"],
+                    round(metrics["pct_n_bases"], 4),
+                    metrics["longest_no_N_run"],
+                    ";".join(
+                        "{}:{}".format(code, count)
+                        for code, count in metrics["ambiguous_bases"].items()
+                    )
+                    or "-",
+                    ";".join("{}-{}".format(start, end) for start, end in metrics["n_runs"])
+                    or "-",
+                    values.get("pct_n_bases", "-"),
+                    values.get("longest_no_N_run", "-"),
+                    ";".join(mismatches) or "-",
+                ]
+            )
+    return samples, mismatched
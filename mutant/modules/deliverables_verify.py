@@ -0,0 +1,99 @@
+""" Verifies the files listed in a deliverables yaml before they are handed
+    over: every path is checked for existence, and its size and checksum are
+    computed in a thread pool (hashlib releases the GIL on large reads) and
+    recorded next to the path in the yaml.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import hashlib
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mutant import log
+
+HASH_BUFFER = 8 * 1024 * 1024
+
+
+def yaml_dumper():
+    """C-accelerated yaml dumper when libyaml is available"""
+    import yaml
+
+    return getattr(yaml, "CDumper", yaml.Dumper)
+
+
+def yaml_loader():
+    import yaml
+
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def write_deliverables(deliv, delivfile):
+    """Writes a deliverables yaml, through a temporary file renamed into place"""
+    import yaml
+
+    tmpfile = "{}.{}.tmp".format(delivfile, os.getpid())
+    with open(tmpfile, "w") as out:
+        yaml.dump(deliv, out, Dumper=yaml_dumper())
+    os.replace(tmpfile, delivfile)
+
+
+def file_checksum(path, algorithm="md5"):
+    """(size, hexdigest) of a file, read with a large buffer"""
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(HASH_BUFFER)
+    view = memoryview(buffer)
+    size = 0
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+            size += read
+    return size, digest.hexdigest()
+
+
+def verify_deliverables(delivfile, threads=8, algorithm="md5"):
+    """Adds size and checksum to every entry of the deliverables yaml.
+    Returns the listed paths that do not exist"""
+    import yaml
+
+    with open(delivfile) as f:
+        deliv = yaml.load(f, Loader=yaml_loader())
+
+    paths = dict()
+    missing = []
+    for entry in deliv["files"]:
+        path = entry["path"]
+        if path in paths or path in missing:
+            continue
+        try:
+            paths[path] = os.stat(path).st_size
+        except OSError:
+            missing.append(path)
+
+    # Largest files first, so that the last one to finish is a small one
+    ordered = sorted(paths, key=paths.get, reverse=True)
+    checksums = dict()
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        for path, result in zip(ordered, pool.map(lambda path: file_checksum(path, algorithm), ordered)):
+            checksums[path] = result
+
+    for entry in deliv["files"]:
+        if entry["path"] in checksums:
+            size, digest = checksums[entry["path"]]
+            entry["size"] = size
+            entry["checksum"] = "{}:{}".format(algorithm, digest)
+
+    write_deliverables(deliv, delivfile)
+
+    for path in missing:
+        log.error("Deliverable {} does not exist".format(path))
+    log.info(
+        "Verified {} deliverables ({:.1f} GB), {} missing".format(
+            len(checksums), sum(size for size, _ in checksums.values()) / 1024 ** 3, len(missing)
+        )
+    )
+    return missing
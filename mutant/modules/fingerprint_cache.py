@@ -0,0 +1,92 @@
+""" Keeps track of the inputs that generated each output of a stage, so that
+    reruns can skip stages whose inputs, outputs and settings are unchanged.
+    The cache is a json file stored in the results directory.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import hashlib
+import json
+import os
+
+from mutant import log
+
+CACHE_FILE = ".mutant_fingerprints.json"
+HASH_BUFFER = 4 * 1024 * 1024
+
+
+class FingerprintCache:
+    def __init__(self, indir, settings, hash_inputs=False):
+        """settings: json serialisable description of code version and configuration.
+        Changing it invalidates every stage. None keeps the settings of the
+        existing cache, to update it outside of a run"""
+        self.path = os.path.join(indir, CACHE_FILE)
+        self.settings = settings
+        self.hash_inputs = hash_inputs
+        self.stages = dict()
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+            if settings is None:
+                self.settings = content.get("settings")
+            if content.get("settings") == self.settings:
+                self.stages = content.get("stages", dict())
+        except (OSError, ValueError):
+            pass
+
+    def fingerprint(self, path, digest=False):
+        """[size, mtime] of a file, plus its md5 if requested. None if missing"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+        if digest:
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_BUFFER), b""):
+                    md5.update(chunk)
+            fingerprint.append(md5.hexdigest())
+        return fingerprint
+
+    def snapshot(self, inputs):
+        return {str(path): self.fingerprint(path, self.hash_inputs) for path in inputs}
+
+    def is_fresh(self, name, inputs, outputs):
+        """True if the stage was recorded with the same input snapshot and its outputs are untouched"""
+        recorded = self.stages.get(name)
+        if recorded is None or not outputs:
+            return False
+        if recorded["inputs"] != self.snapshot(inputs):
+            return False
+        current = {str(path): self.fingerprint(path) for path in outputs}
+        return None not in current.values() and recorded["outputs"] == current
+
+    def record(self, name, inputs_snapshot, outputs):
+        self.stages[name] = {
+            "inputs": inputs_snapshot,
+            "outputs": {str(path): self.fingerprint(path) for path in outputs},
+        }
+
+    def update_outputs(self, name, before, outputs):
+        """Records the outputs of a stage again after they were rewritten in
+        place. before: fingerprints of the outputs prior to the rewrite, which
+        must be the recorded ones so that stale outputs are not made fresh.
+        Returns True if the stage was updated"""
+        recorded = self.stages.get(name)
+        if recorded is None or recorded["outputs"] != before:
+            return False
+        recorded["outputs"] = {str(path): self.fingerprint(path) for path in outputs}
+        return True
+
+    def forget(self, name):
+        self.stages.pop(name, None)
+
+    def save(self):
+        tmpfile = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmpfile, "w") as out:
+                json.dump({"settings": self.settings, "stages": self.stages}, out, indent=1)
+            os.replace(tmpfile, self.path)
+        except OSError as e:
+            log.warning("Unable to save fingerprint cache {} ({})".format(self.path, e))
@@ -0,0 +1,126 @@
+""" Writes csv rows split over one output file per partition (e.g. one per
+    region-lab). Rows are grouped in memory and every file is opened once,
+    written buffered to a temporary file and renamed into place, so readers
+    never see a partially written file. In stream mode rows go straight to the
+    temporary file of their partition instead of being grouped in memory.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import os
+
+WRITE_BUFFER = 1024 * 1024
+# Per partition in stream mode, where every partition stays open
+STREAM_BUFFER = 8192
+
+
+class Route:
+    """File-like target that passes writes on to the file it points at, so that
+    a single csv writer serves every partition"""
+
+    __slots__ = ("out",)
+
+    def __init__(self):
+        self.out = None
+
+    def write(self, text):
+        return self.out.write(text)
+
+
+class PartitionedWriter:
+    def __init__(self, path_of, header="", stream=False, max_open=None, **fmtparams):
+        """path_of: function returning the output path of a partition.
+        header: text written as is at the top of every file.
+        stream: write rows as they are added, to a temporary file per partition.
+        max_open: in stream mode, the number of files kept open. The least
+        recently written file is closed and reopened when needed.
+        fmtparams: passed on to csv.writer"""
+        self.path_of = path_of
+        self.header = header
+        self.stream = stream
+        self.max_open = max_open
+        self.fmtparams = fmtparams
+        self.partitions = dict()
+        # Stream mode: partition -> temporary file, and the open ones, least
+        # recently written first. csv writers hold a sizeable record buffer
+        # each, so one writer is routed between the files
+        self.tmpfiles = dict()
+        self.files = dict()
+        self.route = Route()
+        self.writer = csv.writer(self.route, **fmtparams)
+
+    def add_partition(self, partition):
+        """Makes sure the partition is written, even without rows"""
+        if self.stream:
+            return self.open_partition(partition)
+        return self.partitions.setdefault(partition, [])
+
+    def open_partition(self, partition):
+        out = self.files.pop(partition, None)
+        if out is None:
+            tmpfile = self.tmpfiles.get(partition)
+            if tmpfile is None:
+                tmpfile = "{}.{}.tmp".format(self.path_of(partition), os.getpid())
+                self.tmpfiles[partition] = tmpfile
+                out = open(tmpfile, "w", buffering=STREAM_BUFFER)
+                out.write(self.header)
+            else:
+                out = open(tmpfile, "a", buffering=STREAM_BUFFER)
+            if self.max_open is not None and len(self.files) >= self.max_open:
+                self.files.pop(next(iter(self.files))).close()
+        self.files[partition] = out
+        return out
+
+    def add(self, partition, row):
+        if self.stream:
+            self.route.out = self.open_partition(partition)
+            self.writer.writerow(row)
+        else:
+            self.add_partition(partition).append(row)
+
+    def abort(self):
+        """Removes the temporary files of stream mode"""
+        for out in self.files.values():
+            out.close()
+        for tmpfile in self.tmpfiles.values():
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+        self.files.clear()
+        self.tmpfiles.clear()
+
+    def write(self):
+        """Writes all partitions. Returns the written paths"""
+        if self.stream:
+            return self.close_partitions()
+        paths = []
+        for partition, rows in self.partitions.items():
+            path = self.path_of(partition)
+            tmpfile = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                with open(tmpfile, "w", buffering=WRITE_BUFFER) as out:
+                    out.write(self.header)
+                    csv.writer(out, **self.fmtparams).writerows(rows)
+                os.replace(tmpfile, path)
+            except BaseException:
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+                raise
+            paths.append(path)
+        return paths
+
+    def close_partitions(self):
+        paths = []
+        try:
+            for out in self.files.values():
+                out.close()
+            self.files.clear()
+            for partition, tmpfile in self.tmpfiles.items():
+                path = self.path_of(partition)
+                os.replace(tmpfile, path)
+                paths.append(path)
+        except BaseException:
+            self.abort()
+            raise
+        self.tmpfiles.clear()
+        return paths
@@ -0,0 +1,148 @@
+""" Profiling of a whole mutant command, enabled with the global --profile
+    option. cProfile runs in the main thread and in every thread started
+    afterwards, tracemalloc follows allocations, and the run/postproc/rename
+    steps record their wall time. Results are written next to the results of
+    the command. Without --profile the hooks below return right away.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import functools
+import json
+import os
+import time
+
+from mutant import log, TIMESTAMP
+
+_profiler = None
+
+
+class Profiler:
+    def __init__(self, command):
+        import cProfile
+        import threading
+        import tracemalloc
+
+        self.command = command
+        self.output_dir = os.getcwd()
+        self.stages = dict()
+        self.peak_snapshot = None
+        self.peak_current = 0
+        self.start = time.perf_counter()
+        self.thread_profiles = []
+
+        def profile_thread(*args):
+            # Replaces itself with a profiler of the new thread
+            profile = cProfile.Profile()
+            self.thread_profiles.append(profile)
+            profile.enable()
+
+        tracemalloc.start(25)
+        threading.setprofile(profile_thread)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def record(self, name, seconds):
+        self.stages[name] = round(self.stages.get(name, 0) + seconds, 4)
+
+    def checkpoint(self):
+        """Keeps the allocation snapshot taken at the highest traced memory"""
+        import tracemalloc
+
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.peak_current:
+            self.peak_current = current
+            self.peak_snapshot = tracemalloc.take_snapshot()
+
+    def finish(self):
+        import io
+        import pstats
+        import threading
+        import tracemalloc
+
+        self.profile.disable()
+        threading.setprofile(None)
+        self.checkpoint()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = pstats.Stats(self.profile)
+        for profile in self.thread_profiles:
+            stats.add(profile)
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, "mutant_profile_{}".format(TIMESTAMP))
+        stats.dump_stats("{}.pstats".format(prefix))
+
+        report = io.StringIO()
+        report.write("Command: mutant {}\n".format(self.command))
+        report.write(
+            "Wall time: {:.2f}s, peak traced memory: {:.1f} MB\n\n".format(
+                time.perf_counter() - self.start, peak / 1024 ** 2
+            )
+        )
+        report.write("Stages:\n")
+        for name, seconds in self.stages.items():
+            report.write("  {:<40} {:>10.3f}s\n".format(name, seconds))
+        for sort in ("cumulative", "tottime"):
+            report.write("\nHot functions by {}:\n".format(sort))
+            stats.stream = report
+            stats.sort_stats(sort).print_stats(30)
+        if self.peak_snapshot is not None:
+            report.write("\nAllocation sites at peak memory:\n")
+            for stat in self.peak_snapshot.statistics("lineno")[:25]:
+                report.write("  {}\n".format(stat))
+        with open("{}.txt".format(prefix), "w") as out:
+            out.write(report.getvalue())
+
+        with open("{}.json".format(prefix), "w") as out:
+            json.dump(
+                {
+                    "command": self.command,
+                    "wall_s": round(time.perf_counter() - self.start, 3),
+                    "peak_traced_bytes": peak,
+                    "stages": self.stages,
+                },
+                out,
+                indent=2,
+            )
+        log.info("Profile written to {}.txt/.json/.pstats".format(prefix))
+
+
+def start(command):
+    global _profiler
+    _profiler = Profiler(command)
+    return _profiler
+
+
+def set_output_dir(path):
+    """Folder the profile is written to, defaults to the working directory"""
+    if _profiler is not None:
+        _profiler.output_dir = path
+
+
+def record_timings(prefix, timings):
+    """Adds timings measured elsewhere, e.g. the report stages"""
+    if _profiler is None:
+        return
+    for name, seconds in timings.items():
+        _profiler.record("{}/{}".format(prefix, name), seconds)
+
+
+def profiled(name):
+    """Records the wall time of the decorated function as stage name"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _profiler.record(name, time.perf_counter() - start)
+                _profiler.checkpoint()
+
+        return wrapper
+
+    return decorator
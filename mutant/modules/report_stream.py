@@ -0,0 +1,219 @@
+""" Constant memory ingestion of the sarscov2 results. The qc, pangolin and
+    variant reports and the case config are each read as a stream ordered on
+    sample ID (sorted in chunks spilled to disk when needed) and merge-joined
+    one sample at a time. The report writers consume the joined samples as they
+    are produced, so memory is bounded by a sample and a sort chunk rather than
+    by the size of the case.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import heapq
+import itertools
+import json
+import os
+import tempfile
+
+from mutant.modules.artic_qc import qc_values
+from mutant.modules.sarscov2_pangolin import pangolin_sample
+
+# Rows sorted in memory before spilling to a temporary file
+SORT_CHUNK = 20000
+
+
+def report_sample(line):
+    """Customer sample ID of a qc or variant report row"""
+    return line[0].split("_")[-1]
+
+
+def pangolin_row_sample(line):
+    return pangolin_sample(line[0])
+
+
+def read_rows(path):
+    """Data rows of a csv report. Empty files have no rows"""
+    if os.stat(path).st_size == 0:
+        return
+    with open(path, newline="") as f:
+        content = csv.reader(f)
+        next(content, None)
+        for line in content:
+            if line:
+                yield line
+
+
+def sorted_rows(rows, key, chunk_size=SORT_CHUNK):
+    """Rows ordered on key, keeping the input order of equal keys. Inputs of
+    more than chunk_size rows are sorted in chunks on disk and merged"""
+    rows = iter(rows)
+    chunk = sorted(itertools.islice(rows, chunk_size), key=key)
+    if len(chunk) < chunk_size:
+        yield from chunk
+        return
+    spills = []
+    try:
+        while chunk:
+            spill = tempfile.TemporaryFile(mode="w+", newline="")
+            spills.append(spill)
+            csv.writer(spill).writerows(chunk)
+            spill.seek(0)
+            chunk = sorted(itertools.islice(rows, chunk_size), key=key)
+        # Ties go to the earlier chunk, so the merge is stable
+        yield from heapq.merge(*[csv.reader(spill) for spill in spills], key=key)
+    finally:
+        for spill in spills:
+            spill.close()
+
+
+def in_order(rows, key):
+    previous = None
+    for row in rows:
+        value = key(row)
+        if previous is not None and value < previous:
+            return False
+        previous = value
+    return True
+
+
+def report_rows(path, key, chunk_size=SORT_CHUNK):
+    """Data rows of a csv report ordered on key. Reports already in order, as
+    the pipeline writes them, are streamed from disk without sorting"""
+    if in_order(read_rows(path), key):
+        return read_rows(path)
+    return sorted_rows(read_rows(path), key, chunk_size)
+
+
+def grouped(rows, key):
+    """(key, rows) of rows ordered on key"""
+    for value, group in itertools.groupby(rows, key):
+        yield value, list(group)
+
+
+def merge_join(*streams):
+    """Full outer join of (key, value) streams ordered on key. Yields
+    (key, values) with None for the streams that lack the key"""
+    iterators = [iter(stream) for stream in streams]
+    heads = [next(iterator, None) for iterator in iterators]
+    while True:
+        keys = [head[0] for head in heads if head is not None]
+        if not keys:
+            return
+        key = min(keys)
+        values = []
+        for i, head in enumerate(heads):
+            if head is not None and head[0] == key:
+                values.append(head[1])
+                heads[i] = next(iterators[i], None)
+            else:
+                values.append(None)
+        yield key, values
+
+
+def artic_samples(
+    qc,
+    variants,
+    pangolin,
+    caseinfo,
+    variant_index,
+    classifier,
+    consensus=None,
+    chunk_size=SORT_CHUNK,
+):
+    """Joined results of every sample of the qc report or the case config, ordered
+    on sample ID. Yields (sample, data, records): data is the articdata of the
+    sample, None if it has no qc results, and records its case config records.
+    consensus: (sample, metrics) of the consensus sequences ordered on sample ID,
+    merged into data if given"""
+    # Without any variant rows, samples get no "variants" entry at all
+    rows = read_rows(variants)
+    has_variants = next(rows, None) is not None
+    rows.close()
+    casekeys = caseinfo[0].keys()
+    packing = dict(zip(casekeys, "-" * len(casekeys)))
+
+    def customer_id(record):
+        return record["Customer_ID_sample"]
+
+    streams = [
+        grouped(report_rows(qc, report_sample, chunk_size), report_sample),
+        grouped(
+            report_rows(pangolin, pangolin_row_sample, chunk_size), pangolin_row_sample
+        ),
+        grouped(report_rows(variants, report_sample, chunk_size), report_sample),
+        grouped(sorted(caseinfo, key=customer_id), customer_id),
+    ]
+    if consensus is not None:
+        from mutant.modules.consensus_qc import merge_metrics
+
+        streams.append(grouped(consensus, lambda item: item[0]))
+    for sample, values in merge_join(*streams):
+        qc_rows, pangolin_rows, variant_rows, records = values[:4]
+        records = records or []
+        if qc_rows is None:
+            yield sample, None, records
+            continue
+        data = qc_values(qc_rows[-1])
+        if pangolin_rows:
+            line = pangolin_rows[-1]
+            data.update(
+                {
+                    "lineage": line[1],
+                    "pangolin_probability": line[2],
+                    "pangoLEARN_version": line[3],
+                    "pangolin_qc": line[4],
+                }
+            )
+        var_all = [line[2] for line in variant_rows or ()]
+        var_voc = [
+            line[2] for line in variant_rows or () if variant_index.matches(line[1], line[2])
+        ]
+        data["VOC_aa"] = ";".join(var_voc) if var_voc else "-"
+        if has_variants:
+            if len(var_all) > 1:
+                data["variants"] = ";".join(var_all)
+            else:
+                data["variants"] = var_all or "-"
+        data["VOC"] = classifier.classify(data["lineage"], var_voc)
+        data.update(packing)
+        if records:
+            data.update(records[-1])
+        if consensus is not None:
+            merge_metrics(data, values[4][-1][1] if values[4] else None)
+        yield sample, data, records
+
+
+class JsonWriter:
+    """Writes samples as one json object, formatted as json.dump of the whole
+    articdata, to a temporary file that is renamed into place on close"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmpfile = "{}.{}.tmp".format(path, os.getpid())
+        self.out = open(self.tmpfile, "w")
+        self.out.write("{")
+        self.samples = 0
+
+    def write(self, sample, data):
+        if self.samples:
+            self.out.write(", ")
+        self.out.write("{}: {}".format(json.dumps(sample), json.dumps(data)))
+        self.samples += 1
+
+    def close(self):
+        self.out.write("}")
+        self.out.close()
+        os.replace(self.tmpfile, self.path)
+
+    def abort(self):
+        self.out.close()
+        os.remove(self.tmpfile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
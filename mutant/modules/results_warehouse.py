@@ -0,0 +1,174 @@
+""" SQLite warehouse of the sarscov2 results of all runs. Every postproc run
+    upserts the articdata of its samples, so that questions across runs
+    (lineage, VOC class, region, sequencing date) are answered with indexed
+    queries instead of parsing the artic json of every results directory.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+from mutant.modules.generic_parser import get_json
+
+COLUMNS = [
+    "sample",
+    "case_id",
+    "ticket",
+    "cg_sample",
+    "region",
+    "lab",
+    "lineage",
+    "voc",
+    "qc",
+    "pct_n_bases",
+    "pct_10x_bases",
+    "date",
+    "date_arrival",
+    "results_dir",
+    "loaded",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    sample TEXT NOT NULL,
+    case_id TEXT NOT NULL,
+    ticket TEXT,
+    cg_sample TEXT,
+    region TEXT,
+    lab TEXT,
+    lineage TEXT,
+    voc TEXT,
+    qc TEXT,
+    pct_n_bases REAL,
+    pct_10x_bases REAL,
+    date TEXT,
+    date_arrival TEXT,
+    results_dir TEXT,
+    loaded TEXT,
+    data TEXT,
+    PRIMARY KEY (case_id, sample)
+);
+CREATE INDEX IF NOT EXISTS samples_sample ON samples (sample);
+CREATE INDEX IF NOT EXISTS samples_lineage ON samples (lineage);
+CREATE INDEX IF NOT EXISTS samples_voc ON samples (voc);
+CREATE INDEX IF NOT EXISTS samples_region ON samples (region, date);
+CREATE INDEX IF NOT EXISTS samples_date ON samples (date);
+"""
+
+# A run that cannot get the write lock in time skips the load instead of
+# holding up its report
+LOCK_TIMEOUT = 10
+
+
+def warehouse_path(config_mutant="", warehouse=""):
+    """Warehouse given on the command line, else the one of the MUTANT config, else ''"""
+    if warehouse != "":
+        return os.path.abspath(warehouse)
+    if config_mutant != "" and os.path.exists(config_mutant):
+        return get_json(config_mutant).get("SARS-CoV-2", dict()).get("warehouse", "")
+    return ""
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ResultsWarehouse:
+    def __init__(self, path, timeout=LOCK_TIMEOUT, wal=False):
+        """timeout: seconds to wait for the write lock of a concurrent run.
+        wal: write-ahead journal, only for warehouses on a local filesystem as
+        it relies on shared memory. Shared storage keeps the rollback journal"""
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        if wal:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def upsert(self, articdata, results_dir):
+        """Inserts or replaces the samples of a run. Returns the number of samples"""
+        loaded = time.strftime("%Y-%m-%d %H:%M:%S")
+        rows = []
+        for sample, data in articdata.items():
+            rows.append(
+                (
+                    sample,
+                    str(data.get("case_ID", "-")),
+                    str(data.get("Customer_ID_project", "-")),
+                    data.get("CG_ID_sample", "-"),
+                    data.get("region_code", "-"),
+                    data.get("lab_code", "-"),
+                    data.get("lineage", "-"),
+                    data.get("VOC", "-"),
+                    data.get("qc", "-"),
+                    to_float(data.get("pct_n_bases")),
+                    to_float(data.get("pct_10X_bases")),
+                    data.get("date_sequencing", "-"),
+                    data.get("date_arrival", "-"),
+                    results_dir,
+                    loaded,
+                    json.dumps(data),
+                )
+            )
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO samples ({}, data) VALUES ({})".format(
+                    ", ".join(COLUMNS), ", ".join("?" * (len(COLUMNS) + 1))
+                ),
+                rows,
+            )
+        return len(rows)
+
+    def query(self, sample="", lineage="", voc="", region="", since="", until="", full=False):
+        """Samples matching all given filters, as dicts ordered by date.
+        lineage may be a glob such as 'B.1.617.2*'. since/until compare against
+        the sequencing date, e.g. '2021-04-01'. full adds the complete articdata"""
+        clauses = []
+        params = []
+        if sample:
+            clauses.append("sample = ?")
+            params.append(sample)
+        if lineage:
+            clauses.append("lineage GLOB ?" if "*" in lineage else "lineage = ?")
+            params.append(lineage)
+        if voc:
+            clauses.append("voc = ?")
+            params.append(voc)
+        if region:
+            clauses.append("region = ?")
+            params.append(region.replace(" ", "_"))
+        if since:
+            clauses.append("date >= ?")
+            params.append(since)
+        if until:
+            # Dates are stored with a time of day, include all of the last day
+            clauses.append("date < ?")
+            params.append(until + "~")
+        columns = COLUMNS + ["data"] if full else COLUMNS
+        sql = "SELECT {} FROM samples".format(", ".join(columns))
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY date, sample"
+        results = []
+        for row in self.conn.execute(sql, params):
+            result = dict(zip(columns, row))
+            if full:
+                result["data"] = json.loads(result["data"])
+            results.append(result)
+        return results
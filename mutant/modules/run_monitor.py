@@ -0,0 +1,265 @@
+""" Runs nextflow under asyncio, streaming its stdout/stderr line by line into
+    the log while tailing the execution trace as it grows. Progress per process
+    (submitted/completed/failed/cached tasks), finished samples and an ETA are
+    logged, and optionally written to a json status file that monitoring can
+    read without parsing whole logs or traces.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import asyncio
+import json
+import os
+import re
+import subprocess
+import time
+
+from mutant import log
+from mutant.modules.trace_profiler import parse_trace_line
+
+# Printed by nextflow with -ansi-log false, e.g.
+# [5d/6a3b1c] Submitted process > articNcovIllumina:sequenceAnalysis:readTrimming (sample1)
+PROCESS_LINE = re.compile(r"\] (Submitted|Cached) process > (\S+)(?: \((.*)\))?")
+FAILED = ("FAILED", "ABORTED")
+# Buffer limit of the output streams. Longer lines are read on in chunks and
+# cut to this length
+STREAM_LIMIT = 1024 * 1024
+
+
+class TraceTail:
+    """Reads the rows appended to a trace file since the previous poll"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.header = None
+        self.partial = ""
+
+    def poll(self):
+        """Tasks of the complete lines written since the last poll"""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if size < self.offset:
+            # Trace was rewritten, start over
+            self.offset, self.header, self.partial = 0, None, ""
+        if size == self.offset:
+            return []
+        with open(self.path) as trace:
+            trace.seek(self.offset)
+            chunk = self.partial + trace.read()
+            self.offset = trace.tell()
+        lines = chunk.split("\n")
+        self.partial = lines.pop()
+        tasks = []
+        for line in lines:
+            if not line.strip():
+                continue
+            if self.header is None:
+                self.header = line.split("\t")
+                continue
+            tasks.append(parse_trace_line(self.header, line))
+        return tasks
+
+
+class RunProgress:
+    """Progress of a run, from the nextflow output and the execution trace"""
+
+    def __init__(self, case, trace, status_file=None):
+        self.case = case
+        self.tail = TraceTail(trace)
+        self.status_file = status_file
+        self.start = time.time()
+        self.processes = dict()
+        self.samples = dict()
+        self.state = "running"
+        self.exit = None
+
+    def process(self, name):
+        return self.processes.setdefault(
+            name, {"submitted": 0, "completed": 0, "failed": 0, "cached": 0}
+        )
+
+    def sample(self, tag):
+        return self.samples.setdefault(tag, {"pending": 0, "failed": 0, "processes": set()})
+
+    def on_output(self, line):
+        """Counts submitted tasks from a line of nextflow output"""
+        hit = PROCESS_LINE.search(line)
+        if not hit:
+            return
+        kind, name, tag = hit.groups()
+        if kind == "Submitted":
+            self.process(name)["submitted"] += 1
+            if tag:
+                self.sample(tag)["pending"] += 1
+
+    def on_task(self, task):
+        """Counts a finished task of the execution trace"""
+        counts = self.process(task.process)
+        if task.status == "CACHED":
+            counts["cached"] += 1
+        elif task.status in FAILED:
+            counts["failed"] += 1
+        else:
+            counts["completed"] += 1
+        if not task.tag:
+            return
+        sample = self.sample(task.tag)
+        if task.status != "CACHED":
+            sample["pending"] = max(0, sample["pending"] - 1)
+        if task.status in FAILED:
+            sample["failed"] += 1
+        else:
+            sample["processes"].add(task.process)
+
+    def update(self):
+        """Reads new trace rows. Returns True if anything changed"""
+        tasks = self.tail.poll()
+        for task in tasks:
+            self.on_task(task)
+        return bool(tasks)
+
+    def finished(self):
+        """Samples with nothing pending that passed every per-sample process seen so far"""
+        expected = set()
+        for sample in self.samples.values():
+            expected |= sample["processes"]
+        return [
+            tag
+            for tag, sample in self.samples.items()
+            if not sample["pending"] and not sample["failed"] and sample["processes"] >= expected
+        ]
+
+    def status(self):
+        elapsed = time.time() - self.start
+        finished = self.finished()
+        remaining = len(self.samples) - len(finished)
+        eta = None
+        if finished and remaining and self.state == "running":
+            eta = round(elapsed / len(finished) * remaining)
+        return {
+            "case": self.case,
+            "state": self.state,
+            "exit": self.exit,
+            "elapsed_s": round(elapsed),
+            "eta_s": eta,
+            "samples": {"seen": len(self.samples), "finished": len(finished)},
+            "processes": self.processes,
+            "updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def report(self):
+        """Logs the progress and writes the status file"""
+        status = self.status()
+        tasks = {
+            key: sum(counts[key] for counts in self.processes.values())
+            for key in ("submitted", "completed", "failed", "cached")
+        }
+        log.info(
+            "{}: {} submitted, {} completed, {} failed, {} cached tasks; {}/{} samples finished; ETA {}".format(
+                self.case,
+                tasks["submitted"],
+                tasks["completed"],
+                tasks["failed"],
+                tasks["cached"],
+                status["samples"]["finished"],
+                status["samples"]["seen"],
+                "-" if status["eta_s"] is None else "{}s".format(status["eta_s"]),
+            )
+        )
+        if self.status_file:
+            tmpfile = "{}.{}.tmp".format(self.status_file, os.getpid())
+            try:
+                with open(tmpfile, "w") as out:
+                    json.dump(status, out, indent=2)
+                os.replace(tmpfile, self.status_file)
+            except OSError as e:
+                log.warning("Unable to write status file {} ({})".format(self.status_file, e))
+
+
+async def read_line(reader):
+    """Next line of reader, b"" at the end of the stream. Lines over the limit
+    of the reader are consumed in chunks, and only their start is kept"""
+    parts = []
+    kept = 0
+    while True:
+        try:
+            chunk = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            chunk = e.partial
+        except asyncio.LimitOverrunError as e:
+            chunk = await reader.read(e.consumed)
+            if kept < STREAM_LIMIT:
+                parts.append(chunk)
+                kept += len(chunk)
+            continue
+        if kept < STREAM_LIMIT:
+            parts.append(chunk)
+        return b"".join(parts)[:STREAM_LIMIT]
+
+
+async def stream(reader, handle):
+    while True:
+        line = await read_line(reader)
+        if not line:
+            break
+        handle(line.decode(errors="replace").rstrip())
+
+
+async def watch(progress, interval):
+    """Reports whenever the trace grew, at most once per interval"""
+    while True:
+        await asyncio.sleep(interval)
+        if progress.update():
+            progress.report()
+
+
+async def open_stream(pipe):
+    """StreamReader of a pipe of a child process"""
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=STREAM_LIMIT)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return reader, transport
+
+
+async def run_monitored(cmd, progress, cwd=None, interval=30):
+    """Runs cmd (an argument list) to completion. Returns its exit code"""
+    # Started with Popen and waited on in an executor thread rather than with
+    # create_subprocess_exec, whose child watcher needs the loop to run in the
+    # main thread before python 3.8
+    loop = asyncio.get_event_loop()
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stdout_transport = await open_stream(proc.stdout)
+    stderr, stderr_transport = await open_stream(proc.stderr)
+
+    def on_stdout(line):
+        log.info(line)
+        progress.on_output(line)
+
+    watcher = asyncio.ensure_future(watch(progress, interval))
+    try:
+        await asyncio.gather(stream(stdout, on_stdout), stream(stderr, log.warning))
+        await loop.run_in_executor(None, proc.wait)
+    except BaseException:
+        # Never leave nextflow running unobserved
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        raise
+    finally:
+        watcher.cancel()
+        stdout_transport.close()
+        stderr_transport.close()
+    progress.update()
+    progress.state = "finished" if proc.returncode == 0 else "failed"
+    progress.exit = proc.returncode
+    progress.report()
+    return proc.returncode
+
+
+def run_command(cmd, case, trace, cwd=None, status_file=None, interval=30):
+    """Blocking entry point, safe to call from worker threads (one event loop each)"""
+    progress = RunProgress(case, trace, status_file)
+    return asyncio.run(run_monitored(cmd, progress, cwd, interval))
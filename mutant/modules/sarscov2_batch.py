@@ -0,0 +1,177 @@
+""" Runs the sarscov2 analysis for many cases at once. Nextflow launches are
+    capped to a fixed number of concurrent runs, and the post-processing
+    (reports and deliverables) of a case starts as soon as its run finishes.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from mutant import log, TIMESTAMP, WD
+from mutant.modules.case_model import load_case
+from mutant.modules.generic_parser import get_json
+
+LIVE_STATUS = "run_status.json"
+STATUS_COLUMNS = [
+    "case",
+    "input_folder",
+    "results_dir",
+    "nextflow_exit",
+    "nextflow_s",
+    "postproc",
+    "postproc_s",
+    "total_s",
+]
+
+
+class BatchSC2:
+    def __init__(
+        self,
+        manifest,
+        config_artic,
+        config_mutant,
+        profiles,
+        max_concurrent=4,
+        resume=False,
+        live_status=False,
+        verify_deliverables=False,
+        report_kwargs=None,
+    ):
+        """manifest: json list of {"input_folder": ..., "config_case": ...} entries,
+        optionally with "outdir" and "resume".
+        report_kwargs: options passed on to the ReportSC2 of every case"""
+        self.entries = get_json(manifest)
+        self.config_artic = os.path.abspath(config_artic)
+        self.config_mutant = config_mutant
+        self.profiles = profiles
+        self.max_concurrent = max(1, max_concurrent)
+        self.resume = resume
+        self.live_status = live_status
+        self.verify_deliverables = verify_deliverables
+        self.report_kwargs = report_kwargs or dict()
+        self.status = []
+
+    def prepare(self):
+        """One status record per manifest entry, with unique results directories"""
+        seen = dict()
+        for entry in self.entries:
+            caseID = load_case(entry["config_case"]).case
+            seen[caseID] = seen.get(caseID, 0) + 1
+            timestamp = TIMESTAMP if seen[caseID] == 1 else "{}-{}".format(TIMESTAMP, seen[caseID])
+            self.status.append(
+                {
+                    "case": caseID,
+                    "input_folder": os.path.abspath(entry["input_folder"]),
+                    "config_case": os.path.abspath(entry["config_case"]),
+                    "timestamp": timestamp,
+                    "outdir": entry.get("outdir", ""),
+                    "resume": entry.get("resume", False),
+                    "results_dir": "",
+                    "nextflow_exit": "",
+                    "nextflow_s": "",
+                    "postproc": "pending",
+                    "postproc_s": "",
+                    "total_s": "",
+                }
+            )
+
+    def launch(self, record):
+        """Runs nextflow for one case, in the case's results directory"""
+        from mutant.modules.sarscov2_start import RunSC2
+
+        start = time.perf_counter()
+        run = RunSC2(
+            input_folder=record["input_folder"],
+            caseID=record["case"],
+            config_artic=self.config_artic,
+            prefix="{}_{}".format(record["case"], record["timestamp"]),
+            profiles=self.profiles,
+            timestamp=record["timestamp"],
+            WD=WD,
+        )
+        resdir = run.get_results_dir(self.config_mutant, record["outdir"])
+        os.makedirs(resdir, exist_ok=True)
+        record["results_dir"] = resdir
+        previous = run.find_previous_run(resdir) if self.resume or record["resume"] else None
+        status_file = os.path.join(resdir, LIVE_STATUS) if self.live_status else None
+        log.info("Launching case {} in {}".format(record["case"], resdir))
+        if previous is not None:
+            # The .nextflow cache of a resumed session lives in its launch directory
+            record["nextflow_exit"] = run.run_case(resdir, resume_from=previous, status_file=status_file)
+        else:
+            record["nextflow_exit"] = run.run_case(resdir, launch_dir=resdir, status_file=status_file)
+        record["nextflow_s"] = round(time.perf_counter() - start, 1)
+        return record
+
+    def postproc(self, record):
+        """Creates reports and deliverables of a finished case"""
+        from mutant.modules.sarscov2_delivery import DeliverySC2
+        from mutant.modules.sarscov2_report import ReportSC2
+
+        start = time.perf_counter()
+        try:
+            report = ReportSC2(
+                caseinfo=record["config_case"],
+                indir=record["results_dir"],
+                config_artic=self.config_artic,
+                fastq_dir=record["input_folder"],
+                timestamp=record["timestamp"],
+                **self.report_kwargs
+            )
+            report.create_all_files()
+            delivery = DeliverySC2(caseinfo=record["config_case"], indir=record["results_dir"])
+            delivery.rename_deliverables()
+            if self.verify_deliverables and delivery.verify_deliverables():
+                raise Exception("deliverables are missing")
+            record["postproc"] = "done"
+        except BaseException as e:
+            log.error("Post-processing of case {} failed: {}".format(record["case"], e))
+            record["postproc"] = "failed"
+        record["postproc_s"] = round(time.perf_counter() - start, 1)
+        return record
+
+    def run(self):
+        """Runs all cases. Returns the status records"""
+        self.prepare()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as launches, ThreadPoolExecutor(
+            max_workers=self.max_concurrent
+        ) as postprocs:
+            pending = {launches.submit(self.launch, record): record for record in self.status}
+            finished = []
+            for future in as_completed(pending):
+                record = pending[future]
+                if future.exception() is not None:
+                    log.error("Launch of case {} failed: {}".format(record["case"], future.exception()))
+                    record["nextflow_exit"] = "error"
+                    record["postproc"] = "skipped"
+                    continue
+                if record["nextflow_exit"] != 0:
+                    log.error(
+                        "Nextflow exited with {} for case {}, skipping post-processing".format(
+                            record["nextflow_exit"], record["case"]
+                        )
+                    )
+                    record["postproc"] = "skipped"
+                    continue
+                finished.append(postprocs.submit(self.postproc, record))
+            for future in as_completed(finished):
+                record = future.result()
+                record["total_s"] = round(record["nextflow_s"] + record["postproc_s"], 1)
+        log.info("Batch of {} cases finished in {:.1f}s".format(len(self.status), time.perf_counter() - start))
+        return self.status
+
+    def write_status(self, path):
+        """Writes the status/timing table as tsv and logs it"""
+        with open(path, "w") as out:
+            table = csv.writer(out, delimiter="\t", lineterminator="\n")
+            table.writerow(STATUS_COLUMNS)
+            for record in self.status:
+                table.writerow([record[column] for column in STATUS_COLUMNS])
+        for record in [dict(zip(STATUS_COLUMNS, STATUS_COLUMNS))] + self.status:
+            log.info("  ".join("{:<14}".format(str(record[column])) for column in STATUS_COLUMNS[:1] + STATUS_COLUMNS[3:]))
+        log.info("Batch status written to {}".format(path))
@@ -0,0 +1,160 @@
+""" Streams per sample consensus FASTA files into one multi-FASTA, in sample
+    order. Optionally writes block-gzip (BGZF) compressed output, and a
+    samtools compatible .fai (and .gzi for BGZF) index so that single
+    samples can be fetched by seeking.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import os
+import shutil
+import struct
+import zlib
+
+# BGZF blocks hold at most 64 KiB, compressed data included
+BGZF_BLOCK_SIZE = 0xFF00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+COPY_CHUNK = 16 * 1024 * 1024
+
+
+def consensus_files(indir):
+    """Returns the *.consensus.fa files of a directory, ordered by sample ID"""
+    hits = []
+    if not os.path.isdir(indir):
+        return hits
+    with os.scandir(indir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".consensus.fa") and entry.is_file():
+                sample = entry.name.split(".")[0].split("_")[-1]
+                hits.append((sample, entry.name, entry.path))
+    return [path for sample, name, path in sorted(hits)]
+
+
+class BgzfWriter:
+    """Minimal BGZF writer. Tracks block offsets for the .gzi index"""
+
+    def __init__(self, path):
+        self.handle = open(path, "wb")
+        self.buffer = bytearray()
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.blocks = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.write_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def write_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        # Header (with BC extra subfield holding the block size - 1), payload, CRC32 and ISIZE
+        block_size = 18 + len(deflated) + 8
+        self.handle.write(
+            struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+        )
+        self.handle.write(deflated)
+        self.handle.write(struct.pack("<II", zlib.crc32(data) & 0xFFFFFFFF, len(data)))
+        if self.compressed_offset:
+            self.blocks.append((self.compressed_offset, self.uncompressed_offset))
+        self.compressed_offset += block_size
+        self.uncompressed_offset += len(data)
+
+    def write_gzi(self, path):
+        with open(path, "wb") as out:
+            out.write(struct.pack("<Q", len(self.blocks)))
+            for compressed, uncompressed in self.blocks:
+                out.write(struct.pack("<QQ", compressed, uncompressed))
+
+    def close(self):
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+
+class PlainWriter:
+    """Binary output that can also take whole files kernel-side"""
+
+    def __init__(self, path):
+        self.handle = open(path, "wb")
+
+    def write(self, data):
+        self.handle.write(data)
+
+    def copy_file(self, path):
+        """Appends a file, zero-copy when the platform allows it"""
+        self.handle.flush()
+        out_fd = self.handle.fileno()
+        with open(path, "rb") as infile:
+            in_fd = infile.fileno()
+            remaining = os.fstat(in_fd).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(in_fd, out_fd, min(remaining, COPY_CHUNK))
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except (AttributeError, OSError):
+                shutil.copyfileobj(infile, self.handle, COPY_CHUNK)
+        # copy_file_range moved the descriptor offset behind the buffered handle's back
+        self.handle.seek(0, os.SEEK_END)
+
+    def close(self):
+        self.handle.close()
+
+
+def ends_with_newline(path):
+    with open(path, "rb") as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return True
+        infile.seek(-1, os.SEEK_END)
+        return infile.read(1) == b"\n"
+
+
+def write_concat_consensus(inputs, output, bgzip=False, index=False):
+    """Concatenates FASTA files into output, every record terminated by one
+    newline. Returns the .fai entries (name, length, offset, linebases, linewidth)"""
+    writer = BgzfWriter(output) if bgzip else PlainWriter(output)
+    fai = []
+    offset = 0
+    try:
+        for path in inputs:
+            if not bgzip and not index:
+                writer.copy_file(path)
+                if not ends_with_newline(path):
+                    writer.write(b"\n")
+                continue
+            record = None
+            line = b""
+            with open(path, "rb") as infile:
+                for line in infile:
+                    writer.write(line)
+                    offset += len(line)
+                    if line.startswith(b">"):
+                        name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ""
+                        record = [name, 0, offset, 0, 0]
+                        fai.append(record)
+                    elif record is not None:
+                        bases = len(line.rstrip(b"\r\n"))
+                        if record[3] == 0:
+                            record[3] = bases
+                            record[4] = len(line)
+                        record[1] += bases
+            if line and not line.endswith(b"\n"):
+                writer.write(b"\n")
+                offset += 1
+                if record is not None and record[4] == record[3]:
+                    record[4] += 1
+    finally:
+        writer.close()
+
+    if index:
+        with open("{}.fai".format(output), "w") as out:
+            for record in fai:
+                out.write("\t".join(str(field) for field in record) + "\n")
+        if bgzip:
+            writer.write_gzi("{}.gzi".format(output))
+    return fai
@@ -6,101 +6,163 @@
 """
 
 
-import csv
-import glob
 import os
-from datetime import date
-from pathlib import Path
 
-import yaml
-
-from mutant.modules.generic_parser import get_sarscov2_config
+from mutant import log
+from mutant.modules.case_model import load_case
+from mutant.modules.fingerprint_cache import FingerprintCache
+from mutant.modules.profiling import profiled
 
 
 class DeliverySC2:
     def __init__(self, caseinfo, indir):
         self.casefile = caseinfo
-        caseinfo = get_sarscov2_config(caseinfo)
+        caseinfo = load_case(caseinfo)
 
-        regionlab_list = []
-        for record in caseinfo:
-            regionlab = "{}_{}".format(record["region_code"], record["lab_code"])
-            if regionlab not in regionlab_list:
-                regionlab_list.append(regionlab)
         self.caseinfo = caseinfo
-        self.case = caseinfo[0]["case_ID"]
-        self.ticket = caseinfo[0]["Customer_ID_project"]
-        self.project = caseinfo[0]["Customer_ID_project"]
-        self.regionlabs = regionlab_list
+        self.case = caseinfo.case
+        self.ticket = caseinfo.ticket
+        self.project = caseinfo.ticket
+        self.regionlabs = caseinfo.regionlabs
         self.indir = indir
 
+    @profiled("rename")
     def rename_deliverables(self):
-        """Rename result files for delivery: fastq, consensus files, vcf and pangolin"""
+        """Rename result files for delivery: fastq, consensus files, vcf and pangolin.
+        Every output directory is read once; returns the created/skipped/missing counts"""
+
+        links = []
+        missing = []
 
         # Rename sample files
+        consensus_dir = "{0}/ncovIllumina_sequenceAnalysis_makeConsensus".format(self.indir)
+        vcf_dir = "{0}/ncovIllumina_Genotyping_typeVariants/vcf".format(self.indir)
+        consensus_index = index_dir(consensus_dir)
+        vcf_index = index_dir(vcf_dir)
 
         for sampleinfo in self.caseinfo:
-            sample = sampleinfo["CG_ID_sample"]
-            region = sampleinfo["region_code"]
-            lab = sampleinfo["lab_code"]
-            base_sample = "{0}_{1}_{2}".format(
-                region, lab, sampleinfo["Customer_ID_sample"]
-            )
+            base_sample = sampleinfo.base_sample
             if not sampleinfo["sequencing_qc_pass"]:
                 continue
 
             # rename makeConsensus
-            prefix = "{0}/ncovIllumina_sequenceAnalysis_makeConsensus".format(
-                self.indir
-            )
-            for item in glob.glob("{0}/{1}.*".format(prefix, base_sample)):
-                newpath = "{0}/{1}.consensus.fasta".format(prefix, base_sample)
-                try: 
-                    os.symlink(item, newpath)
-                except Exception as e:
-                    pass
+            newname = "{0}.consensus.fasta".format(base_sample)
+            hits = [name for name in consensus_index.get(base_sample, []) if name != newname]
+            if hits:
+                links.append(("{0}/{1}".format(consensus_dir, hits[0]), "{0}/{1}".format(consensus_dir, newname)))
+            else:
+                missing.append("{0}/{1}.*".format(consensus_dir, base_sample))
 
             # rename typeVariants
-            prefix = "{0}/ncovIllumina_Genotyping_typeVariants/vcf".format(self.indir)
-            for item in glob.glob("{0}/{1}.csq.vcf".format(prefix, base_sample)):
-                newpath = "{0}/{1}.vcf".format(prefix, base_sample)
-                try: 
-                    os.symlink(item, newpath)
-                except Exception as e:
-                    pass
-
+            vcf = "{0}.csq.vcf".format(base_sample)
+            if vcf in vcf_index.get(base_sample, []):
+                links.append(("{0}/{1}".format(vcf_dir, vcf), "{0}/{1}.vcf".format(vcf_dir, base_sample)))
+            else:
+                missing.append("{0}/{1}".format(vcf_dir, vcf))
 
         ## Rename case files
+        multiqc_dir = "{}/multiqc".format(self.indir)
+        multiqc = list_dir(multiqc_dir)
 
         # rename multiqc
-        hit = glob.glob("{}/multiqc/*_multiqc.html".format(self.indir))
+        hit = [name for name in multiqc if name.endswith("_multiqc.html")]
         if len(hit) == 1:
-            hit = hit[0]
-            try: 
-                os.symlink(hit, "{}/{}_multiqc.html".format(self.indir, self.ticket))
-            except Exception as e:
-                pass
+            links.append(("{}/{}".format(multiqc_dir, hit[0]), "{}/{}_multiqc.html".format(self.indir, self.ticket)))
+        else:
+            missing.append("{}/*_multiqc.html".format(multiqc_dir))
 
         # rename multiqc json
-        hit = glob.glob("{}/multiqc/*_multiqc_data/multiqc_data.json".format(self.indir))
+        hit = [
+            "{}/{}/multiqc_data.json".format(multiqc_dir, name)
+            for name in multiqc
+            if name.endswith("_multiqc_data")
+        ]
+        hit = [path for path in hit if os.path.exists(path)]
         if len(hit) == 1:
-            hit = hit[0]
-            try: 
-                os.symlink(hit, "{}/{}_multiqc.json".format(self.indir, self.ticket))
-            except Exception as e:
-                pass
-          
+            links.append((hit[0], "{}/{}_multiqc.json".format(self.indir, self.ticket)))
+        else:
+            missing.append("{}/*_multiqc_data/multiqc_data.json".format(multiqc_dir))
 
         core_suffix = [
             ".qc.csv",
             ".typing_summary.csv",
             ".variant_summary.csv",
         ]
+        case_files = list_dir(self.indir)
         for thing in core_suffix:
-            hit = glob.glob("{0}/*{1}".format(self.indir, thing))
+            newname = "{0}{1}".format(self.ticket, thing)
+            hit = [name for name in case_files if name.endswith(thing) and name != newname]
             if len(hit) == 1:
-                hit = hit[0]
-                try: 
-                    os.symlink(hit, "{0}/{1}{2}".format(self.indir, self.ticket, thing))
-                except Exception as e:
-                    pass
+                links.append(("{0}/{1}".format(self.indir, hit[0]), "{0}/{1}".format(self.indir, newname)))
+            else:
+                missing.append("{0}/*{1}".format(self.indir, thing))
+
+        counts = make_links(links)
+        counts["missing"] = len(missing)
+        for pattern in missing:
+            log.debug("No unique file for delivery at {}".format(pattern))
+        log.info(
+            "Renamed deliverables of {}: {} links created, {} already in place, {} failed, {} missing".format(
+                self.case, counts["created"], counts["skipped"], counts["failed"], counts["missing"]
+            )
+        )
+        return counts
+
+    @profiled("verify")
+    def verify_deliverables(self, threads=8):
+        """Checks that every file of the deliverables yaml exists, and records
+        its size and checksum. Returns the missing paths"""
+        from mutant.modules.deliverables_verify import verify_deliverables
+
+        delivfile = "{}/{}_deliverables.yaml".format(self.indir, self.case)
+        # The yaml is an output of the deliveryfile stage of the report, which
+        # would otherwise be rebuilt without the checksums on the next run
+        cache = FingerprintCache(self.indir, settings=None)
+        before = {delivfile: cache.fingerprint(delivfile)}
+        missing = verify_deliverables(delivfile, threads=threads)
+        if cache.update_outputs("deliveryfile", before, [delivfile]):
+            cache.save()
+        return missing
+
+
+def list_dir(path):
+    """Sorted names of the visible entries of a directory, empty if it is missing"""
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries if not entry.name.startswith("."))
+    except OSError:
+        return []
+
+
+def index_dir(path):
+    """Entry names of a directory keyed by every prefix that ends before a '.',
+    so that all files named <key>.* are found with a single lookup"""
+    index = dict()
+    for name in list_dir(path):
+        for pos, char in enumerate(name):
+            if char == ".":
+                index.setdefault(name[:pos], []).append(name)
+    return index
+
+
+def make_links(links):
+    """Creates (target, link) symlinks. Links already pointing to their target are
+    kept, stale symlinks are replaced and regular files are never overwritten"""
+    counts = {"created": 0, "skipped": 0, "failed": 0}
+    for target, link in links:
+        if os.path.islink(link):
+            if os.readlink(link) == target:
+                counts["skipped"] += 1
+                continue
+            os.remove(link)
+        elif os.path.exists(link):
+            log.warning("Not linking {} to {}, a file is in the way".format(link, target))
+            counts["failed"] += 1
+            continue
+        try:
+            os.symlink(target, link)
+            counts["created"] += 1
+        except OSError as e:
+            log.warning("Unable to link {} to {} ({})".format(link, target, e))
+            counts["failed"] += 1
+    return counts
@@ -0,0 +1,76 @@
+""" Merges the per sample pangolin typing results of the sarscov2 pipeline
+    into one csv, validating the header of every input. The merged rows are
+    also returned as a sample index, so that they need not be parsed again.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+PANGOLIN_HEADER = [
+    "taxon",
+    "lineage",
+    "probability",
+    "pangoLEARN_version",
+    "status",
+    "note",
+]
+
+
+def pangolin_sample(taxon):
+    """Customer sample ID of a pangolin taxon"""
+    return taxon.split(".")[0].split("_")[-1]
+
+
+def pangolin_files(indir):
+    """Returns the *.csv files of a directory, ordered by sample ID"""
+    hits = []
+    if not os.path.isdir(indir):
+        return hits
+    with os.scandir(indir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".csv") and entry.is_file():
+                hits.append((pangolin_sample(entry.name), entry.name, entry.path))
+    return [path for sample, name, path in sorted(hits)]
+
+
+def read_pangolin(path):
+    """Returns the data rows of a pangolin csv in PANGOLIN_HEADER column order"""
+    with open(path, newline="") as f:
+        content = csv.reader(f)
+        header = next(content, None)
+        if header is None:
+            return []
+        if sorted(header) != sorted(PANGOLIN_HEADER):
+            raise ValueError(
+                "Unexpected pangolin header in {}: {}".format(path, ",".join(header))
+            )
+        order = [header.index(column) for column in PANGOLIN_HEADER]
+        return [[line[i] for i in order] for line in content if line]
+
+
+def merge_pangolin(inputs, output, threads=4):
+    """Writes the rows of all inputs to output, in input order.
+    Returns a sample -> row index of the written rows. Raises ValueError on
+    an input with an unexpected header, leaving output untouched"""
+    index = dict()
+    tmpfile = "{}.{}.tmp".format(output, os.getpid())
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            parsed = pool.map(read_pangolin, inputs)
+            with open(tmpfile, "w", newline="") as out:
+                concat = csv.writer(out, lineterminator="\n")
+                concat.writerow(PANGOLIN_HEADER)
+                for rows in parsed:
+                    concat.writerows(rows)
+                    for row in rows:
+                        index[pangolin_sample(row[0])] = row
+        os.replace(tmpfile, output)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    return index
@@ -7,34 +7,75 @@
 import csv
 import glob
 import json
-import pandas
-import re
 import os
+import sqlite3
 import sys
-import yaml 
 
 from datetime import date
 from pathlib import Path
 
-from mutant import WD
-from mutant.modules.generic_parser import get_sarscov2_config, get_json, append_dict
+from mutant import WD, version, log
+from mutant.modules.artic_jsonl import JsonlWriter, index_path
+from mutant.modules.artic_qc import qc_sample, qc_values
+from mutant.modules.case_model import load_case
+from mutant.modules.fingerprint_cache import FingerprintCache
+from mutant.modules.generic_parser import get_json, append_dict
+from mutant.modules.partitioned_writer import PartitionedWriter
+from mutant.modules.profiling import profiled, record_timings
+from mutant.modules.report_stream import JsonWriter, artic_samples
+from mutant.modules.results_warehouse import ResultsWarehouse
+from mutant.modules.sarscov2_consensus import consensus_files, write_concat_consensus
+from mutant.modules.sarscov2_pangolin import merge_pangolin, pangolin_files
+from mutant.modules.stage_scheduler import StageScheduler
+from mutant.modules.trace_profiler import read_trace, write_performance_report
+from mutant.modules.variant_index import REGIONS_OF_INTEREST, load_variant_index
+from mutant.modules.variant_report import write_variant_report
+from mutant.modules.voc_classifier import CLASSIFICATIONS, load_classifier
+
+RESULT_HEADER = [
+    "Sample",
+    "Selection",
+    "Region Code",
+    "Ticket",
+    "%N_bases",
+    "%10X_coverage",
+    "QC_pass",
+    "Lineage",
+    "PangoLEARN_version",
+    "VOC",
+    "Mutations",
+]
+# Samples upserted into the warehouse per transaction when streaming
+WAREHOUSE_BATCH = 1000
 
 
 class ReportSC2:
-    def __init__(self, caseinfo, indir, config_artic, fastq_dir, timestamp):
+    def __init__(
+        self,
+        caseinfo,
+        indir,
+        config_artic,
+        fastq_dir,
+        timestamp,
+        engine="csv",
+        workers=4,
+        force=False,
+        hash_inputs=False,
+        warehouse="",
+        json_format="json",
+        regions_of_interest=REGIONS_OF_INTEREST,
+        streaming=False,
+        variant_shards="none",
+        consensus_qc=False,
+    ):
         self.casefile = caseinfo
-        caseinfo = get_sarscov2_config(caseinfo)
+        caseinfo = load_case(caseinfo)
 
-        regionlab_list = []
-        for record in caseinfo:
-            regionlab = "{}_{}".format(record["region_code"], record["lab_code"])
-            if regionlab not in regionlab_list:
-                regionlab_list.append(regionlab)
         self.caseinfo = caseinfo
-        self.case = caseinfo[0]["case_ID"]
-        self.ticket = caseinfo[0]["Customer_ID_project"]
-        self.project = caseinfo[0]["Customer_ID_project"]
-        self.regionlabs = regionlab_list
+        self.case = caseinfo.case
+        self.ticket = caseinfo.ticket
+        self.project = caseinfo.ticket
+        self.regionlabs = caseinfo.regionlabs
         self.indir = indir
         self.config_artic = config_artic
         self.time = timestamp
@@ -42,31 +83,190 @@ class ReportSC2:
         self.today = today
         self.fastq_dir = fastq_dir
         self.articdata = dict()
-
+        # Sample -> pangolin row, set when the merged pangolin file is written
+        self.pangolin_index = None
+        # Ingestion of artic results: "csv" (line by line) or "pandas" (vectorized)
+        self.engine = engine
+        self.workers = workers
+        # Rebuild every output regardless of the fingerprint cache
+        self.force = force
+        self.hash_inputs = hash_inputs
+        # SQLite results warehouse the articdata is loaded into, if any
+        self.warehouse = warehouse
+        # Artic json output: "json", "jsonl" (one sample per line, indexed) or "both"
+        self.json_format = json_format
+        # Config of the gene regions and named mutations reported as VOC_aa
+        self.regions_of_interest = regions_of_interest
+        # Merge-join the results one sample at a time instead of loading articdata
+        self.streaming = streaming
+        # Variant report also split per "regionlab" or per "sample", or "none"
+        self.variant_shards = variant_shards
+        # Recompute the QC metrics from the consensus sequences into articdata
+        self.consensus_qc = consensus_qc
+
+    @profiled("postproc")
     def create_all_files(self):
-        self.create_trailblazer_config()
-        self.create_concat_pangolin()
-        self.create_concat_consensus()
-        self.create_deliveryfile()
-        self.create_fohm_csv()
-        self.load_lookup_dict()
-        self.create_sarscov2_resultfile()
-        self.create_sarscov2_variantfile()
-        self.create_jsonfile()
+        """Creates all report files, independent stages are run concurrently.
+        Stages whose outputs are up to date with their inputs are skipped unless forced.
+        Returns the wall-clock time of each stage that ran"""
+        settings = {
+            "version": version,
+            "casefile": os.path.abspath(self.casefile),
+            "config_artic": self.config_artic,
+            "fastq_dir": self.fastq_dir,
+        }
+        if self.warehouse:
+            settings["warehouse"] = self.warehouse
+        if self.json_format != "json":
+            settings["json_format"] = self.json_format
+        if self.streaming:
+            settings["streaming"] = True
+        if self.variant_shards != "none":
+            settings["variant_shards"] = self.variant_shards
+        if self.consensus_qc:
+            settings["consensus_qc"] = True
+        cache = FingerprintCache(self.indir, settings=settings, hash_inputs=self.hash_inputs)
+        scheduler = StageScheduler(workers=self.workers, cache=cache, force=self.force)
+
+        pangolin = "{0}/{1}.pangolin.csv".format(self.indir, self.ticket)
+        artic_results = (
+            glob.glob(os.path.join(self.indir, "*qc.csv"))
+            + glob.glob(os.path.join(self.indir, "*variant_summary.csv"))
+            + [pangolin, self.casefile, CLASSIFICATIONS]
+            + load_variant_index(self.regions_of_interest).sources
+        )
+        if self.consensus_qc:
+            artic_results += self.consensus_paths()
+
+        scheduler.add(
+            "trailblazer_config",
+            self.create_trailblazer_config,
+            inputs=[Path(self.indir, "pipeline_info", "execution_trace.txt")],
+            outputs=[Path(self.indir, "trailblazer_config.yaml")],
+        )
+        scheduler.add(
+            "performance_report",
+            self.create_performance_report,
+            inputs=[Path(self.indir, "pipeline_info", "execution_trace.txt")],
+            outputs=[
+                Path(self.indir, "pipeline_info", "performance_summary.json"),
+                Path(self.indir, "pipeline_info", "performance_processes.csv"),
+            ],
+        )
+        scheduler.add(
+            "concat_pangolin",
+            self.create_concat_pangolin,
+            inputs=pangolin_files(
+                "{0}/ncovIllumina_sequenceAnalysis_pangolinTyping".format(self.indir)
+            ),
+            outputs=[pangolin],
+        )
+        scheduler.add(
+            "concat_consensus",
+            self.create_concat_consensus,
+            inputs=consensus_files(
+                "{0}/ncovIllumina_sequenceAnalysis_makeConsensus".format(self.indir)
+            ),
+            outputs=["{0}/{1}.consensus.fa".format(self.indir, self.ticket)],
+        )
+        scheduler.add(
+            "variantfile",
+            self.create_sarscov2_variantfile,
+            inputs=glob.glob(os.path.join(self.indir, "*variant_summary.csv"))
+            # Shards follow the samples and region-labs of the case config
+            + ([self.casefile] if self.variant_shards != "none" else []),
+            outputs=[
+                os.path.join(self.indir, "sars-cov-2_{}_variants.csv".format(self.ticket)),
+                self.mutation_counts_path(),
+            ]
+            + [self.variant_shard_path(shard) for shard in self.variant_shard_keys()],
+        )
+        fohm_outputs = [
+            os.path.join(self.indir, "{}_{}_komplettering.csv".format(rl, self.today))
+            for rl in self.regionlabs
+        ]
+        # The deliverables list the dated komplettering files, so the yaml is
+        # rebuilt after the stage that writes them whenever they change
+        deliveryfile = {
+            "inputs": [self.casefile] + fohm_outputs,
+            "outputs": ["{}/{}_deliverables.yaml".format(self.indir, self.case)],
+        }
+        resultfile = os.path.join(self.indir, "sars-cov-2_{}_results.csv".format(self.ticket))
+        receipt = "{}/{}_warehouse.json".format(self.indir, self.ticket)
+        if self.streaming:
+            scheduler.add(
+                "streamed_reports",
+                self.create_streamed_reports,
+                requires=["concat_pangolin"],
+                inputs=artic_results,
+                outputs=[resultfile]
+                + self.json_outputs()
+                + fohm_outputs
+                + ([receipt] if self.warehouse else []),
+            )
+            scheduler.add(
+                "deliveryfile",
+                self.create_deliveryfile,
+                requires=["streamed_reports"],
+                **deliveryfile
+            )
+            timings = scheduler.run()
+            record_timings("postproc", timings)
+            return timings
+
+        scheduler.add(
+            "fohm_csv",
+            self.create_fohm_csv,
+            inputs=[self.casefile],
+            outputs=fohm_outputs,
+        )
+        scheduler.add(
+            "deliveryfile", self.create_deliveryfile, requires=["fohm_csv"], **deliveryfile
+        )
+        scheduler.add("lookup_dict", self.load_lookup_dict, requires=["concat_pangolin"])
+        scheduler.add(
+            "resultfile",
+            self.create_sarscov2_resultfile,
+            requires=["lookup_dict"],
+            inputs=artic_results,
+            outputs=[resultfile],
+        )
+        scheduler.add(
+            "jsonfile",
+            self.create_jsonfile,
+            requires=["lookup_dict"],
+            inputs=artic_results,
+            outputs=self.json_outputs(),
+        )
+        if self.warehouse:
+            scheduler.add(
+                "warehouse",
+                self.load_warehouse,
+                requires=["lookup_dict"],
+                inputs=artic_results,
+                outputs=[receipt],
+            )
+        timings = scheduler.run()
+        record_timings("postproc", timings)
+        return timings
 
     def get_finished_slurm_ids(self) -> list:
         trace_file_path = Path(self.indir, "pipeline_info", "execution_trace.txt")
         slurm_id_list = []
-        with open(trace_file_path, "r") as trace_file_contents:
-            for line in trace_file_contents:
-                slurm_id = line.split()[2]
-                try:
-                    slurm_id_list.append(int(slurm_id))
-                except Exception:
-                    continue
+        for task in read_trace(trace_file_path):
+            try:
+                slurm_id_list.append(int(task.native_id))
+            except Exception:
+                continue
         return slurm_id_list
 
+    def create_performance_report(self) -> None:
+        """Summarises the execution trace into pipeline_info/performance_*"""
+        write_performance_report(self.indir)
+
     def create_trailblazer_config(self) -> None:
+        import yaml
+
         trailblazer_config_path = Path(self.indir, "trailblazer_config.yaml")
         finished_slurm_ids = self.get_finished_slurm_ids()
         if not finished_slurm_ids:
@@ -78,54 +278,40 @@ class ReportSC2:
 
         indir = "{0}/ncovIllumina_sequenceAnalysis_pangolinTyping".format(self.indir)
 
-        concat = open("{0}/{1}.pangolin.csv".format(self.indir, self.ticket), "w+")
-        concat.write("taxon,lineage,probability,pangoLEARN_version,status,note\n")
-
-
-        for item in glob.glob("{0}/*.csv".format(indir)):
-            single = open(item, "r")
-            concat.write('\n'.join(single.readlines()[1:]))
-        concat.close()
+        self.pangolin_index = merge_pangolin(
+            pangolin_files(indir), "{0}/{1}.pangolin.csv".format(self.indir, self.ticket)
+        )
 
     def create_concat_consensus(self):
 
         indir = "{0}/ncovIllumina_sequenceAnalysis_makeConsensus".format(self.indir)
 
-        concat = open("{0}/{1}.consensus.fa".format(self.indir, self.ticket), "w+")
-        for item in glob.glob("{0}/*.consensus.fa".format(indir)):
-            single = open(item, "r")
-            concat.write(single.read())
-            concat.write("\n")
-        concat.close()
+        write_concat_consensus(
+            consensus_files(indir), "{0}/{1}.consensus.fa".format(self.indir, self.ticket)
+        )
 
     def create_fohm_csv(self):
 
         """Creates a summary file for FoHM for each region-lab-combination"""
 
-        # Add header to summary files
-        for regionlab in self.regionlabs:
-            sumfile = os.path.join(
-                self.indir,
-                "{}_{}_komplettering.csv".format(regionlab, self.today),
-            )
-            with open(sumfile, "w") as summary:
-                summary.write("provnummer,urvalskriterium,GISAID_accession\n")
-
+        summary = PartitionedWriter(
+            lambda regionlab: os.path.join(
+                self.indir, "{}_{}_komplettering.csv".format(regionlab, self.today)
+            ),
+            header="provnummer,urvalskriterium,GISAID_accession\n",
+        )
         # Write sample information to corresponding summary file
-        for record in self.caseinfo:
-            region = record["region_code"]
-            lab = record["lab_code"]
-            sumfile = os.path.join(
-                self.indir, "{}_{}_{}_komplettering.csv".format(region, lab, self.today)
-            )
-            with open(sumfile, "a") as out:
-                summary = csv.writer(out)
-                summary.writerow(
+        for regionlab, records in self.caseinfo.by_regionlab.items():
+            summary.add_partition(regionlab)
+            for record in records:
+                summary.add(
+                    regionlab,
                     [
                         record["Customer_ID_sample"],
                         record["selection_criteria"],
-                    ]
+                    ],
                 )
+        summary.write()
 
     def create_sarscov2_resultfile(self):
         """Write summary csv report of Artic and Pangolin results"""
@@ -142,65 +328,82 @@ class ReportSC2:
         )
         with open(summaryfile, mode="w") as out:
             summary = csv.writer(out)
-            summary.writerow(
-                [
-                    "Sample",
-                    "Selection",
-                    "Region Code",
-                    "Ticket",
-                    "%N_bases",
-                    "%10X_coverage",
-                    "QC_pass",
-                    "Lineage",
-                    "PangoLEARN_version",
-                    "VOC",
-                    "Mutations",
-
-                ]
-            )
+            summary.writerow(RESULT_HEADER)
             for sample, data in self.articdata.items():
-                selection = "-"
-                row = [
-                    sample,
-                    data["selection_criteria"],
-                    data["region_code"],
-                    ticket,
-                    data["pct_n_bases"],
-                    data["pct_10X_bases"],
-                    data["qc"],
-                    data["lineage"],
-                    data["pangoLEARN_version"],
-                    data["VOC"],
-                    data["VOC_aa"],
-
-                ]
-                summary.writerow(row)
+                summary.writerow(self.result_row(sample, data))
+
+    def result_row(self, sample, data):
+        """Row of a sample in the summary csv report"""
+        return [
+            sample,
+            data["selection_criteria"],
+            data["region_code"],
+            self.ticket,
+            data["pct_n_bases"],
+            data["pct_10X_bases"],
+            data["qc"],
+            data["lineage"],
+            data["pangoLEARN_version"],
+            data["VOC"],
+            data["VOC_aa"],
+        ]
 
     def create_sarscov2_variantfile(self):
         """Write variant csv report of identified variants
-        I am literally just variant_summary.csv but with sample names"""
+        I am literally just variant_summary.csv but with sample names.
+        Also counts the mutations, and splits the report per shard if configured"""
 
         indir = self.indir
         ticket = self.ticket
-        today = self.today
 
-        varRep = glob.glob(os.path.join(indir, "*variant_summary.csv"))[0]
-        varout = os.path.join(
-            indir, "sars-cov-2_{}_variants.csv".format(ticket, today)
+        varout = os.path.join(indir, "sars-cov-2_{}_variants.csv".format(ticket))
+        hits = glob.glob(os.path.join(indir, "*variant_summary.csv"))
+        varRep = hits[0] if hits else None
+        if varRep is None:
+            print("Unable to find *variant_summary.csv in {}, variant report is empty".format(indir))
+        shard_mode = "" if self.variant_shards == "none" else self.variant_shards
+        if shard_mode:
+            os.makedirs(os.path.dirname(self.variant_shard_path("")), exist_ok=True)
+        try:
+            write_variant_report(
+                varRep,
+                varout,
+                counts=self.mutation_counts_path(),
+                shard_mode=shard_mode,
+                shard_path=self.variant_shard_path,
+                shards=self.variant_shard_keys(),
+                caseinfo=self.caseinfo,
+            )
+        except OSError as e:
+            print("Failed creating file {}\n{}".format(varout, e))
+
+    def mutation_counts_path(self):
+        return os.path.join(self.indir, "sars-cov-2_{}_mutation_counts.csv".format(self.ticket))
+
+    def variant_shard_keys(self):
+        """Region-labs or customer sample IDs the variant report is split into"""
+        if self.variant_shards == "regionlab":
+            return self.regionlabs
+        if self.variant_shards == "sample":
+            return [record["Customer_ID_sample"] for record in self.caseinfo]
+        return []
+
+    def variant_shard_path(self, shard):
+        return os.path.join(
+            self.indir,
+            "variants_by_{}".format(self.variant_shards),
+            "sars-cov-2_{}_{}_variants.csv".format(self.ticket, shard),
         )
-        if os.stat(varRep).st_size != 0:
-            with open(varRep) as f, open(varout, mode="w") as out:
-                variants = f.readlines()
-                varsummary = csv.writer(out)
-                varsummary.writerow(variants[0].strip().split(","))
-                for line in variants[1:]:
-                    line = line.strip().split(",")
-                    varsummary.writerow([line[0].split("_")[-1]] + line[1:])
-        else:
-            try:
-                open(varout, "a").close()
-            except Exception as e:
-                print("Failed creating file {}\n{}".format(varout, e))
+
+    def json_outputs(self):
+        """Artic json files written in the configured json format"""
+        outputs = []
+        if self.json_format in ("json", "both"):
+            outputs.append("{}/{}_artic.json".format(self.indir, self.ticket))
+        if self.json_format in ("jsonl", "both"):
+            jsonl = "{}/{}_artic.jsonl".format(self.indir, self.ticket)
+            outputs.extend([jsonl, index_path(jsonl)])
+        return outputs
 
     def create_jsonfile(self):
         """Output all result data in a json format for easy parsing"""
@@ -209,10 +412,143 @@ class ReportSC2:
             print("No artic results loaded. Quitting create_jsonfile")
             sys.exit(-1)
 
-        with open(
-            "{}/{}_artic.json".format(self.indir, self.ticket, self.today), "w"
-        ) as outfile:
-            json.dump(self.articdata, outfile)
+        if self.json_format in ("json", "both"):
+            with open(
+                "{}/{}_artic.json".format(self.indir, self.ticket, self.today), "w"
+            ) as outfile:
+                json.dump(self.articdata, outfile)
+        if self.json_format in ("jsonl", "both"):
+            with JsonlWriter("{}/{}_artic.jsonl".format(self.indir, self.ticket)) as outfile:
+                for sample, data in self.articdata.items():
+                    outfile.write(sample, data)
+
+    def load_warehouse(self):
+        """Upserts the results of the case into the results warehouse, and leaves
+        a receipt of the load in the results directory"""
+        try:
+            with ResultsWarehouse(self.warehouse) as warehouse:
+                samples = warehouse.upsert(self.articdata, self.indir)
+        except (sqlite3.Error, OSError) as e:
+            log.warning("Unable to load results into warehouse {} ({})".format(self.warehouse, e))
+            return
+        log.info("Loaded {} samples into warehouse {}".format(samples, self.warehouse))
+        with open("{}/{}_warehouse.json".format(self.indir, self.ticket), "w") as out:
+            json.dump({"warehouse": self.warehouse, "samples": samples}, out, indent=2)
+
+    def create_streamed_reports(self):
+        """Writes the summary csv report, the artic json, the FoHM files and the
+        warehouse load from one merge-joined pass over the artic results and the
+        case config, holding one sample at a time. Samples are written in sample
+        ID order"""
+        qc, variants, pangolin = self.artic_paths()
+        consensus = None
+        if self.consensus_qc:
+            from mutant.modules.consensus_qc import consensus_metrics
+
+            consensus = consensus_metrics(self.consensus_paths(), self.workers)
+        samples = artic_samples(
+            qc,
+            variants,
+            pangolin,
+            self.caseinfo,
+            load_variant_index(self.regions_of_interest),
+            load_classifier(),
+            consensus=consensus,
+        )
+        summaryfile = os.path.join(self.indir, "sars-cov-2_{}_results.csv".format(self.ticket))
+        tmpfile = "{}.{}.tmp".format(summaryfile, os.getpid())
+        fohm = PartitionedWriter(
+            lambda regionlab: os.path.join(
+                self.indir, "{}_{}_komplettering.csv".format(regionlab, self.today)
+            ),
+            header="provnummer,urvalskriterium,GISAID_accession\n",
+            stream=True,
+        )
+        writers = []
+        warehouse = None
+        loaded = 0
+        batch = dict()
+        try:
+            for regionlab in self.regionlabs:
+                fohm.add_partition(regionlab)
+            if self.json_format in ("json", "both"):
+                writers.append(JsonWriter("{}/{}_artic.json".format(self.indir, self.ticket)))
+            if self.json_format in ("jsonl", "both"):
+                writers.append(JsonlWriter("{}/{}_artic.jsonl".format(self.indir, self.ticket)))
+            if self.warehouse:
+                warehouse = self.open_warehouse()
+            written = 0
+            mismatched = 0
+            with open(tmpfile, mode="w") as out:
+                summary = csv.writer(out)
+                summary.writerow(RESULT_HEADER)
+                for sample, data, records in samples:
+                    for record in records:
+                        fohm.add(
+                            record.regionlab,
+                            [record["Customer_ID_sample"], record["selection_criteria"]],
+                        )
+                    if data is None:
+                        continue
+                    written += 1
+                    if self.consensus_qc and data["consensus_qc_mismatch"] != "-":
+                        mismatched += 1
+                    summary.writerow(self.result_row(sample, data))
+                    for writer in writers:
+                        writer.write(sample, data)
+                    if warehouse is not None:
+                        batch[sample] = data
+                        if len(batch) == WAREHOUSE_BATCH:
+                            warehouse = self.upsert_batch(warehouse, batch)
+                            loaded += len(batch)
+                            batch = dict()
+            if written == 0:
+                print("No artic results loaded. Quitting create_streamed_reports")
+                sys.exit(-1)
+        except BaseException:
+            fohm.abort()
+            for writer in writers:
+                writer.abort()
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            if warehouse is not None:
+                warehouse.close()
+            raise
+        os.replace(tmpfile, summaryfile)
+        fohm.write()
+        for writer in writers:
+            writer.close()
+        self.log_consensus_mismatches(mismatched)
+
+        if warehouse is None:
+            return
+        if batch:
+            warehouse = self.upsert_batch(warehouse, batch)
+            loaded += len(batch)
+        if warehouse is None:
+            return
+        warehouse.close()
+        log.info("Loaded {} samples into warehouse {}".format(loaded, self.warehouse))
+        with open("{}/{}_warehouse.json".format(self.indir, self.ticket), "w") as out:
+            json.dump({"warehouse": self.warehouse, "samples": loaded}, out, indent=2)
+
+    def open_warehouse(self):
+        """The results warehouse, or None if it cannot be opened"""
+        try:
+            return ResultsWarehouse(self.warehouse)
+        except (sqlite3.Error, OSError) as e:
+            log.warning("Unable to load results into warehouse {} ({})".format(self.warehouse, e))
+            return None
+
+    def upsert_batch(self, warehouse, batch):
+        """Upserts a batch of samples. Returns the warehouse, or None after a failed load"""
+        try:
+            warehouse.upsert(batch, self.indir)
+        except (sqlite3.Error, OSError) as e:
+            log.warning("Unable to load results into warehouse {} ({})".format(self.warehouse, e))
+            warehouse.close()
+            return None
+        return warehouse
 
 
 
@@ -220,6 +556,34 @@ class ReportSC2:
         """ Loads articdata with data from various sources. Atm, artic output and the case          config input file """
         self.load_artic_results()
         self.load_case_config()
+        if self.consensus_qc:
+            self.load_consensus_qc()
+
+    def consensus_paths(self):
+        return consensus_files(
+            "{0}/ncovIllumina_sequenceAnalysis_makeConsensus".format(self.indir)
+        )
+
+    def load_consensus_qc(self):
+        """Adds the QC metrics recomputed from the consensus sequences to articdata,
+        cross-checked against the qc.csv values"""
+        from mutant.modules.consensus_qc import consensus_metrics, merge_metrics
+
+        metrics = dict(consensus_metrics(self.consensus_paths(), self.workers))
+        for sample, data in self.articdata.items():
+            merge_metrics(data, metrics.get(sample))
+        self.log_consensus_mismatches(
+            sum(data["consensus_qc_mismatch"] != "-" for data in self.articdata.values())
+        )
+
+    def log_consensus_mismatches(self, mismatched):
+        """Warns about samples whose qc.csv values disagree with their consensus"""
+        if mismatched:
+            log.warning(
+                "qc.csv disagrees with the consensus sequence of {} samples of {}".format(
+                    mismatched, self.case
+                )
+            )
 
     def load_case_config(self):
         """ Appends additional data to articdata dictionary """
@@ -227,37 +591,47 @@ class ReportSC2:
 
         packing = dict(zip(casekeys, "-"*len(casekeys)))
 
-        #Packs with keys. Time consuming but not really
+        #Packs with keys, then writes caseconfig data where relevant
         for k, v in self.articdata.items():
-            self.articdata[k].update(packing)
-        #Writes caseconfig data where relevant
-        for entry in self.caseinfo:
-            k = entry['Customer_ID_sample']
-            if k in self.articdata.keys():
-                self.articdata[k].update(entry)
+            v.update(packing)
+            entry = self.caseinfo.sample(k)
+            if entry is not None:
+                v.update(entry)
 
 
     def load_artic_results(self):
         """Parse artic output directory for analysis results. Returns dictionary data object        """
-        indir = self.indir
-        voc_pos = range(475, 486)
-        muts = pandas.read_csv("{0}/standalone/spike_mutations.csv".format(WD), sep=",")
-        # Magical unpacking into single list
-        voc_pos_aa = sum(muts.values.tolist(), [])
+        variant_index = load_variant_index(self.regions_of_interest)
 
-        classifications = pandas.read_csv("{0}/standalone/classifications.csv".format(WD), sep=",")
-        voc_strains = { 'lineage':'','spike':'','class':''}
-        voc_strains['lineage'] = classifications['lineage'].tolist()
-        voc_strains['spike'] = classifications['spike'].tolist()
-        voc_strains['class'] = classifications['class'].tolist()
+        classifier = load_classifier()
 
         #voc_pos_aa = get_json("{0}/standalone/voc_strains.json".format(WD))['voc_pos_aa']
         #voc_strains = get_json("{0}/standalone/voc_strains.json".format(WD))['voc_strains']
 
-        artic_data = dict()
-        var_all = dict()
-        var_voc = dict()
+        paths = self.artic_paths()
+
+        if self.engine == "pandas":
+            from mutant.modules.artic_tables import load_artic_tables
+
+            artic_data, var_voc = load_artic_tables(
+                paths[0], paths[1], self.pangolin_rows(paths[2]), variant_index
+            )
+        else:
+            artic_data, var_voc = self.parse_artic_files(paths, variant_index)
+
+        #Classification
+        for key, vals in artic_data.items():
+            artic_data[key].update(
+                {"VOC": classifier.classify(vals["lineage"], var_voc.get(key, ()))}
+            )
+
 
+
+        self.articdata.update(artic_data)
+
+    def artic_paths(self):
+        """Paths of the qc, variant and pangolin reports of the artic output directory"""
+        indir = self.indir
         # Files of interest. ONLY ADD TO END OF THIS LIST
         files = [
             "*qc.csv",
@@ -280,41 +654,44 @@ class ReportSC2:
             except Exception as e:
                 print("Unable to find {0} in {1} ({2})".format(f, indir, e))
                 sys.exit(-1)
+        return paths
+
+    def pangolin_rows(self, path):
+        """Pangolin data rows. Taken from the index of create_concat_pangolin
+        if available, otherwise parsed from the merged pangolin file"""
+        if self.pangolin_index is not None:
+            return list(self.pangolin_index.values())
+        with open(path) as f:
+            content = csv.reader(f)
+            next(content)
+            return list(content)
+
+    def parse_artic_files(self, paths, variant_index):
+        """Line by line parsing of the qc, variant and pangolin reports.
+        Returns per sample data and variants of interest per sample"""
+        artic_data = dict()
+        var_all = dict()
+        var_voc = dict()
 
         # Parse qc report data
         with open(paths[0]) as f:
             content = csv.reader(f)
             next(content)
             for line in content:
-                sample = line[0].split("_")[-1]
-                if float(line[2]) > 95:
-                    qc_flag = "TRUE"
-                else:
-                    qc_flag = "FALSE"
-                artic_data[sample] = {
-                    "pct_n_bases": line[1],
-                    "pct_10X_bases": line[2],
-                    "longest_no_N_run": line[3],
-                    "num_aligned_reads": line[4],
-                    "artic_qc": line[7],
-                    "qc": qc_flag,
-                }
+                artic_data[qc_sample(line)] = qc_values(line)
         # Parse Pangolin report data
-        with open(paths[2]) as f:
-            content = csv.reader(f)
-            next(content)
-            for line in content:
-                sample = line[0].split(".")[0].split("_")[-1]
-                lineage = line[1]
+        for line in self.pangolin_rows(paths[2]):
+            sample = line[0].split(".")[0].split("_")[-1]
+            lineage = line[1]
 
-                artic_data[sample].update(
-                    {
-                        "lineage": lineage,
-                        "pangolin_probability": line[2],
-                        "pangoLEARN_version": line[3],
-                        "pangolin_qc": line[4],
-                    }
-                )
+            artic_data[sample].update(
+                {
+                    "lineage": lineage,
+                    "pangolin_probability": line[2],
+                    "pangoLEARN_version": line[3],
+                    "pangolin_qc": line[4],
+                }
+            )
 
         # Parse Variant report data
         if os.stat(paths[1]).st_size != 0:
@@ -324,8 +701,7 @@ class ReportSC2:
                 for line in content:
                     sample = line[0].split("_")[-1]
                     variant = line[2]
-                    pos = int(re.findall(r"\d+", variant)[0])
-                    if (pos in voc_pos) or (variant in voc_pos_aa):
+                    if variant_index.matches(line[1], variant):
                         append_dict(var_voc, sample, variant)
                     append_dict(var_all, sample, variant)
         # Add variant data to results
@@ -350,30 +726,15 @@ class ReportSC2:
                 else:
                     artic_data[sample].update({"variants": "-"})
 
-
-        #Classification
-        for key, vals in artic_data.items():
-            #Packing
-            artic_data[key].update( {"VOC": "No" } )
-
-            #Check for lineage
-            if artic_data[key]["lineage"] == "None":
-                artic_data[key].update( {"VOC":"-"})
-            elif artic_data[key]["lineage"] in voc_strains['lineage']:
-                index = voc_strains['lineage'].index(artic_data[key]['lineage'])
-                #Check for spike
-                if pandas.isna(voc_strains['spike'][index]) or voc_strains['spike'][index] in artic_data[key]['VOC_aa']:
-                    artic_data[key].update( {"VOC":voc_strains['class'][index]} )
-
-
-
-        self.articdata.update(artic_data)
+        return artic_data, var_voc
 
     def create_deliveryfile(self):
 
         """Create deliverables file"""
 
         deliv = {"files": []}
+        from mutant.modules.deliverables_verify import write_deliverables
+
         delivfile = "{}/{}_deliverables.yaml".format(self.indir, self.case)
 
         ## Per Case
@@ -401,6 +762,18 @@ class ReportSC2:
             }
         )
 
+        # Mutation counts
+        deliv["files"].append(
+            {
+                "format": "csv",
+                "id": self.case,
+                "path": self.mutation_counts_path(),
+                "path_index": "~",
+                "step": "report",
+                "tag": "ks-mutation-counts",
+            }
+        )
+
         # Pangolin typing
         deliv["files"].append(
             {
@@ -483,16 +856,30 @@ class ReportSC2:
         #)
 
         # Artic Json (Vogue) data
-        deliv["files"].append(
-            {
-                "format": "json",
-                "id": self.case,
-                "path": "{}/{}_artic.json".format(self.indir, self.ticket),
-                "path_index": "~",
-                "step": "result_aggregation",
-                "tag": "artic-json",
-            }
-        )
+        if self.json_format in ("json", "both"):
+            deliv["files"].append(
+                {
+                    "format": "json",
+                    "id": self.case,
+                    "path": "{}/{}_artic.json".format(self.indir, self.ticket),
+                    "path_index": "~",
+                    "step": "result_aggregation",
+                    "tag": "artic-json",
+                }
+            )
+        # Artic JSON Lines data, one sample per line
+        if self.json_format in ("jsonl", "both"):
+            jsonl = "{}/{}_artic.jsonl".format(self.indir, self.ticket)
+            deliv["files"].append(
+                {
+                    "format": "jsonl",
+                    "id": self.case,
+                    "path": jsonl,
+                    "path_index": index_path(jsonl),
+                    "step": "result_aggregation",
+                    "tag": "artic-jsonl",
+                }
+            )
         # Provided CG CASE info from StatusDB
         deliv["files"].append(
             {
@@ -557,6 +944,18 @@ class ReportSC2:
                     "tag": "SARS-CoV-2-info",
                 }
             )
+            # Region split KS Aux report
+            if self.variant_shards == "regionlab":
+                deliv["files"].append(
+                    {
+                        "format": "csv",
+                        "id": self.case,
+                        "path": self.variant_shard_path(rl),
+                        "path_index": "~",
+                        "step": "report",
+                        "tag": "ks-aux-results-regionlab",
+                    }
+                )
 
         # Per sample
         for record in self.caseinfo:
@@ -589,6 +988,18 @@ class ReportSC2:
                     "tag": "reverse-reads",
                 }
             )
+            # Sample split KS Aux report
+            if self.variant_shards == "sample":
+                deliv["files"].append(
+                    {
+                        "format": "csv",
+                        "id": sampleID,
+                        "path": self.variant_shard_path(sample),
+                        "path_index": "~",
+                        "step": "report",
+                        "tag": "ks-aux-results-sample",
+                    }
+                )
 
             ## Commenting these to save space in CG. Can be reenabled dynamically
 
@@ -632,5 +1043,4 @@ class ReportSC2:
             #    }
             #)
 
-        with open(delivfile, "w") as out:
-            yaml.dump(deliv, out)
+        write_deliverables(deliv, delivfile)
@@ -2,12 +2,18 @@
     and creates a deliverables file for Clinical Genomics Infrastructure"""
 
 import os
+import re
 import sys
 import click
+import csv
+import hashlib
 import json
-import subprocess
 from mutant import version, log
 from mutant.modules.generic_parser import get_json
+from mutant.modules.profiling import profiled
+from mutant.modules.run_monitor import run_command
+
+RUN_INFO = "mutant_run.json"
 
 
 class RunSC2:
@@ -38,18 +44,134 @@ class RunSC2:
             resdir = os.path.abspath("results")
         return resdir
 
-    def run_case(self, resdir):
+    def input_fingerprint(self):
+        """Checksum of the names and sizes of all files in the input folder"""
+        listing = []
+        for root, dirs, files in os.walk(self.fastq):
+            for name in files:
+                path = os.path.join(root, name)
+                listing.append("{}\t{}".format(os.path.relpath(path, self.fastq), os.path.getsize(path)))
+        return hashlib.md5("\n".join(sorted(listing)).encode()).hexdigest()
+
+    def find_previous_run(self, resdir):
+        """Most recent results directory next to resdir that analysed the same
+        case and input set. Returns its run info, or None"""
+        parent = os.path.dirname(os.path.abspath(resdir))
+        fingerprint = self.input_fingerprint()
+        candidates = []
+        if not os.path.isdir(parent):
+            return None
+        with os.scandir(parent) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.path == os.path.abspath(resdir):
+                    continue
+                if not entry.name.startswith("{}_".format(self.case)):
+                    continue
+                info_file = os.path.join(entry.path, RUN_INFO)
+                try:
+                    with open(info_file) as f:
+                        info = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if info.get("case") == self.case and info.get("input_fingerprint") == fingerprint:
+                    candidates.append((os.stat(info_file).st_mtime, entry.path, info))
+        if not candidates:
+            return None
+        mtime, path, info = max(candidates)
+        info["results_dir"] = path
+        return info
+
+    def write_run_info(self, resdir, workdir, launch_dir, resumed_from=None):
+        info = {
+            "case": self.case,
+            "input_folder": os.path.abspath(self.fastq),
+            "input_fingerprint": self.input_fingerprint(),
+            "work_dir": workdir,
+            "launch_dir": os.path.abspath(launch_dir or os.getcwd()),
+            "session": None,
+            "resumed_from": resumed_from,
+        }
+        os.makedirs(resdir, exist_ok=True)
+        with open(os.path.join(resdir, RUN_INFO), "w") as out:
+            json.dump(info, out, indent=2)
+        return info
+
+    def record_session(self, resdir, nflog):
+        """Stores the nextflow session id of the run, needed to resume it"""
+        info_file = os.path.join(resdir, RUN_INFO)
+        session = None
+        try:
+            with open(nflog) as f:
+                for line in f:
+                    hit = re.search(r"Session uuid: ([0-9a-f-]{36})", line)
+                    if hit:
+                        session = hit.group(1)
+                        break
+        except OSError:
+            return
+        info = get_json(info_file)
+        info["session"] = session
+        with open(info_file, "w") as out:
+            json.dump(info, out, indent=2)
 
-        """Run SARS-CoV-2 analysis"""
+    def carry_cached_tasks(self, previous_resdir, resdir):
+        """Replaces the CACHED rows of the new execution trace with the rows of the
+        run that computed them, keeping job ids and metrics of cached tasks"""
+        new_trace = os.path.join(resdir, "pipeline_info", "execution_trace.txt")
+        old_trace = os.path.join(previous_resdir, "pipeline_info", "execution_trace.txt")
+        if not (os.path.exists(new_trace) and os.path.exists(old_trace)):
+            return 0
+        with open(old_trace) as f:
+            previous = {row["hash"]: row for row in csv.DictReader(f, delimiter="\t") if row.get("hash")}
+        with open(new_trace) as f:
+            content = csv.DictReader(f, delimiter="\t")
+            header = content.fieldnames
+            rows = list(content)
+        carried = 0
+        for row in rows:
+            if row.get("status") == "CACHED" and row.get("hash") in previous:
+                old = previous[row["hash"]]
+                row.update({key: old[key] for key in header if key in old and key != "status"})
+                carried += 1
+        with open(new_trace, "w") as out:
+            writer = csv.DictWriter(out, fieldnames=header, delimiter="\t", lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(rows)
+        log.info("Carried {} cached tasks from {} into the execution trace".format(carried, previous_resdir))
+        return carried
+
+    @profiled("run")
+    def run_case(self, resdir, launch_dir=None, resume_from=None, status_file=None, interval=30):
+
+        """Run SARS-CoV-2 analysis. Returns the exit code of nextflow.
+        launch_dir sets the working directory of nextflow (and thereby its .nextflow cache).
+        resume_from is the run info of a previous run whose work directory is reused.
+        Progress is logged (and written to status_file) every interval seconds"""
 
         resultsline = "--outdir {}".format(resdir)
-        workline = "-work-dir {}".format(os.path.join(resdir, "work"))
+        workdir = os.path.join(resdir, "work")
+        workline = "-work-dir {}".format(workdir)
+        if resume_from is not None:
+            # Resumed runs keep using the work directory of the run they resumed
+            workdir = resume_from.get("work_dir") or os.path.join(resume_from["results_dir"], "work")
+            workline = "-work-dir {} -resume".format(workdir)
+            if resume_from.get("session"):
+                workline = "{} {}".format(workline, resume_from["session"])
+            if launch_dir is None:
+                launch_dir = resume_from["launch_dir"]
+            log.info("Resuming from {}".format(resume_from["results_dir"]))
+        self.write_run_info(
+            resdir,
+            workdir,
+            launch_dir,
+            resume_from["results_dir"] if resume_from is not None else None,
+        )
         nflog = os.path.join(resdir, "nextflow.log")
         confline = ""
         if self.config_artic != "":
             confline = "-C {0}".format(self.config_artic)
 
-        cmd = "nextflow {0} -log {1} run {2} {3}/externals/gms-artic/main.nf -profile {4} --illumina --prefix {5} " "--directory {6} {7}".format(
+        cmd = "nextflow {0} -log {1} run -ansi-log false {2} {3}/externals/gms-artic/main.nf -profile {4} --illumina --prefix {5} " "--directory {6} {7}".format(
             confline,
             nflog,
             workline,
@@ -60,7 +182,15 @@ class RunSC2:
             resultsline,
         )
         log.debug("Command ran: {}".format(cmd))
-        proc = subprocess.Popen(cmd.split())
-        out, err = proc.communicate()
-        log.info(out)
-        log.info(err)
+        returncode = run_command(
+            cmd.split(),
+            self.case,
+            os.path.join(resdir, "pipeline_info", "execution_trace.txt"),
+            cwd=launch_dir,
+            status_file=status_file,
+            interval=interval,
+        )
+        self.record_session(resdir, nflog)
+        if resume_from is not None:
+            self.carry_cached_tasks(resume_from["results_dir"], resdir)
+        return returncode
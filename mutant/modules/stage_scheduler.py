@@ -0,0 +1,122 @@
+""" Runs interdependent stages (callables) in a thread pool. A stage is
+    started as soon as all stages it requires have finished. The first
+    failing stage stops the scheduling of new stages and its exception is
+    re-raised once the running stages have finished.
+    With a FingerprintCache, stages whose outputs are up to date with their
+    inputs are skipped, as are stages without outputs that no rerun stage needs.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from mutant import log
+
+
+class Stage:
+    __slots__ = ("name", "func", "requires", "inputs", "outputs")
+
+    def __init__(self, name, func, requires=(), inputs=(), outputs=None):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.inputs = list(inputs)
+        # None marks stages that only produce in-memory results
+        self.outputs = None if outputs is None else list(outputs)
+
+
+class StageScheduler:
+    def __init__(self, workers=4, cache=None, force=False):
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.force = force
+        self.stages = dict()
+        self.timings = dict()
+
+    def add(self, name, func, requires=(), inputs=(), outputs=None):
+        """Adds a stage. Stages may only require stages that were added before them.
+        inputs/outputs are the files a cached stage reads and writes"""
+        for required in requires:
+            if required not in self.stages:
+                raise ValueError("Stage {} requires unknown stage {}".format(name, required))
+        self.stages[name] = Stage(name, func, requires, inputs, outputs)
+
+    def timed(self, stage):
+        start = time.perf_counter()
+        snapshot = None
+        if self.cache is not None and stage.outputs is not None:
+            snapshot = self.cache.snapshot(stage.inputs)
+        stage.func()
+        if snapshot is not None:
+            self.cache.record(stage.name, snapshot, stage.outputs)
+        self.timings[stage.name] = time.perf_counter() - start
+        log.info("Stage {} finished in {:.2f}s".format(stage.name, self.timings[stage.name]))
+
+    def stale_stages(self):
+        """Names of the stages that have to run"""
+        if self.cache is None or self.force:
+            return set(self.stages)
+        stale = set()
+        # Cached stages run when out of date, or when a cached stage upstream runs
+        upstream = dict()
+        for stage in self.stages.values():
+            upstream[stage.name] = set()
+            for required in stage.requires:
+                if self.stages[required].outputs is None:
+                    upstream[stage.name] |= upstream[required]
+                else:
+                    upstream[stage.name].add(required)
+            if stage.outputs is None:
+                continue
+            if upstream[stage.name] & stale or not self.cache.is_fresh(
+                stage.name, stage.inputs, stage.outputs
+            ):
+                stale.add(stage.name)
+        # In-memory stages run when a stage that runs needs them
+        for stage in reversed(list(self.stages.values())):
+            if stage.outputs is not None:
+                continue
+            dependents = [other for other in self.stages.values() if stage.name in other.requires]
+            if not dependents or any(other.name in stale for other in dependents):
+                stale.add(stage.name)
+        return stale
+
+    def run(self):
+        """Runs all stages. Returns the wall-clock time of each stage"""
+        start = time.perf_counter()
+        stale = self.stale_stages()
+        for name in self.stages:
+            if name not in stale:
+                log.info("Stage {} is up to date, skipping".format(name))
+        done = set(self.stages) - stale
+        waiting = [stage for stage in self.stages.values() if stage.name in stale]
+        running = dict()
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while waiting or running:
+                if failure is None:
+                    for stage in list(waiting):
+                        if all(required in done for required in stage.requires):
+                            waiting.remove(stage)
+                            running[pool.submit(self.timed, stage)] = stage
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    if future.exception() is not None:
+                        if self.cache is not None:
+                            self.cache.forget(stage.name)
+                        if failure is None:
+                            failure = future.exception()
+                            log.error("Stage {} failed: {}".format(stage.name, failure))
+                    else:
+                        done.add(stage.name)
+        if self.cache is not None:
+            self.cache.save()
+        if failure is not None:
+            raise failure
+        log.info("All stages finished in {:.2f}s".format(time.perf_counter() - start))
+        return self.timings
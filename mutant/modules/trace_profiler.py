@@ -0,0 +1,298 @@
+""" Parses the nextflow execution trace (pipeline_info/execution_trace.txt)
+    into typed task records, and summarises where the wall-clock time of a
+    run went: critical path, slowest processes, CPU efficiency per label,
+    memory headroom per process, and time spent queued versus running.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import bisect
+import csv
+import json
+import os
+import re
+import statistics
+
+from datetime import datetime
+
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+MEMORY_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+DURATION_PATTERN = re.compile(r"([\d.]+)\s*(ms|s|m|h|d)")
+FINISHED = ("COMPLETED", "FAILED", "ABORTED")
+
+
+def parse_duration(value):
+    """Seconds of a nextflow duration such as '1h 2m 3s' or '250ms'"""
+    if value in ("", "-", None):
+        return None
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_memory(value):
+    """Bytes of a nextflow memory value such as '1.5 GB'"""
+    if value in ("", "-", None):
+        return None
+    number, _, unit = value.strip().partition(" ")
+    try:
+        return float(number) * MEMORY_UNITS.get(unit.upper() or "B", 1)
+    except ValueError:
+        return None
+
+
+def parse_percent(value):
+    if value in ("", "-", None):
+        return None
+    try:
+        return float(value.rstrip("%"))
+    except ValueError:
+        return None
+
+
+def parse_timestamp(value):
+    """Epoch seconds of a nextflow timestamp such as '2021-05-01 10:00:00.000'"""
+    if value in ("", "-", None):
+        return None
+    for pattern in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(value, pattern).timestamp()
+        except ValueError:
+            continue
+    try:
+        return float(value) / 1000
+    except ValueError:
+        return None
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TraceTask:
+    """One row of the execution trace. Fields missing from the trace are None"""
+
+    __slots__ = (
+        "task_id",
+        "hash",
+        "native_id",
+        "name",
+        "process",
+        "tag",
+        "label",
+        "status",
+        "exit",
+        "submit",
+        "duration",
+        "realtime",
+        "cpu_pct",
+        "peak_rss",
+        "peak_vmem",
+        "rchar",
+        "wchar",
+        "cpus",
+        "memory",
+    )
+
+    def __init__(self, row):
+        get = row.get
+        self.task_id = get("task_id")
+        self.hash = get("hash")
+        self.native_id = get("native_id")
+        self.name = get("name", "")
+        process, _, tag = self.name.partition(" (")
+        self.process = get("process") or process
+        self.tag = get("tag") or tag.rstrip(")") or None
+        # Nextflow traces carry no label field, so unlabelled tasks are
+        # grouped under their process
+        self.label = get("label") or self.process
+        self.status = get("status")
+        self.exit = parse_int(get("exit"))
+        self.submit = parse_timestamp(get("submit"))
+        self.duration = parse_duration(get("duration"))
+        self.realtime = parse_duration(get("realtime"))
+        self.cpu_pct = parse_percent(get("%cpu"))
+        self.peak_rss = parse_memory(get("peak_rss"))
+        self.peak_vmem = parse_memory(get("peak_vmem"))
+        self.rchar = parse_memory(get("rchar"))
+        self.wchar = parse_memory(get("wchar"))
+        self.cpus = parse_int(get("cpus"))
+        self.memory = parse_memory(get("memory"))
+
+    @property
+    def complete(self):
+        if self.submit is None or self.duration is None:
+            return None
+        return self.submit + self.duration
+
+    @property
+    def queued(self):
+        if self.duration is None or self.realtime is None:
+            return None
+        return max(0.0, self.duration - self.realtime)
+
+
+def parse_trace_line(header, line):
+    """Task of a single trace line, given the split header line"""
+    return TraceTask(dict(zip(header, line.rstrip("\n").split("\t"))))
+
+
+def read_trace(path):
+    """Streams the tasks of a trace file"""
+    with open(path) as trace:
+        header = trace.readline().rstrip("\n").split("\t")
+        for line in trace:
+            if line.strip():
+                yield parse_trace_line(header, line)
+
+
+def latest_before(tasks, completes, current):
+    """Latest completed of tasks (ordered on complete, with completes their
+    complete times) that finished by and was submitted before current"""
+    index = bisect.bisect_right(completes, current.submit + 1)
+    latest = None
+    for i in range(index - 1, -1, -1):
+        if latest is not None and completes[i] < latest.complete:
+            break
+        # Submitted strictly earlier, so the walk always terminates. Ties go to
+        # the task first in the trace
+        if tasks[i].submit < current.submit:
+            latest = tasks[i]
+    return latest
+
+
+def critical_path(tasks):
+    """Chain of tasks ending with the last one to complete, where every task
+    is preceded by the latest task completed before it was submitted
+    (preferring tasks of the same sample)"""
+    timed = sorted(
+        (task for task in tasks if task.complete is not None), key=lambda task: task.complete
+    )
+    if not timed:
+        return []
+    completes = [task.complete for task in timed]
+    by_tag = dict()
+    for task in timed:
+        by_tag.setdefault(task.tag, []).append(task)
+    tag_completes = {
+        tag: [task.complete for task in members] for tag, members in by_tag.items()
+    }
+    path = [timed[-1]]
+    while True:
+        current = path[-1]
+        previous = latest_before(by_tag[current.tag], tag_completes[current.tag], current)
+        if previous is None:
+            previous = latest_before(timed, completes, current)
+        if previous is None:
+            break
+        path.append(previous)
+    return list(reversed(path))
+
+
+def cpu_efficiencies(tasks):
+    """Share of the requested CPUs used by each task"""
+    return [task.cpu_pct / (100 * (task.cpus or 1)) for task in tasks if task.cpu_pct is not None]
+
+
+def summarise(tasks, top=10):
+    """Performance summary of a run, as json serialisable dictionaries"""
+    tasks = list(tasks)
+    finished = [task for task in tasks if task.status in FINISHED]
+    statuses = dict()
+    for task in tasks:
+        statuses[task.status] = statuses.get(task.status, 0) + 1
+
+    processes = dict()
+    labels = dict()
+    for task in finished:
+        processes.setdefault(task.process, []).append(task)
+        labels.setdefault(task.label, []).append(task)
+
+    per_process = []
+    for process, members in sorted(processes.items()):
+        realtimes = [task.realtime for task in members if task.realtime is not None]
+        queued = [task.queued for task in members if task.queued is not None]
+        efficiencies = cpu_efficiencies(members)
+        rss = [task.peak_rss for task in members if task.peak_rss is not None]
+        headroom = [
+            task.memory - task.peak_rss
+            for task in members
+            if task.memory is not None and task.peak_rss is not None
+        ]
+        per_process.append(
+            {
+                "process": process,
+                "tasks": len(members),
+                "failed": sum(1 for task in members if task.status != "COMPLETED"),
+                "realtime_total_s": sum(realtimes),
+                "realtime_mean_s": statistics.mean(realtimes) if realtimes else None,
+                "realtime_max_s": max(realtimes) if realtimes else None,
+                "queued_total_s": sum(queued),
+                "cpu_efficiency_mean": statistics.mean(efficiencies) if efficiencies else None,
+                "peak_rss_max_bytes": max(rss) if rss else None,
+                "memory_headroom_min_bytes": min(headroom) if headroom else None,
+                "read_bytes": sum(task.rchar or 0 for task in members),
+                "written_bytes": sum(task.wchar or 0 for task in members),
+            }
+        )
+
+    per_label = dict()
+    for label, members in sorted(labels.items()):
+        efficiencies = cpu_efficiencies(members)
+        per_label[label] = statistics.mean(efficiencies) if efficiencies else None
+
+    submits = [task.submit for task in finished if task.submit is not None]
+    completes = [task.complete for task in finished if task.complete is not None]
+    path = critical_path(finished)
+    slowest = sorted(
+        (task for task in finished if task.realtime is not None),
+        key=lambda task: task.realtime,
+        reverse=True,
+    )[:top]
+    summary = {
+        "tasks": len(tasks),
+        "statuses": statuses,
+        "wall_clock_s": (max(completes) - min(submits)) if submits and completes else None,
+        "running_total_s": sum(task.realtime or 0 for task in finished),
+        "queued_total_s": sum(task.queued or 0 for task in finished),
+        "critical_path_s": (path[-1].complete - path[0].submit) if path else None,
+        "critical_path": [
+            {"name": task.name, "queued_s": task.queued, "realtime_s": task.realtime}
+            for task in path
+        ],
+        "slowest_tasks": [
+            {"name": task.name, "realtime_s": task.realtime, "queued_s": task.queued}
+            for task in slowest
+        ],
+        "cpu_efficiency_per_label": per_label,
+        "slowest_processes": [
+            entry["process"]
+            for entry in sorted(per_process, key=lambda entry: entry["realtime_total_s"], reverse=True)[:top]
+        ],
+    }
+    return summary, per_process
+
+
+def write_performance_report(indir):
+    """Writes pipeline_info/performance_summary.json and performance_processes.csv.
+    Returns False if the run has no trace"""
+    info_dir = os.path.join(indir, "pipeline_info")
+    trace = os.path.join(info_dir, "execution_trace.txt")
+    if not os.path.exists(trace):
+        return False
+    summary, per_process = summarise(read_trace(trace))
+    with open(os.path.join(info_dir, "performance_summary.json"), "w") as out:
+        json.dump(summary, out, indent=2)
+    with open(os.path.join(info_dir, "performance_processes.csv"), "w") as out:
+        columns = list(per_process[0].keys()) if per_process else ["process"]
+        writer = csv.DictWriter(out, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(per_process)
+    return True
@@ -0,0 +1,117 @@
+""" Decides which variants of the artic variant summary are of interest. The
+    regions of interest (gene and position intervals) and the named mutations
+    are read from standalone/regions_of_interest.json. Regions are compiled
+    into a position mask per gene and named mutations into a set, so a lookup
+    costs the same however many regions are configured.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import os
+import re
+
+from functools import lru_cache
+
+from mutant import WD
+from mutant.modules.generic_parser import get_json
+
+REGIONS_OF_INTEREST = "{0}/standalone/regions_of_interest.json".format(WD)
+ANY_GENE = "*"
+# Reference residue(s) or ins/del prefix, first position, remainder. E.g. N501Y, H69del, ins679GIAL
+VARIANT_PATTERN = re.compile(r"^(\D*)(\d+)(.*)$")
+
+_indexes = dict()
+
+
+class Variant:
+    __slots__ = ("gene", "ref", "pos", "alt", "name")
+
+    def __init__(self, gene, ref, pos, alt, name):
+        self.gene = gene
+        self.ref = ref
+        self.pos = pos
+        self.alt = alt
+        self.name = name
+
+
+@lru_cache(maxsize=None)
+def parse_variant(gene, name):
+    """Variant record of a variant summary entry. pos is None if name has no position"""
+    hit = VARIANT_PATTERN.match(name)
+    if hit is None:
+        return Variant(gene, name, None, "", name)
+    ref, pos, alt = hit.groups()
+    return Variant(gene, ref, int(pos), alt, name)
+
+
+class VariantIndex:
+    def __init__(self, regions=(), named=(), sources=()):
+        """regions: (gene, start, end) intervals, inclusive. named: mutation names,
+        optionally gene qualified as gene:name"""
+        self.masks = dict()
+        for gene, start, end in regions:
+            mask = self.masks.setdefault(gene, bytearray())
+            if len(mask) <= end:
+                mask.extend(bytes(end + 1 - len(mask)))
+            mask[start : end + 1] = b"\x01" * (end + 1 - start)
+        self.named = set()
+        for name in named:
+            gene, _, mutation = name.rpartition(":")
+            self.named.add((gene or ANY_GENE, mutation))
+        # Files the index was built from
+        self.sources = list(sources)
+
+    @classmethod
+    def from_config(cls, path=REGIONS_OF_INTEREST):
+        config = get_json(path)
+        regions = [
+            (region["gene"], int(region["start"]), int(region["end"]))
+            for region in config.get("regions", [])
+        ]
+        named = []
+        sources = [path]
+        for listing in config.get("named_mutations", []):
+            listing = os.path.join(os.path.dirname(path), listing)
+            sources.append(listing)
+            with open(listing) as f:
+                content = csv.reader(f)
+                next(content)
+                named.extend(line[0].strip() for line in content if line and line[0].strip())
+        return cls(regions, named, sources)
+
+    def in_region(self, gene, pos):
+        if pos is None:
+            return False
+        for key in (gene, ANY_GENE):
+            mask = self.masks.get(key)
+            if mask is not None and pos < len(mask) and mask[pos]:
+                return True
+        return False
+
+    def of_interest(self, variant):
+        return (
+            self.in_region(variant.gene, variant.pos)
+            or (ANY_GENE, variant.name) in self.named
+            or (variant.gene, variant.name) in self.named
+        )
+
+    def matches(self, gene, name):
+        return self.of_interest(parse_variant(gene, name))
+
+
+def load_variant_index(path=REGIONS_OF_INTEREST):
+    """Returns the index of a regions of interest config, memoised per process
+    and rebuilt when the config or its mutation lists change"""
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+    index = _indexes.get(key)
+    if index is not None and all(
+        os.stat(source).st_mtime_ns == mtime for source, mtime in index[1]
+    ):
+        return index[0]
+    variant_index = VariantIndex.from_config(path)
+    _indexes[key] = (
+        variant_index,
+        [(source, os.stat(source).st_mtime_ns) for source in variant_index.sources],
+    )
+    return variant_index
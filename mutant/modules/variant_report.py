@@ -0,0 +1,118 @@
+""" Rewrites the artic variant summary into the customer variant report, one
+    chunk of rows at a time. Rows can also be split into one report per
+    region-lab or per sample, and the occurrences of every mutation are counted
+    in the same pass.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import io
+import itertools
+import os
+
+from collections import Counter
+
+from mutant.modules.partitioned_writer import PartitionedWriter
+
+SHARD_MODES = ["regionlab", "sample"]
+# Rows read and written per chunk
+CHUNK_ROWS = 10000
+# Shard files kept open at the same time, others are reopened when needed
+MAX_OPEN_SHARDS = 64
+COUNTS_HEADER = ["gene", "variant", "count"]
+
+
+def csv_line(row):
+    """A row formatted the way csv.writer writes it"""
+    out = io.StringIO()
+    csv.writer(out).writerow(row)
+    return out.getvalue()
+
+
+def shard_key(mode, name, caseinfo=None):
+    """Region-lab or customer sample ID of a variant summary sample name.
+    The region-lab is taken from the case config when the sample is in it"""
+    sample = name.split("_")[-1]
+    if mode == "sample":
+        return sample
+    record = caseinfo.sample(sample) if caseinfo is not None else None
+    if record is not None:
+        return record.regionlab
+    return name.rpartition("_")[0]
+
+
+def write_variant_report(
+    source, output, counts=None, shard_mode="", shard_path=None, shards=(), caseinfo=None
+):
+    """Writes the rows of the variant summary source to output, with sample
+    names reduced to the customer sample ID. source may be None.
+    counts: path of the table of occurrences per mutation, optional.
+    shard_mode: "regionlab" or "sample" to also write one report per shard, to
+    shard_path(shard). shards: shards written even without rows.
+    Returns the number of variant rows"""
+    rows = 0
+    mutations = Counter()
+    tmpfile = "{}.{}.tmp".format(output, os.getpid())
+    splitter = None
+    try:
+        # A missing variant summary gives empty reports
+        with open(source, newline="") if source else io.StringIO() as f, open(
+            tmpfile, "w", newline=""
+        ) as out:
+            content = csv.reader(f)
+            header = next(content, None)
+            if shard_mode:
+                splitter = PartitionedWriter(
+                    shard_path,
+                    header=csv_line(header) if header is not None else "",
+                    stream=True,
+                    max_open=MAX_OPEN_SHARDS,
+                )
+                for shard in shards:
+                    splitter.add_partition(shard)
+            if header is not None:
+                report = csv.writer(out)
+                report.writerow(header)
+                while True:
+                    chunk = [line for line in itertools.islice(content, CHUNK_ROWS) if line]
+                    if not chunk:
+                        break
+                    reported = [[line[0].split("_")[-1]] + line[1:] for line in chunk]
+                    report.writerows(reported)
+                    # Gene and variant are the second and third columns, as for
+                    # the other readers of the variant summary
+                    for line in chunk:
+                        mutations[(line[1], line[2])] += 1
+                    if splitter is not None:
+                        # Rows of a sample are adjacent, look up each name once
+                        shard_of = dict()
+                        for line, row in zip(chunk, reported):
+                            name = line[0]
+                            if name not in shard_of:
+                                shard_of[name] = shard_key(shard_mode, name, caseinfo)
+                            splitter.add(shard_of[name], row)
+                    rows += len(chunk)
+        if splitter is not None:
+            splitter.write()
+        os.replace(tmpfile, output)
+    except BaseException:
+        if splitter is not None:
+            splitter.abort()
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    if counts is not None:
+        write_mutation_counts(mutations, counts)
+    return rows
+
+
+def write_mutation_counts(mutations, path):
+    """Mutation counts, most frequent first"""
+    with open(path, "w", newline="") as out:
+        table = csv.writer(out)
+        table.writerow(COUNTS_HEADER)
+        for (gene, variant), count in sorted(
+            mutations.items(), key=lambda item: (-item[1], item[0])
+        ):
+            table.writerow([gene, variant, count])
@@ -0,0 +1,138 @@
+""" Classifies SARS-CoV-2 samples as VOC/VOI/Monitoring etc. from their
+    pangolin lineage and spike mutations. The rules of classifications.csv
+    are compiled once into a lineage trie and cached on disk, the cache is
+    invalidated whenever the csv is modified.
+
+    A row applies to its exact lineage only, unless the lineage is written
+    with a trailing ".*" (e.g. B.1.617.2.*): the row then also covers every
+    descendant that is not listed itself. Descendants resolve to the closest
+    ancestor with such a row.
+
+    By: Isak Sylvin & Tanja Normark
+"""
+
+import csv
+import hashlib
+import os
+import pickle
+
+from mutant import WD, log
+
+CLASSIFICATIONS = "{0}/standalone/classifications.csv".format(WD)
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "mutant",
+)
+# Bump when the pickled layout changes
+CACHE_FORMAT = 2
+# Suffix of lineages whose rules also cover their descendants
+DESCENDANTS = ".*"
+
+_compiled = dict()
+
+
+class VOCClassifier:
+    """Lineage trie of (required spike mutations, class, covers descendants) rules"""
+
+    __slots__ = ("trie", "resolved")
+
+    def __init__(self, rules):
+        """rules: iterable of (lineage, spike mutations, class) in priority order"""
+        # Each trie node is a (children, rules) pair keyed by lineage component
+        self.trie = dict()
+        for lineage, spike, voc_class in rules:
+            descendants = lineage.endswith(DESCENDANTS)
+            if descendants:
+                lineage = lineage[: -len(DESCENDANTS)]
+            children = self.trie
+            for part in lineage.split("."):
+                node = children.setdefault(part, (dict(), []))
+                children = node[0]
+            node[1].append((frozenset(spike), voc_class, descendants))
+        self.resolved = dict()
+
+    @classmethod
+    def from_csv(cls, path=CLASSIFICATIONS):
+        """Compiles the classification rules of a csv with lineage,spike,class columns"""
+        rules = []
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                spike = [mut.strip() for mut in row["spike"].split(";") if mut.strip()]
+                rules.append((row["lineage"].strip(), spike, row["class"].strip()))
+        return cls(rules)
+
+    def resolve(self, lineage):
+        """Returns the rules of the lineage, or else the descendant rules of its
+        closest ancestor that has any"""
+        if lineage in self.resolved:
+            return self.resolved[lineage]
+        found = ()
+        children = self.trie
+        parts = lineage.split(".")
+        for depth, part in enumerate(parts, 1):
+            if part not in children:
+                break
+            children, rules = children[part]
+            if depth == len(parts) and rules:
+                found = rules
+            elif any(rule[2] for rule in rules):
+                found = [rule for rule in rules if rule[2]]
+        self.resolved[lineage] = found
+        return found
+
+    def classify(self, lineage, mutations):
+        """Returns the class of a sample. Mutations are the sample's spike
+        mutations of interest. As before the trie, only the first rule (in
+        csv order) of the lineage (see resolve) is used, and it applies when
+        its required mutations are all present"""
+        if lineage == "None":
+            return "-"
+        rules = self.resolve(lineage)
+        if not rules:
+            return "No"
+        spike, voc_class, _ = rules[0]
+        if not isinstance(mutations, (set, frozenset)):
+            mutations = frozenset(mutations)
+        return voc_class if spike <= mutations else "No"
+
+    def __getstate__(self):
+        return self.trie
+
+    def __setstate__(self, state):
+        self.trie = state
+        self.resolved = dict()
+
+
+def load_classifier(path=CLASSIFICATIONS):
+    """Returns the compiled classifier of path. Memoised per process, and
+    pickled to the user cache dir keyed by the csv's mtime and size"""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, CACHE_FORMAT)
+    if key in _compiled:
+        return _compiled[key]
+
+    cachefile = os.path.join(
+        CACHE_DIR, "voc_classifier_{}.pickle".format(hashlib.md5(key[0].encode()).hexdigest())
+    )
+    classifier = None
+    try:
+        with open(cachefile, "rb") as f:
+            cached_key, cached = pickle.load(f)
+        if cached_key == key:
+            classifier = cached
+    except Exception:
+        pass
+
+    if classifier is None:
+        classifier = VOCClassifier.from_csv(path)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+            with open(tmpfile, "wb") as f:
+                pickle.dump((key, classifier), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cachefile)
+        except OSError as e:
+            log.debug("Unable to cache VOC classifier in {} ({})".format(CACHE_DIR, e))
+
+    _compiled[key] = classifier
+    return classifier
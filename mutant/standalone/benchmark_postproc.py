@@ -0,0 +1,444 @@
+""" Measures how the sarscov2 post-processing scales with the number of
+    samples. Realistic artic output trees (qc, variant summary, pangolin,
+    consensus, vcf, multiqc, execution trace and case config) are generated
+    for every requested size, and the run (with a stub in place of nextflow),
+    postproc and rename steps are replayed against them, each in a fresh
+    interpreter. Wall time and memory per step, and wall time per report stage, are written
+    as json, and compared against a previous result file to catch regressions.
+    By: Isak Sylvin & Tanja Normark """
+
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from argparse import SUPPRESS, ArgumentParser
+
+REGIONS = ["{:02d}".format(code) for code in range(1, 26)]
+LABS = ["SE{}".format(code) for code in range(100, 1000, 50)]
+LINEAGES = ["B.1.1.7", "B.1.617.2", "AY.4", "AY.3", "B.1.351", "P.1", "B.1.525", "A.23.1", "None"]
+MUTATIONS = [
+    ("S", "D614G"),
+    ("S", "N501Y"),
+    ("S", "P681H"),
+    ("S", "E484K"),
+    ("S", "L452R"),
+    ("S", "T478K"),
+    ("S", "K417N"),
+    ("S", "H69del"),
+    ("S", "A701V"),
+    ("S", "ins679GIAL"),
+    ("ORF1ab", "T3255I"),
+    ("ORF1ab", "P4715L"),
+    ("N", "R203K"),
+    ("N", "G204R"),
+    ("ORF8", "Q27*"),
+    ("M", "I82T"),
+]
+PROCESSES = ["readTrimming", "readMapping", "trimPrimerSequences", "makeConsensus", "pangolinTyping"]
+CASE = "benchcase"
+# Steps of 'analyse sarscov2', each replayed in its own interpreter
+STEPS = ["run", "postproc", "rename"]
+TICKET = 999999
+
+# Stub put first on PATH in place of nextflow, the results already exist
+NEXTFLOW_STUB = """#!/bin/sh
+log=""
+while [ $# -gt 0 ]; do [ "$1" = "-log" ] && log=$2; shift; done
+echo "Session uuid: 00000000-0000-4000-8000-000000000000" > $log
+"""
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument("-s",
+                        "--sizes",
+                        dest="sizes",
+                        help="Comma-separated sample counts to benchmark",
+                        metavar="<INT,INT>",
+                        required=False,
+                        type=str,
+                        default="10,1000,10000,100000")
+    parser.add_argument("-w",
+                        "--workdir",
+                        dest="workdir",
+                        help="Folder to generate the trees in, a temporary folder by default",
+                        metavar="<PATH>",
+                        required=False,
+                        type=str,
+                        default="")
+    parser.add_argument("-o",
+                        "--output",
+                        dest="output",
+                        help="Json file to write the results to",
+                        metavar="<PATH>",
+                        required=False,
+                        type=str,
+                        default="postproc_benchmark.json")
+    parser.add_argument("-e",
+                        "--engine",
+                        dest="engine",
+                        help="Ingestion engine for the artic result tables",
+                        choices=["csv", "pandas"],
+                        required=False,
+                        default="csv")
+    parser.add_argument("--streaming",
+                        dest="streaming",
+                        help="Build the reports in one sample-by-sample pass",
+                        action="store_true")
+    parser.add_argument("--workers",
+                        dest="workers",
+                        help="Report stages run in parallel",
+                        metavar="<INT>",
+                        required=False,
+                        type=int,
+                        default=4)
+    parser.add_argument("-g",
+                        "--genome_length",
+                        dest="genome_length",
+                        help="Length of the generated consensus sequences",
+                        metavar="<INT>",
+                        required=False,
+                        type=int,
+                        default=29903)
+    parser.add_argument("-m",
+                        "--memory",
+                        dest="memory",
+                        help="Trace python allocations for the peak memory of every step (slows the run down)",
+                        action="store_true")
+    parser.add_argument("-k",
+                        "--keep",
+                        dest="keep",
+                        help="Keep the generated trees",
+                        action="store_true")
+    parser.add_argument("-b",
+                        "--baseline",
+                        dest="baseline",
+                        help="Previous result file to compare against",
+                        metavar="<PATH>",
+                        required=False,
+                        type=str,
+                        default="")
+    parser.add_argument("-t",
+                        "--tolerance",
+                        dest="tolerance",
+                        help="Allowed slowdown relative to the baseline, e.g. 0.2 for 20%%",
+                        metavar="<FLOAT>",
+                        required=False,
+                        type=float,
+                        default=0.2)
+    parser.add_argument("--step",
+                        dest="step",
+                        help=SUPPRESS,
+                        choices=STEPS,
+                        required=False,
+                        default="run")
+    parser.add_argument("--replay",
+                        dest="replay",
+                        help=SUPPRESS,
+                        metavar="<PATH>",
+                        required=False,
+                        type=str,
+                        default="")
+    return parser
+
+
+def generate_tree(root, samples, genome_length, seed=1):
+    """Writes the artic output of a case with the given number of samples.
+    Returns the paths of the results folder, fastq folder and case config"""
+    rng = random.Random(seed)
+    indir = os.path.join(root, "results")
+    fastq = os.path.join(root, "fastq")
+    folders = {
+        "pangolin": "ncovIllumina_sequenceAnalysis_pangolinTyping",
+        "consensus": "ncovIllumina_sequenceAnalysis_makeConsensus",
+        "vcf": "ncovIllumina_Genotyping_typeVariants/vcf",
+        "info": "pipeline_info",
+        "multiqc": "multiqc/{}_multiqc_data".format(CASE),
+    }
+    for folder in folders.values():
+        os.makedirs(os.path.join(indir, folder), exist_ok=True)
+    os.makedirs(fastq, exist_ok=True)
+
+    reference = bytearray(rng.choice(b"ACGT") for _ in range(genome_length))
+    start = time.mktime((2021, 5, 1, 8, 0, 0, 0, 0, -1))
+    caseinfo = []
+    with open(os.path.join(indir, "{}.qc.csv".format(CASE)), "w") as qc, open(
+        os.path.join(indir, "{}.variant_summary.csv".format(CASE)), "w"
+    ) as variants, open(os.path.join(indir, folders["info"], "execution_trace.txt"), "w") as trace:
+        qc.write("sample_name,pct_N_bases,pct_covered_bases,longest_no_N_run,num_aligned_reads,fasta,bam,qc_pass\n")
+        variants.write("sample,gene,variant,dna\n")
+        trace.write("task_id\thash\tnative_id\tname\tstatus\texit\tsubmit\tduration\trealtime\t%cpu\tpeak_rss\tpeak_vmem\trchar\twchar\tcpus\tmemory\n")
+        task = 0
+        for number in range(samples):
+            sample = "B{:07d}".format(number)
+            region = rng.choice(REGIONS)
+            lab = rng.choice(LABS)
+            base_sample = "{}_{}_{}".format(region, lab, sample)
+            caseinfo.append(
+                {
+                    "CG_ID_project": "ACC{}".format(TICKET),
+                    "CG_ID_sample": "ACC{}A{}".format(TICKET, number),
+                    "case_ID": CASE,
+                    "region_code": region,
+                    "lab_code": lab,
+                    "priority": "standard",
+                    "Customer_ID_project": TICKET,
+                    "Customer_ID_sample": sample,
+                    "customer_id": "cust000",
+                    "application_tag": "VWGDPTR001",
+                    "date_arrival": "2021-04-28 00:00:00",
+                    "date_libprep": "2021-04-29 00:00:00",
+                    "date_sequencing": "2021-04-30 12:00:00",
+                    "method_libprep": "1508:22",
+                    "method_sequencing": "1606:10",
+                    "sequencing_qc_pass": rng.random() > 0.02,
+                    "selection_criteria": rng.choice(["1. Allmän övervakning", "2. Riktad insamling"]),
+                }
+            )
+
+            # Consensus with a few mutations and masked stretches
+            genome = bytearray(reference)
+            for _ in range(rng.randint(5, 40)):
+                genome[rng.randrange(genome_length)] = rng.choice(b"ACGT")
+            masked = 0
+            for _ in range(rng.randint(0, 4)):
+                begin = rng.randrange(genome_length)
+                end = min(genome_length, begin + rng.randint(50, 2000))
+                genome[begin:end] = b"N" * (end - begin)
+                masked += end - begin
+            with open(
+                os.path.join(indir, folders["consensus"], "{}.primertrimmed.consensus.fa".format(base_sample)), "wb"
+            ) as out:
+                out.write(">Consensus_{}.primertrimmed.consensus_threshold_0.75_quality_20\n".format(base_sample).encode())
+                for offset in range(0, genome_length, 60):
+                    out.write(genome[offset : offset + 60] + b"\n")
+            pct_n = 100.0 * masked / genome_length
+            qc.write(
+                "{},{:.2f},{:.2f},{},{},{}.primertrimmed.consensus.fa,{}.mapped.primertrimmed.sorted.bam,{}\n".format(
+                    base_sample,
+                    pct_n,
+                    100 - pct_n,
+                    genome_length - masked,
+                    rng.randint(50000, 900000),
+                    base_sample,
+                    base_sample,
+                    "TRUE" if pct_n < 5 else "FALSE",
+                )
+            )
+
+            for gene, mutation in rng.sample(MUTATIONS, rng.randint(0, 10)):
+                variants.write("{},{},{},c.{}A>G\n".format(base_sample, gene, mutation, rng.randrange(genome_length)))
+
+            with open(os.path.join(indir, folders["pangolin"], "{}.pangolin.csv".format(base_sample)), "w") as out:
+                out.write("taxon,lineage,probability,pangoLEARN_version,status,note\n")
+                out.write(
+                    "Consensus_{}.primertrimmed.consensus_threshold_0.75_quality_20,{},1.0,2021-05-19,passed_qc,\n".format(
+                        base_sample, rng.choice(LINEAGES)
+                    )
+                )
+            with open(os.path.join(indir, folders["vcf"], "{}.csq.vcf".format(base_sample)), "w") as out:
+                out.write("##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+
+            submit = start + number
+            for process in PROCESSES:
+                task += 1
+                realtime = rng.randint(5, 300)
+                trace.write(
+                    "{0}\t{1:02x}/{2:06x}\t{3}\tncovIllumina:sequenceAnalysis:{4} ({5})\tCOMPLETED\t0\t{6}\t{7}s\t{8}s\t{9}%\t{10} MB\t{11} MB\t{12} MB\t{13} MB\t4\t8 GB\n".format(
+                        task,
+                        task % 256,
+                        task,
+                        1000000 + task,
+                        process,
+                        base_sample,
+                        time.strftime("%Y-%m-%d %H:%M:%S.000", time.localtime(submit)),
+                        realtime + rng.randint(0, 60),
+                        realtime,
+                        rng.randint(50, 390),
+                        rng.randint(100, 4000),
+                        rng.randint(4000, 8000),
+                        rng.randint(10, 500),
+                        rng.randint(10, 500),
+                    )
+                )
+                submit += realtime + 60
+
+    with open(os.path.join(indir, "{}.typing_summary.csv".format(CASE)), "w") as out:
+        out.write("sample,gene,nucleotide,amino_acid\n")
+    with open(os.path.join(indir, "multiqc", "{}_multiqc.html".format(CASE)), "w") as out:
+        out.write("<html></html>\n")
+    with open(os.path.join(indir, folders["multiqc"], "multiqc_data.json"), "w") as out:
+        out.write("{}\n")
+    casefile = os.path.join(root, "{}.json".format(CASE))
+    with open(casefile, "w") as out:
+        json.dump(caseinfo, out, indent=2)
+    return indir, fastq, casefile
+
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(name, func, results, memory):
+    """Runs func, records its wall time and memory under name. Returns its result.
+    Every step is replayed in its own interpreter, so maxrss_mb is the peak of
+    this step alone; rss_before_mb is the peak before it started"""
+    rss_before = maxrss_mb()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    value = func()
+    results[name] = {
+        "wall_s": round(time.perf_counter() - start, 3),
+        "maxrss_mb": round(maxrss_mb(), 1),
+        "rss_before_mb": round(rss_before, 1),
+    }
+    if memory:
+        results[name]["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+        tracemalloc.stop()
+    return value
+
+
+def replay(root, step, engine, workers, memory, streaming=False):
+    """Runs one step of 'analyse sarscov2' against a generated tree. Called in a
+    fresh interpreter per step, so that memory figures only concern this step"""
+    from mutant import WD
+    from mutant.modules.sarscov2_delivery import DeliverySC2
+    from mutant.modules.sarscov2_report import ReportSC2
+    from mutant.modules.sarscov2_start import RunSC2
+
+    with open(os.path.join(root, "replay.json")) as f:
+        paths = json.load(f)
+    results = dict()
+    if step == "run":
+        stub_dir = os.path.join(root, "bin")
+        os.makedirs(stub_dir, exist_ok=True)
+        with open(os.path.join(stub_dir, "nextflow"), "w") as out:
+            out.write(NEXTFLOW_STUB)
+        os.chmod(os.path.join(stub_dir, "nextflow"), 0o755)
+        os.environ["PATH"] = "{}{}{}".format(stub_dir, os.pathsep, os.environ["PATH"])
+
+        run = RunSC2(
+            input_folder=paths["fastq"],
+            caseID=CASE,
+            prefix=CASE,
+            profiles="local",
+            timestamp="bench",
+            WD=WD,
+        )
+        measure("run", lambda: run.run_case(paths["indir"], launch_dir=root), results, memory)
+    elif step == "postproc":
+        report = ReportSC2(
+            caseinfo=paths["casefile"],
+            indir=paths["indir"],
+            config_artic="",
+            fastq_dir=paths["fastq"],
+            timestamp="bench",
+            engine=engine,
+            workers=workers,
+            force=True,
+            streaming=streaming,
+        )
+        stages = measure("postproc", report.create_all_files, results, memory)
+        results["postproc"]["stages"] = {name: round(seconds, 3) for name, seconds in stages.items()}
+    elif step == "rename":
+        delivery = DeliverySC2(caseinfo=paths["casefile"], indir=paths["indir"])
+        measure("rename", delivery.rename_deliverables, results, memory)
+    return results
+
+
+def main():
+    args = get_parser().parse_args()
+    if args.replay:
+        results = replay(
+            args.replay, args.step, args.engine, args.workers, args.memory, args.streaming
+        )
+        sys.stdout.write("\n{}\n".format(json.dumps(results)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mutant_benchmark_")
+    results = {
+        "python": sys.version.split()[0],
+        "engine": args.engine,
+        "workers": args.workers,
+        "streaming": args.streaming,
+        "genome_length": args.genome_length,
+        "sizes": dict(),
+    }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        root = os.path.join(workdir, "samples_{}".format(size))
+        start = time.perf_counter()
+        indir, fastq, casefile = generate_tree(root, size, args.genome_length)
+        with open(os.path.join(root, "replay.json"), "w") as out:
+            json.dump({"indir": indir, "fastq": fastq, "casefile": casefile}, out)
+        generated = time.perf_counter() - start
+
+        steps = dict()
+        for step in STEPS:
+            cmd = [sys.executable, os.path.abspath(__file__), "--replay", root, "--step", step, "--engine", args.engine, "--workers", str(args.workers)]
+            if args.memory:
+                cmd.append("--memory")
+            if args.streaming:
+                cmd.append("--streaming")
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0:
+                print("Replay of {} on {} samples failed:\n{}".format(step, size, proc.stderr))
+                sys.exit(-1)
+            steps.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+        results["sizes"][str(size)] = {"generate_s": round(generated, 1), "steps": steps}
+        print(
+            "{:>7} samples  {}".format(
+                size,
+                "  ".join(
+                    "{} {:.2f}s {:.0f}MB".format(name, step["wall_s"], step["maxrss_mb"])
+                    for name, step in steps.items()
+                ),
+            )
+        )
+        if not args.keep:
+            shutil.rmtree(root)
+    if not args.keep and not args.workdir:
+        shutil.rmtree(workdir)
+
+    with open(args.output, "w") as out:
+        json.dump(results, out, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            previous = json.load(f)["sizes"]
+        regressions = []
+        for size, result in results["sizes"].items():
+            if size not in previous:
+                continue
+            for name, step in result["steps"].items():
+                before = previous[size]["steps"].get(name)
+                if before is None:
+                    continue
+                if step["wall_s"] > before["wall_s"] * (1 + args.tolerance):
+                    regressions.append(
+                        "{} samples, {}: {:.2f}s -> {:.2f}s".format(size, name, before["wall_s"], step["wall_s"])
+                    )
+                for key in ("maxrss_mb", "peak_traced_mb"):
+                    if key not in step or key not in before:
+                        continue
+                    if step[key] > before[key] * (1 + args.tolerance):
+                        regressions.append(
+                            "{} samples, {} {}: {:.0f}MB -> {:.0f}MB".format(
+                                size, name, key, before[key], step[key]
+                            )
+                        )
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+""" Measures the cold-start time of every mutant subcommand, each run in a
+    fresh interpreter with --help, and lists heavy modules that got imported
+    on the way. Results are written as json, and compared against a previous
+    result file to catch startup regressions.
+    By: Isak Sylvin & Tanja Normark """
+
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+
+HEAVY_MODULES = ["pandas", "numpy", "yaml"]
+
+# Invokes the CLI in-process and reports which heavy modules were loaded
+PROBE = """
+import json, sys
+from mutant.cli import root
+try:
+    root.main(args=sys.argv[1:], prog_name="mutant", standalone_mode=False)
+finally:
+    sys.stderr.write(json.dumps([m for m in {heavy} if m in sys.modules]))
+"""
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument("-o",
+                        "--output",
+                        dest="output",
+                        help="Json file to write the results to",
+                        metavar="<PATH>",
+                        required=False,
+                        type=str,
+                        default="startup_benchmark.json")
+    parser.add_argument("-r",
+                        "--repeats",
+                        dest="repeats",
+                        help="Runs per subcommand, the median is reported",
+                        metavar="<INT>",
+                        required=False,
+                        type=int,
+                        default=5)
+    parser.add_argument("-b",
+                        "--baseline",
+                        dest="baseline",
+                        help="Previous result file to compare against",
+                        metavar="<PATH>",
+                        required=False,
+                        type=str,
+                        default="")
+    parser.add_argument("-t",
+                        "--tolerance",
+                        dest="tolerance",
+                        help="Allowed slowdown relative to the baseline, e.g. 0.2 for 20%%",
+                        metavar="<FLOAT>",
+                        required=False,
+                        type=float,
+                        default=0.2)
+    return parser
+
+
+def list_subcommands():
+    """Returns the argument list of every leaf command of the mutant CLI"""
+    import click
+    from mutant.cli import root
+
+    commands = []
+
+    def walk(group, path):
+        for name, command in sorted(group.commands.items()):
+            if isinstance(command, click.Group):
+                walk(command, path + [name])
+            else:
+                commands.append(path + [name])
+
+    walk(root, [])
+    return commands
+
+
+def time_command(args, repeats):
+    """Median wall-clock seconds of `mutant <args> --help` and the heavy modules it loaded"""
+    timings = []
+    loaded = []
+    probe = PROBE.format(heavy=HEAVY_MODULES)
+    for _ in range(repeats):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-c", probe] + args + ["--help"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        timings.append(time.perf_counter() - start)
+        try:
+            loaded = json.loads(proc.stderr.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print("Unable to probe 'mutant {}': {}".format(" ".join(args), proc.stderr))
+            sys.exit(-1)
+    return statistics.median(timings), loaded
+
+
+def main():
+    args = get_parser().parse_args()
+    results = {"python": sys.version.split()[0], "commands": dict()}
+    baseline_time, _ = time_command([], args.repeats)
+    results["interpreter_and_cli"] = baseline_time
+    for command in list_subcommands():
+        seconds, loaded = time_command(command, args.repeats)
+        name = " ".join(command)
+        results["commands"][name] = {"seconds": seconds, "heavy_modules": loaded}
+        print("mutant {:<30} {:.3f}s {}".format(name, seconds, ",".join(loaded)))
+
+    with open(args.output, "w") as out:
+        json.dump(results, out, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            previous = json.load(f)["commands"]
+        regressions = []
+        for name, result in results["commands"].items():
+            if name not in previous:
+                continue
+            if result["seconds"] > previous[name]["seconds"] * (1 + args.tolerance):
+                regressions.append(
+                    "{}: {:.3f}s -> {:.3f}s".format(name, previous[name]["seconds"], result["seconds"])
+                )
+            for module in set(result["heavy_modules"]) - set(previous[name]["heavy_modules"]):
+                regressions.append("{}: now imports {}".format(name, module))
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,101 +2,269 @@
     all reverse fastq files into one file for each sample. The files
     that are used for concatenation will be removed afterwards if they
     got more than 1 inode.
+    With --verify every gzip member is decompressed in the same pass as
+    the copy, CRC/ISIZE is checked and reads are counted. The outcome is
+    written to a per sample integrity manifest.
+    Sample folders and read directions are processed concurrently, and
+    the data is copied kernel-side (copy_file_range/sendfile) when the
+    platform allows it.
     By: @henningonsbring """
 
+import json
 import os
 import re
-import subprocess
+import zlib
 import sys
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
 PREFIX_TO_CONCATENATE = ["MWG", "MWL", "MWM", "MWR", "MWX", "CONCATENATE"]
-parser = ArgumentParser()
-
-parser.add_argument("-i",
-                    "--input_folder",
-                    dest="input_folder",
-                    help="Folder with fastq to concatenate",
-                    metavar="<PATH>",
-                    required=True,
-                    type=str)
-parser.add_argument("-a",
-                    "--app_tag",
-                    dest="app_tag",
-                    help="Application tag",
-                    metavar="<STRING>",
-                    required=False,
-                    type=str,
-                    default="CONCATENATE")
-parser.add_argument("-d",
-                    "--date",
-                    dest="date",
-                    help="Date to add to the concatenated file name, e.g. order date",
-                    metavar="<DATE>",
-                    required=False,
-                    type=str,
-                    default="")
-
-args = parser.parse_args()
-should_concatenate = False
-
-for prefix in PREFIX_TO_CONCATENATE:
-    if args.app_tag.startswith(prefix):
-        print("Apptag %s identified, data generated with this application tag should be concatenated" % (args.app_tag))
-        should_concatenate = True
-
-if should_concatenate == False:
-    print("Data with application tag %s should not be concatenated, skipping concatenation" % (args.app_tag))
-    sys.exit(-1)
-
-for dir_name in os.listdir(args.input_folder):
-    dir_path = os.path.join(args.input_folder, dir_name)
-    if len(os.listdir(dir_path)) == 0:
-        print("Empty folder found: %s" % (dir_path))
-        cmd = "rmdir " + str(dir_path)
-        os.system(cmd)
-        print("Running command: %s" % (cmd))
-        continue
-    if not os.path.isdir(dir_path):
-        continue
-    for read_direction in [1, 2]:
-        same_direction = []
-        total_size = 0
-        for file in os.listdir(dir_path):
-            abs_path_file = os.path.join(dir_path, file)
-            direction_string = ".+_R" + str(read_direction) + "_[0-9]+.fastq.gz"
-            direction_pattern = re.compile(direction_string)
+# Bytes handed to the kernel per copy call, and user space buffer for the fallback copy
+COPY_CHUNK = 64 * 1024 * 1024
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument("-i",
+                        "--input_folder",
+                        dest="input_folder",
+                        help="Folder with fastq to concatenate",
+                        metavar="<PATH>",
+                        required=True,
+                        type=str)
+    parser.add_argument("-a",
+                        "--app_tag",
+                        dest="app_tag",
+                        help="Application tag",
+                        metavar="<STRING>",
+                        required=False,
+                        type=str,
+                        default="CONCATENATE")
+    parser.add_argument("-d",
+                        "--date",
+                        dest="date",
+                        help="Date to add to the concatenated file name, e.g. order date",
+                        metavar="<DATE>",
+                        required=False,
+                        type=str,
+                        default="")
+    parser.add_argument("-t",
+                        "--threads",
+                        dest="threads",
+                        help="Number of sample folders/read directions concatenated in parallel",
+                        metavar="<INT>",
+                        required=False,
+                        type=int,
+                        default=min(8, os.cpu_count() or 1))
+    parser.add_argument("-v",
+                        "--verify",
+                        dest="verify",
+                        help="Verify gzip integrity and count reads while concatenating",
+                        action="store_true")
+    return parser
+
+
+def write_all(out_fd, data):
+    """Write all of data to out_fd, os.write may write less than asked"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(out_fd, view):]
+
+
+def copy_into(out_fd, in_path):
+    """Append the content of in_path to the open file descriptor out_fd.
+    Tries copy_file_range, then sendfile, then a plain buffered copy"""
+    with open(in_path, "rb") as infile:
+        in_fd = infile.fileno()
+        remaining = os.fstat(in_fd).st_size
+        for kernel_copy in (getattr(os, "copy_file_range", None), getattr(os, "sendfile", None)):
+            if kernel_copy is None:
+                continue
+            try:
+                while remaining > 0:
+                    if kernel_copy is os.sendfile:
+                        copied = os.sendfile(out_fd, in_fd, None, min(remaining, COPY_CHUNK))
+                    else:
+                        copied = kernel_copy(in_fd, out_fd, min(remaining, COPY_CHUNK))
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError:
+                # Unsupported by the file system (or partially done), continue from the current offsets
+                continue
+        while True:
+            chunk = infile.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            write_all(out_fd, chunk)
+
+
+def copy_and_verify(out_fd, in_path):
+    """Append the content of in_path to out_fd while streaming every gzip member
+    through zlib, which validates CRC32 and ISIZE. Returns an integrity report"""
+    report = {"file": in_path, "size": 0, "members": 0, "reads": 0, "status": "OK"}
+    lines = 0
+    member_open = False
+    decompressor = zlib.decompressobj(wbits=31)
+    with open(in_path, "rb") as infile:
+        while True:
+            chunk = infile.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            write_all(out_fd, chunk)
+            report["size"] += len(chunk)
+            # Once a member is found corrupt the rest of the file is only copied
+            while chunk and report["status"] == "OK":
+                member_open = True
+                try:
+                    lines += decompressor.decompress(chunk).count(b"\n")
+                except zlib.error as e:
+                    report["status"] = "Corrupt gzip member {}: {}".format(report["members"] + 1, e)
+                    break
+                if not decompressor.eof:
+                    break
+                # Member complete, remaining bytes belong to the next member
+                report["members"] += 1
+                member_open = False
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+    if report["status"] == "OK":
+        if report["members"] == 0 or member_open:
+            report["status"] = "Truncated gzip member {}".format(report["members"] + 1)
+        elif lines % 4 != 0:
+            report["status"] = "Truncated fastq record ({} lines)".format(lines)
+    report["reads"] = lines // 4
+    return report
+
+
+def find_direction_files(dir_path, read_direction):
+    """Returns the sorted fastq files of one read direction and their summed size"""
+    same_direction = []
+    total_size = 0
+    direction_pattern = re.compile(".+_R" + str(read_direction) + "_[0-9]+.fastq.gz")
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            abs_path_file = os.path.join(dir_path, entry.name)
             if direction_pattern.match(abs_path_file):
                 same_direction.append(os.path.abspath(abs_path_file))
-                total_size = total_size + Path(abs_path_file).stat().st_size
-        same_direction.sort()
-        cmd = "cat"
-        for i in range(len(same_direction)):
-            cmd = cmd + " " + same_direction[i]
-        if args.date:
-            output = dir_path + "/" + str(args.date) + "_" + dir_name + "_" + str(read_direction) + ".fastq.gz"
-        else:
-            output = dir_path + "/" + dir_name + "_" + str(read_direction) + ".fastq.gz"
-        cmd = cmd + " > " + output
-        print("Running command: %s" % (cmd))
-        os.system(cmd)
-        concatenated_size = Path(output).stat().st_size
-        if total_size == concatenated_size:
-            print(
-                "QC PASSED: Total size for files used in concatenation match the size of the concatenated file"
-            )
-            for file in same_direction:
-                inode_check_cmd = "stat -c %h " + file
-                n_inodes = subprocess.getoutput(inode_check_cmd)
-                if int(n_inodes) > 1:
-                    print("Removing file: %s" % (file))
-                    os.remove(file)
-                else:
-                    print(
-                        "WARNING %s only got 1 inode, file will not be removed" % (file)
-                    )
-        else:
-            print("WARNING data lost in concatenation")
+                total_size = total_size + entry.stat().st_size
+    same_direction.sort()
+    return same_direction, total_size
+
+
+def concatenate_direction(dir_path, dir_name, read_direction, date, verify=False):
+    """Concatenates all files of one read direction in a sample folder, then
+    removes the inputs that are hardlinked elsewhere if the size QC passes.
+    Returns the QC outcome and the integrity reports of the inputs (if verified)"""
+    same_direction, total_size = find_direction_files(dir_path, read_direction)
+    if date:
+        output = dir_path + "/" + str(date) + "_" + dir_name + "_" + str(read_direction) + ".fastq.gz"
+    else:
+        output = dir_path + "/" + dir_name + "_" + str(read_direction) + ".fastq.gz"
+    print("Concatenating %s into %s" % (" ".join(same_direction), output))
+    reports = []
+    out_fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for file in same_direction:
+            if verify:
+                reports.append(copy_and_verify(out_fd, file))
+            else:
+                copy_into(out_fd, file)
+    finally:
+        os.close(out_fd)
+    corrupt = [report for report in reports if report["status"] != "OK"]
+    for report in corrupt:
+        print("WARNING %s failed integrity check: %s" % (report["file"], report["status"]))
+    concatenated_size = Path(output).stat().st_size
+    if corrupt:
+        print("WARNING corrupt input found, no files used in concatenation of %s will be removed" % (output))
+    elif total_size == concatenated_size:
+        print(
+            "QC PASSED: Total size for files used in concatenation match the size of the concatenated file %s" % (output)
+        )
+        for file in same_direction:
+            if os.stat(file).st_nlink > 1:
+                print("Removing file: %s" % (file))
+                os.remove(file)
+            else:
+                print(
+                    "WARNING %s only got 1 inode, file will not be removed" % (file)
+                )
+        return True, output, reports
+    else:
+        print("WARNING data lost in concatenation of %s" % (output))
+    return False, output, reports
+
+
+def write_manifest(dir_path, dir_name, date, outcomes):
+    """Writes the integrity manifest of one sample folder next to its concatenated files"""
+    if date:
+        manifest = os.path.join(dir_path, "{}_{}_integrity.json".format(date, dir_name))
+    else:
+        manifest = os.path.join(dir_path, "{}_integrity.json".format(dir_name))
+    content = {"sample": dir_name, "passed": True, "outputs": []}
+    for read_direction, (passed, output, reports) in sorted(outcomes.items()):
+        content["passed"] = content["passed"] and passed
+        content["outputs"].append(
+            {
+                "read_direction": read_direction,
+                "output": output,
+                "passed": passed,
+                "reads": sum(report["reads"] for report in reports),
+                "inputs": reports,
+            }
+        )
+    with open(manifest, "w") as out:
+        json.dump(content, out, indent=2)
+    print("Integrity manifest written to %s" % (manifest))
+
+
+def main():
+    args = get_parser().parse_args()
+    should_concatenate = False
+
+    for prefix in PREFIX_TO_CONCATENATE:
+        if args.app_tag.startswith(prefix):
+            print("Apptag %s identified, data generated with this application tag should be concatenated" % (args.app_tag))
+            should_concatenate = True
+
+    if should_concatenate == False:
+        print("Data with application tag %s should not be concatenated, skipping concatenation" % (args.app_tag))
+        # Nothing to do is not a failure, only QC and integrity failures exit non-zero
+        return
+
+    jobs = []
+    for dir_name in sorted(os.listdir(args.input_folder)):
+        dir_path = os.path.join(args.input_folder, dir_name)
+        if not os.path.isdir(dir_path):
+            continue
+        if len(os.listdir(dir_path)) == 0:
+            print("Empty folder found: %s" % (dir_path))
+            print("Removing folder: %s" % (dir_path))
+            os.rmdir(dir_path)
+            continue
+        for read_direction in [1, 2]:
+            jobs.append((dir_path, dir_name, read_direction, args.date))
+
+    with ThreadPoolExecutor(max_workers=max(1, args.threads)) as pool:
+        futures = [pool.submit(concatenate_direction, *job, args.verify) for job in jobs]
+        results = [future.result() for future in futures]
+
+    if args.verify:
+        per_sample = dict()
+        for (dir_path, dir_name, read_direction, date), outcome in zip(jobs, results):
+            per_sample.setdefault((dir_path, dir_name), dict())[read_direction] = outcome
+        for (dir_path, dir_name), outcomes in per_sample.items():
+            write_manifest(dir_path, dir_name, args.date, outcomes)
+
+    if not all(passed for passed, output, reports in results):
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
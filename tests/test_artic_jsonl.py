@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from mutant.modules.artic_jsonl import JsonlWriter, index_path, iter_jsonl, load_samples
+
+
+def test_index_written_as_samples_go(tmp_path):
+    path = str(tmp_path / "case_artic.jsonl")
+    with JsonlWriter(path) as writer:
+        writer.write("S1", {"lineage": "B.1.1.7"})
+        writer.write("S2", {"lineage": "B.1.617.2", "note": "ä"})
+        writer.index.flush()
+        with open(writer.index_tmpfile) as index:
+            assert [line.split("\t")[0] for line in index] == ["S1", "S2"]
+        assert not os.path.exists(index_path(path))
+    assert list(iter_jsonl(path)) == [
+        ("S1", {"lineage": "B.1.1.7"}),
+        ("S2", {"lineage": "B.1.617.2", "note": "ä"}),
+    ]
+    assert load_samples(path, ["S2", "S3"]) == {"S2": {"lineage": "B.1.617.2", "note": "ä"}}
+
+
+def test_abort_leaves_nothing(tmp_path):
+    path = str(tmp_path / "case_artic.jsonl")
+    with pytest.raises(RuntimeError):
+        with JsonlWriter(path) as writer:
+            writer.write("S1", {})
+            raise RuntimeError
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_without_index(tmp_path):
+    path = str(tmp_path / "case_artic.jsonl")
+    with JsonlWriter(path, index=False) as writer:
+        writer.write("S1", {})
+    assert os.listdir(str(tmp_path)) == ["case_artic.jsonl"]
+    assert load_samples(path, ["S1"]) == {"S1": {}}
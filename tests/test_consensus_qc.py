@@ -0,0 +1,79 @@
+import csv
+
+from mutant.modules.consensus_qc import (
+    consensus_metrics,
+    cross_check,
+    file_metrics,
+    read_qc,
+    write_metrics,
+)
+
+CONSENSUS_DIR = "ncovIllumina_sequenceAnalysis_makeConsensus"
+
+
+def write_fasta(path, sequence, width=10):
+    lines = [sequence[i : i + width] for i in range(0, len(sequence), width)]
+    path.write_text(">{}\n{}\n".format(path.name, "\n".join(lines)))
+
+
+def test_metrics(tmp_path):
+    # 30 bases, 8 N in two runs, one R and one y
+    path = tmp_path / "01_Region_A_SE1_Lab_S1.primertrimmed.consensus.fa"
+    write_fasta(path, "NNNNNACGTACGTRACGTnnnACGTAyGTN")
+    sample, metrics = file_metrics(str(path))
+    assert sample == "S1"
+    assert metrics["length"] == 30
+    assert metrics["pct_n_bases"] == 9 / 30 * 100
+    assert metrics["longest_no_N_run"] == 13
+    assert metrics["ambiguous_bases"] == {"R": 1, "Y": 1}
+    assert metrics["n_runs"] == [[1, 5], [19, 21], [30, 30]]
+
+
+def test_edge_cases(tmp_path):
+    empty = tmp_path / "S1.consensus.fa"
+    empty.write_text(">S1\n")
+    all_n = tmp_path / "S2.consensus.fa"
+    write_fasta(all_n, "N" * 25)
+    second_record = tmp_path / "S3.consensus.fa"
+    second_record.write_text(">S3\nACGT\n>other\nNNNN\n")
+
+    metrics = dict(consensus_metrics([str(empty), str(all_n), str(second_record)]))
+    assert metrics["S1"]["length"] == 0
+    assert metrics["S1"]["pct_n_bases"] == 100.0
+    assert metrics["S2"]["longest_no_N_run"] == 0
+    assert metrics["S2"]["n_runs"] == [[1, 25]]
+    assert metrics["S3"]["length"] == 4
+    assert metrics["S3"]["n_runs"] == []
+
+
+def test_cross_check():
+    metrics = {"pct_n_bases": 10.0, "longest_no_N_run": 100}
+    assert cross_check({"pct_n_bases": "10.004", "longest_no_N_run": "101"}, metrics) == []
+    assert cross_check({"pct_n_bases": "10.5", "longest_no_N_run": "98"}, metrics) == [
+        "pct_n_bases",
+        "longest_no_N_run",
+    ]
+    assert cross_check({"pct_n_bases": "NA"}, metrics) == []
+
+
+def test_write_metrics(tmp_path):
+    consensus = tmp_path / CONSENSUS_DIR
+    consensus.mkdir()
+    write_fasta(consensus / "01_Region_A_SE1_Lab_S1.primertrimmed.consensus.fa", "ACGTNNACGT")
+    write_fasta(consensus / "01_Region_A_SE1_Lab_S2.primertrimmed.consensus.fa", "ACGTACGTAC")
+    qc = tmp_path / "case.qc.csv"
+    qc.write_text(
+        "sample_name,pct_N_bases,pct_covered_bases,longest_no_N_run,num_aligned_reads,fasta,bam,qc_pass\n"
+        "01_Region_A_SE1_Lab_S1,20.0,100,4,10,f,b,TRUE\n"
+        "01_Region_A_SE1_Lab_S2,0.0,100,5,10,f,b,TRUE\n"
+    )
+    assert read_qc(str(qc))["S1"] == {"pct_n_bases": "20.0", "longest_no_N_run": "4"}
+
+    output = tmp_path / "consensus_metrics.csv"
+    assert write_metrics(str(tmp_path), str(output), qc_path=str(qc)) == (2, 1)
+    with open(output, newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [row["sample"] for row in rows] == ["S1", "S2"]
+    assert rows[0]["n_runs"] == "5-6"
+    assert rows[0]["mismatch"] == "-"
+    assert rows[1]["mismatch"] == "longest_no_N_run"
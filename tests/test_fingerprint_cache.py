@@ -0,0 +1,119 @@
+import os
+
+from mutant.modules.fingerprint_cache import FingerprintCache
+from mutant.modules.stage_scheduler import StageScheduler
+
+SETTINGS = {"version": "test"}
+
+
+def touch(path, content, offset=0):
+    """Writes content with an mtime moved offset seconds ahead"""
+    path.write_text(content)
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + offset * 10 ** 9))
+
+
+def build(tmp_path, runs, settings=SETTINGS, force=False):
+    """Runs a cached stage copying in.txt to out.txt, then an in-memory stage
+    and a cached stage that both depend on it"""
+    source = tmp_path / "in.txt"
+    output = tmp_path / "out.txt"
+    summary = tmp_path / "summary.txt"
+
+    def copy():
+        runs.append("copy")
+        output.write_text(source.read_text())
+
+    def summarise():
+        runs.append("summary")
+        summary.write_text(str(len(output.read_text())))
+
+    cache = FingerprintCache(str(tmp_path), settings=settings)
+    scheduler = StageScheduler(workers=2, cache=cache, force=force)
+    scheduler.add("copy", copy, inputs=[source], outputs=[output])
+    scheduler.add("load", lambda: runs.append("load"), requires=["copy"])
+    scheduler.add("summary", summarise, requires=["load"], inputs=[output], outputs=[summary])
+    scheduler.run()
+
+
+def test_fresh_stages_are_skipped(tmp_path):
+    touch(tmp_path / "in.txt", "abc")
+    runs = []
+    build(tmp_path, runs)
+    assert runs == ["copy", "load", "summary"]
+    runs.clear()
+    build(tmp_path, runs)
+    assert runs == []
+
+
+def test_changed_input_reruns_downstream(tmp_path):
+    touch(tmp_path / "in.txt", "abc")
+    build(tmp_path, [])
+    touch(tmp_path / "in.txt", "abcd", offset=1)
+    runs = []
+    build(tmp_path, runs)
+    assert runs == ["copy", "load", "summary"]
+    assert (tmp_path / "summary.txt").read_text() == "4"
+
+
+def test_touched_output_reruns_stage(tmp_path):
+    touch(tmp_path / "in.txt", "abc")
+    build(tmp_path, [])
+    touch(tmp_path / "summary.txt", "edited", offset=1)
+    runs = []
+    build(tmp_path, runs)
+    assert runs == ["load", "summary"]
+
+
+def test_missing_output_reruns_stage(tmp_path):
+    touch(tmp_path / "in.txt", "abc")
+    build(tmp_path, [])
+    os.remove(str(tmp_path / "out.txt"))
+    runs = []
+    build(tmp_path, runs)
+    assert runs == ["copy", "load", "summary"]
+
+
+def test_settings_and_force_rerun_everything(tmp_path):
+    touch(tmp_path / "in.txt", "abc")
+    build(tmp_path, [])
+    runs = []
+    build(tmp_path, runs, settings={"version": "other"})
+    assert runs == ["copy", "load", "summary"]
+    runs = []
+    build(tmp_path, runs, settings={"version": "other"}, force=True)
+    assert runs == ["copy", "load", "summary"]
+
+
+def test_hashed_inputs(tmp_path):
+    source = tmp_path / "in.txt"
+    touch(source, "abc")
+    cache = FingerprintCache(str(tmp_path), settings=SETTINGS, hash_inputs=True)
+    snapshot = cache.snapshot([source])
+    cache.record("stage", snapshot, [])
+    # Same size and mtime, other content
+    stat = os.stat(str(source))
+    source.write_text("xyz")
+    os.utime(str(source), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.snapshot([source]) != snapshot
+
+
+def test_update_outputs(tmp_path):
+    touch(tmp_path / "in.txt", "abc")
+    build(tmp_path, [])
+    output = tmp_path / "out.txt"
+    cache = FingerprintCache(str(tmp_path), settings=None)
+    before = {str(output): cache.fingerprint(str(output))}
+    touch(output, "abc, checked", offset=1)
+    assert cache.update_outputs("copy", before, [output])
+    cache.save()
+    runs = []
+    build(tmp_path, runs)
+    assert runs == ["load", "summary"]
+
+    # Outputs that were already stale are not made fresh
+    touch(output, "stale", offset=2)
+    cache = FingerprintCache(str(tmp_path), settings=None)
+    before = {str(output): cache.fingerprint(str(output))}
+    touch(output, "stale, checked", offset=3)
+    assert cache.update_outputs("copy", before, [output]) is False
@@ -0,0 +1,56 @@
+import os
+
+from mutant.modules.sarscov2_delivery import index_dir, make_links
+
+
+def test_make_links_is_idempotent(tmp_path):
+    targets = []
+    for name in ("a.fastq.gz", "b.fastq.gz"):
+        (tmp_path / name).write_text(name)
+        targets.append(str(tmp_path / name))
+    links = [(target, target.replace(".fastq.gz", "_1.fastq.gz")) for target in targets]
+
+    assert make_links(links) == {"created": 2, "skipped": 0, "failed": 0}
+    assert make_links(links) == {"created": 0, "skipped": 2, "failed": 0}
+    for target, link in links:
+        assert os.readlink(link) == target
+
+
+def test_make_links_replaces_stale_links(tmp_path):
+    old = tmp_path / "old.fa"
+    new = tmp_path / "new.fa"
+    old.write_text("old")
+    new.write_text("new")
+    link = str(tmp_path / "sample.fa")
+    os.symlink(str(old), link)
+    # Dangling links are replaced too
+    dangling = str(tmp_path / "dangling.fa")
+    os.symlink(str(tmp_path / "gone.fa"), dangling)
+
+    counts = make_links([(str(new), link), (str(new), dangling)])
+    assert counts == {"created": 2, "skipped": 0, "failed": 0}
+    assert os.readlink(link) == str(new)
+    assert os.readlink(dangling) == str(new)
+
+
+def test_make_links_keeps_regular_files(tmp_path):
+    target = tmp_path / "target.fa"
+    target.write_text("target")
+    existing = tmp_path / "existing.fa"
+    existing.write_text("keep")
+
+    counts = make_links([(str(target), str(existing))])
+    assert counts == {"created": 0, "skipped": 0, "failed": 1}
+    assert not os.path.islink(str(existing))
+    assert existing.read_text() == "keep"
+
+
+def test_index_dir(tmp_path):
+    for name in ("S1.consensus.fa", "S1.vcf", "S10.vcf", ".hidden.vcf"):
+        (tmp_path / name).write_text("")
+    index = index_dir(str(tmp_path))
+    assert index["S1"] == ["S1.consensus.fa", "S1.vcf"]
+    assert index["S1.consensus"] == ["S1.consensus.fa"]
+    assert index["S10"] == ["S10.vcf"]
+    assert "" not in index
+    assert index_dir(str(tmp_path / "missing")) == dict()
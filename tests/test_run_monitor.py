@@ -0,0 +1,35 @@
+import json
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mutant.modules.run_monitor import STREAM_LIMIT, run_command
+
+SCRIPT = """
+import sys
+print("[5d/6a3b1c] Submitted process > articNcovIllumina:readTrimming (sample1)")
+print("x" * {})
+print("failed", file=sys.stderr)
+sys.exit(3)
+""".format(
+    STREAM_LIMIT * 2
+)
+
+
+def test_run_from_worker_thread(tmp_path):
+    # Batch mode runs cases from worker threads
+    status = str(tmp_path / "status.json")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        future = pool.submit(
+            run_command,
+            [sys.executable, "-c", SCRIPT],
+            "case1",
+            str(tmp_path / "execution_trace.txt"),
+            status_file=status,
+        )
+        assert future.result(timeout=60) == 3
+    with open(status) as f:
+        progress = json.load(f)
+    assert progress["state"] == "failed"
+    assert progress["exit"] == 3
+    assert progress["processes"]["articNcovIllumina:readTrimming"]["submitted"] == 1
@@ -0,0 +1,96 @@
+import json
+import os
+
+import pytest
+
+from mutant.modules.sarscov2_report import ReportSC2
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "testdata")
+PANGOLIN_DIR = "ncovIllumina_sequenceAnalysis_pangolinTyping"
+
+
+def write_case(path, entries):
+    """Writes a case config, with its mtime moved ahead so it reads as changed"""
+    with open(path, "w") as out:
+        json.dump(entries, out)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Artic results of the two samples of the MIC3109 case config"""
+    with open(os.path.join(TESTDATA, "MIC3109_artic.json")) as f:
+        entries = json.load(f)
+    casefile = str(tmp_path / "case.json")
+    write_case(casefile, entries)
+    indir = tmp_path / "results"
+    (indir / PANGOLIN_DIR).mkdir(parents=True)
+    qc = ["sample_name,pct_N_bases,pct_covered_bases,longest_no_N_run,num_aligned_reads,fasta,bam,qc_pass"]
+    variants = ["sample,gene,variant,dna"]
+    for entry in entries:
+        name = "01_Region_Pirridutt_SE999_Langistan_{}".format(entry["Customer_ID_sample"])
+        qc.append("{},1.5,98.5,29000,5000,f,b,TRUE".format(name))
+        variants.append("{},S,N501Y,c.1A>G".format(name))
+        (indir / PANGOLIN_DIR / "{}.pangolin.csv".format(name)).write_text(
+            "taxon,lineage,probability,pangoLEARN_version,status,note\n"
+            "Consensus_{}.primertrimmed,B.1.1.7,1.0,2021-05-01,passed_qc,\n".format(name)
+        )
+    (indir / "tinycase.qc.csv").write_text("\n".join(qc) + "\n")
+    (indir / "tinycase.variant_summary.csv").write_text("\n".join(variants) + "\n")
+    (indir / "pipeline_info").mkdir()
+    (indir / "pipeline_info" / "execution_trace.txt").write_text(
+        "task_id\tname\tstatus\tsubmit\tduration\trealtime\n"
+        "1\tncovIllumina:sequenceAnalysis:readTrimming (x)\tCOMPLETED\t"
+        "2021-05-01 10:00:00.000\t1m 0s\t30s\n"
+    )
+    return casefile, str(indir), entries
+
+
+def run_report(casefile, indir, today=None, **options):
+    report = ReportSC2(
+        caseinfo=casefile,
+        indir=indir,
+        config_artic="",
+        fastq_dir=indir,
+        timestamp="T",
+        workers=2,
+        **options
+    )
+    if today is not None:
+        report.today = today
+    return report.create_all_files()
+
+
+def test_deliverables_follow_the_date(tree):
+    casefile, indir, _ = tree
+    run_report(casefile, indir, today="20261019")
+    ran = run_report(casefile, indir, today="20261019")
+    assert "deliveryfile" not in ran
+
+    ran = run_report(casefile, indir, today="20261020")
+    assert "fohm_csv" in ran and "deliveryfile" in ran
+    with open(os.path.join(indir, "tinycase_deliverables.yaml")) as f:
+        deliverables = f.read()
+    assert "20261020_komplettering.csv" in deliverables
+    assert "20261019_komplettering.csv" not in deliverables
+
+
+def test_variant_shards_follow_the_case_config(tree):
+    casefile, indir, entries = tree
+    entries[1]["lab_code"] = "SE100 Other"
+    write_case(casefile, entries)
+    run_report(casefile, indir, variant_shards="regionlab")
+
+    # Same region-labs, swapped between the samples
+    entries[0]["lab_code"], entries[1]["lab_code"] = "SE100 Other", "SE999 Langistan"
+    write_case(casefile, entries)
+    ran = run_report(casefile, indir, variant_shards="regionlab")
+    assert "variantfile" in ran
+    shard = os.path.join(
+        indir,
+        "variants_by_regionlab",
+        "sars-cov-2_123456_01_Region_Pirridutt_SE100_Other_variants.csv",
+    )
+    with open(shard) as f:
+        assert "12CS123456" in f.read()
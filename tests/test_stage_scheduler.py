@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from mutant.modules.stage_scheduler import StageScheduler
+
+
+def test_requirements_run_first():
+    order = []
+    lock = threading.Lock()
+
+    def stage(name, delay=0.0):
+        def run():
+            time.sleep(delay)
+            with lock:
+                order.append(name)
+
+        return run
+
+    scheduler = StageScheduler(workers=4)
+    scheduler.add("a", stage("a", 0.05))
+    scheduler.add("b", stage("b"))
+    scheduler.add("c", stage("c"), requires=["a"])
+    scheduler.add("d", stage("d"), requires=["b", "c"])
+    timings = scheduler.run()
+    assert sorted(timings) == ["a", "b", "c", "d"]
+    assert order.index("a") < order.index("c") < order.index("d")
+    assert order.index("b") < order.index("d")
+
+
+def test_independent_stages_overlap():
+    barrier = threading.Barrier(2, timeout=5)
+    scheduler = StageScheduler(workers=2)
+    # Deadlocks (and times out) unless both run at once
+    scheduler.add("a", barrier.wait)
+    scheduler.add("b", barrier.wait)
+    scheduler.run()
+
+
+def test_unknown_requirement():
+    scheduler = StageScheduler()
+    with pytest.raises(ValueError):
+        scheduler.add("b", lambda: None, requires=["a"])
+
+
+def test_fail_fast():
+    ran = []
+
+    def fail():
+        raise RuntimeError("broken")
+
+    def slow():
+        time.sleep(0.1)
+        ran.append("slow")
+
+    scheduler = StageScheduler(workers=2)
+    scheduler.add("fail", fail)
+    scheduler.add("slow", slow)
+    scheduler.add("after_fail", lambda: ran.append("after_fail"), requires=["fail"])
+    scheduler.add("after_slow", lambda: ran.append("after_slow"), requires=["slow"])
+    with pytest.raises(RuntimeError, match="broken"):
+        scheduler.run()
+    # Running stages finish, no new stage starts after the failure
+    assert ran == ["slow"]
@@ -0,0 +1,63 @@
+import json
+import os
+
+from mutant.modules.variant_index import (
+    REGIONS_OF_INTEREST,
+    VariantIndex,
+    load_variant_index,
+    parse_variant,
+)
+
+
+def test_parse_variant():
+    variant = parse_variant("S", "N501Y")
+    assert (variant.ref, variant.pos, variant.alt) == ("N", 501, "Y")
+    variant = parse_variant("S", "ins679GIAL")
+    assert (variant.ref, variant.pos, variant.alt) == ("ins", 679, "GIAL")
+    assert parse_variant("S", "H69del").pos == 69
+    assert parse_variant("S", "unknown").pos is None
+
+
+def test_regions():
+    index = VariantIndex(regions=[("S", 475, 485), ("*", 10, 10)])
+    assert index.matches("S", "E484K")
+    assert index.matches("S", "S477N")
+    assert index.matches("S", "T475A")
+    assert index.matches("S", "F486L") is False
+    assert index.matches("ORF1ab", "E484K") is False
+    # Gene '*' matches every gene
+    assert index.matches("N", "R10K")
+    assert index.matches("N", "R100000K") is False
+
+
+def test_named_mutations():
+    index = VariantIndex(named=["D614G", "ORF1ab:T3255I"])
+    assert index.matches("S", "D614G")
+    assert index.matches("M", "D614G")
+    assert index.matches("ORF1ab", "T3255I")
+    assert index.matches("S", "T3255I") is False
+    # Whole names, not substrings
+    assert index.matches("S", "D614GX") is False
+
+
+def test_default_config():
+    index = load_variant_index(REGIONS_OF_INTEREST)
+    assert index.matches("S", "N501Y")
+    assert index.matches("S", "E484Q")
+    assert index.matches("S", "G142D") is False
+
+
+def test_config_reloaded_on_change(tmp_path):
+    listing = tmp_path / "named.csv"
+    listing.write_text("mutation\nN501Y\n")
+    config = tmp_path / "regions.json"
+    config.write_text(json.dumps({"regions": [], "named_mutations": ["named.csv"]}))
+    index = load_variant_index(str(config))
+    assert index.matches("S", "N501Y")
+    assert index.matches("S", "K417N") is False
+    assert load_variant_index(str(config)) is index
+
+    listing.write_text("mutation\nN501Y\nK417N\n")
+    stat = os.stat(str(listing))
+    os.utime(str(listing), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert load_variant_index(str(config)).matches("S", "K417N")
@@ -0,0 +1,99 @@
+import csv
+import os
+
+import pytest
+
+from mutant.modules import variant_report
+from mutant.modules.case_model import load_case
+from mutant.modules.variant_report import write_variant_report
+
+TESTDATA = os.path.join(os.path.dirname(__file__), "testdata")
+SUMMARY = [
+    ["sample", "gene", "variant", "dna"],
+    ["01_Region_Pirridutt_SE999_Langistan_12CS123456", "S", "N501Y", "c.1A>G"],
+    ["01_Region_Pirridutt_SE999_Langistan_12CS123456", "S", "D614G", "c.2A>G"],
+    ["01_Region_Pirridutt_SE999_Langistan_34CS123456", "S", "D614G", "c.2A>G"],
+    ["02_Region_Other_SE100_Lab_56CS123456", "ORF1ab", "T3255I", "c.3A>G"],
+]
+
+
+def read_csv(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f))
+
+
+@pytest.fixture
+def summary(tmp_path):
+    path = tmp_path / "case.variant_summary.csv"
+    with open(path, "w", newline="") as out:
+        csv.writer(out).writerows(SUMMARY)
+    return str(path)
+
+
+def test_report_and_counts(tmp_path, summary, monkeypatch):
+    # Several chunks
+    monkeypatch.setattr(variant_report, "CHUNK_ROWS", 3)
+    output = str(tmp_path / "variants.csv")
+    counts = str(tmp_path / "counts.csv")
+    assert write_variant_report(summary, output, counts=counts) == 4
+    assert read_csv(output) == [SUMMARY[0]] + [
+        [line[0].split("_")[-1]] + line[1:] for line in SUMMARY[1:]
+    ]
+    assert read_csv(counts) == [
+        ["gene", "variant", "count"],
+        ["S", "D614G", "2"],
+        ["ORF1ab", "T3255I", "1"],
+        ["S", "N501Y", "1"],
+    ]
+
+
+def test_columns_by_position(tmp_path):
+    # Other header names do not stop the report
+    source = tmp_path / "renamed.csv"
+    source.write_text("sample,a,b\nx_1,S,N501Y\n")
+    output = tmp_path / "variants.csv"
+    counts = str(tmp_path / "counts.csv")
+    assert write_variant_report(str(source), str(output), counts=counts) == 1
+    assert read_csv(str(output)) == [["sample", "a", "b"], ["1", "S", "N501Y"]]
+    assert read_csv(counts)[1:] == [["S", "N501Y", "1"]]
+
+
+def test_regionlab_shards(tmp_path, summary):
+    caseinfo = load_case(os.path.join(TESTDATA, "MIC3109_artic.json"))
+    shard_path = lambda shard: str(tmp_path / "{}.csv".format(shard))
+    write_variant_report(
+        summary,
+        str(tmp_path / "variants.csv"),
+        shard_mode="regionlab",
+        shard_path=shard_path,
+        shards=["03_Region_Empty_SE1_Lab"],
+        caseinfo=caseinfo,
+    )
+    assert read_csv(shard_path("01_Region_Pirridutt_SE999_Langistan")) == [
+        SUMMARY[0],
+        ["12CS123456", "S", "N501Y", "c.1A>G"],
+        ["12CS123456", "S", "D614G", "c.2A>G"],
+        ["34CS123456", "S", "D614G", "c.2A>G"],
+    ]
+    # Samples missing from the case config are split on their name
+    assert read_csv(shard_path("02_Region_Other_SE100_Lab")) == [
+        SUMMARY[0],
+        ["56CS123456", "ORF1ab", "T3255I", "c.3A>G"],
+    ]
+    assert read_csv(shard_path("03_Region_Empty_SE1_Lab")) == [SUMMARY[0]]
+
+
+def test_sample_shards(tmp_path, summary):
+    shard_path = lambda shard: str(tmp_path / "{}.csv".format(shard))
+    write_variant_report(
+        summary, str(tmp_path / "variants.csv"), shard_mode="sample", shard_path=shard_path
+    )
+    assert len(read_csv(shard_path("12CS123456"))) == 3
+    assert len(read_csv(shard_path("34CS123456"))) == 2
+    assert len(read_csv(shard_path("56CS123456"))) == 2
+
+
+def test_missing_source(tmp_path):
+    output = str(tmp_path / "variants.csv")
+    assert write_variant_report(None, output) == 0
+    assert os.path.getsize(output) == 0
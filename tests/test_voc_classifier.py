@@ -0,0 +1,102 @@
+import csv
+
+import pytest
+
+from mutant.modules import voc_classifier
+from mutant.modules.voc_classifier import CLASSIFICATIONS, VOCClassifier, load_classifier
+
+
+def legacy_classify(rows, lineage, mutations):
+    """The classification of load_artic_results before the trie: first row of
+    the exact lineage, spike list matched as a substring"""
+    if lineage == "None":
+        return "-"
+    lineages = [row["lineage"] for row in rows]
+    if lineage not in lineages:
+        return "No"
+    row = rows[lineages.index(lineage)]
+    if row["spike"] in ";".join(mutations):
+        return row["class"]
+    return "No"
+
+
+@pytest.fixture(scope="module")
+def rows():
+    with open(CLASSIFICATIONS) as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return VOCClassifier.from_csv(CLASSIFICATIONS)
+
+
+def test_matches_legacy_classifier(rows, classifier):
+    # The legacy classifier only knew exact lineages
+    legacy_rows = []
+    for row in rows:
+        lineage = row["lineage"]
+        if lineage.endswith(voc_classifier.DESCENDANTS):
+            lineage = lineage[: -len(voc_classifier.DESCENDANTS)]
+        legacy_rows.append(dict(row, lineage=lineage))
+    samples = [("None", []), ("B.1.1.1", ["D614G"]), ("B.1.1.7", [])]
+    for row in legacy_rows:
+        spike = row["spike"].split(";")
+        samples.extend([(row["lineage"], spike), (row["lineage"], spike[1:])])
+    for lineage, mutations in samples:
+        assert classifier.classify(lineage, mutations) == legacy_classify(
+            legacy_rows, lineage, mutations
+        ), (lineage, mutations)
+
+
+def test_unlisted_descendants_are_not_classified(classifier):
+    # B.1 is listed, its descendants are not
+    assert classifier.classify("B.1", ["A701V", "D614G", "E484K", "K417N", "N501Y"]) == "VOC"
+    assert classifier.classify("B.1.1", ["A701V", "D614G", "E484K", "K417N", "N501Y"]) == "No"
+    assert classifier.classify("B.1.177", ["A701V", "D614G", "E484K", "K417N", "N501Y"]) == "No"
+
+
+def test_descendant_rows():
+    classifier = VOCClassifier(
+        [
+            ("B.1.617.2.*", ["L452R"], "VOC"),
+            ("B.1.617.2.5", ["T478K"], "VOI"),
+            ("B.1", [], "Monitoring"),
+        ]
+    )
+    assert classifier.classify("B.1.617.2", ["L452R"]) == "VOC"
+    assert classifier.classify("B.1.617.2.4.1", ["L452R"]) == "VOC"
+    # Listed descendants only use their own rows
+    assert classifier.classify("B.1.617.2.5", ["L452R"]) == "No"
+    assert classifier.classify("B.1.617.2.5", ["L452R", "T478K"]) == "VOI"
+    assert classifier.classify("B.1.617.2.5", ["T478K"]) == "VOI"
+    assert classifier.classify("B.1.617.3", ["L452R"]) == "No"
+
+
+def test_first_rule_of_a_lineage(classifier):
+    # Only the first B.1.1.7 row (Monitoring, D614G;L452R;N501Y;P681H) is used
+    assert classifier.classify("B.1.1.7", ["D614G", "L452R", "N501Y", "P681H"]) == "Monitoring"
+    assert classifier.classify("B.1.1.7", ["D614G", "N501Y", "P681H"]) == "No"
+    assert classifier.classify("B.1.1.7", ["D614G", "N501Y", "P681H", "S494P"]) == "No"
+
+
+def test_no_substring_matches():
+    classifier = VOCClassifier([("P.2", ["D614G", "E484K"], "Monitoring")])
+    assert classifier.classify("P.2", ["D614G", "E484K"]) == "Monitoring"
+    assert classifier.classify("P.2", ["D614G", "E484KX"]) == "No"
+
+
+def test_cached_classifier(tmp_path, monkeypatch):
+    monkeypatch.setattr(voc_classifier, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(voc_classifier, "_compiled", dict())
+    path = tmp_path / "classifications.csv"
+    path.write_text("lineage,spike,class\nA.1.*,S1,VOC\n")
+    assert load_classifier(str(path)).classify("A.1.2", ["S1"]) == "VOC"
+    assert len(list(tmp_path.glob("voc_classifier_*.pickle"))) == 1
+
+    monkeypatch.setattr(voc_classifier, "_compiled", dict())
+    assert load_classifier(str(path)).classify("A.1.2", ["S1"]) == "VOC"
+
+    path.write_text("lineage,spike,class\nA.1,S1,VOI\n")
+    assert load_classifier(str(path)).classify("A.1.2", ["S1"]) == "No"
+    assert load_classifier(str(path)).classify("A.1", ["S1"]) == "VOI"